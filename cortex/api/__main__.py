@@ -14,8 +14,10 @@ def cli():
 @click.option('--port', '-p', type=int, default=5000, show_default=True, help='API Server port')
 @click.option('--database', '-d', type=str, default='monogodb://127.0.0.1:27017', show_default=True, callback=strip_str,
               help='Database URL')
-def _run_api_server(host, port, database):
-    return run_api_server(host=host, port=port, database_url=database)
+@click.option('--workers', '-w', type=int, default=1, show_default=True,
+              help='Worker processes, sharing the listening socket')
+def _run_api_server(host, port, database, workers):
+    return run_api_server(host=host, port=port, database_url=database, workers=workers)
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
+import contextlib
 import importlib
 from .app import app
+from ..prefork import Supervisor
 from ..utils import parse_url
 
 
@@ -11,7 +13,14 @@ def setup_app(database_url):
     app.config.update(DB_CLIENT=db_client)
 
 
-def run_api_server(host='127.0.0.1', port=5000, database_url='mongodb://127.0.0.1:27017'):
+@contextlib.contextmanager
+def _api_worker(database_url):
+    # Runs in every worker process, each has its own database connection
+    setup_app(database_url=database_url)
+    yield app
+
+
+def run_api_server(host='127.0.0.1', port=5000, database_url='mongodb://127.0.0.1:27017', workers=1):
     """Sets up an API server which exposes the given database
 
     Initialized by a database url in the format <mq_name>://<host>:<port>.
@@ -24,7 +33,12 @@ def run_api_server(host='127.0.0.1', port=5000, database_url='mongodb://127.0.0.
         host (:obj:`str`): Hostname of the API server
         port (:obj:`int`): Port of the API server
         database_url (:obj:`str`): Database URL in the format <db_name>://<host>:<port>
+        workers (:obj:`int`, optional): Number of worker processes sharing the listening socket (see
+            :class:`cortex.prefork.Supervisor`), each with its own database client
     """
+    if workers > 1:
+        Supervisor(host, port, lambda: _api_worker(database_url), workers).run()
+        return
     setup_app(database_url=database_url)
     app.run(host=host, port=port, threaded=True)
 
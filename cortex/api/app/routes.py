@@ -17,6 +17,8 @@ def get_users():
 @app.route('/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     user = app.config['DB_CLIENT'].get_user(user_id)
+    if user is None:
+        return _not_found(f'User {user_id}')
     if isinstance(user['birthday'], datetime.datetime):
         user['birthday'] = user['birthday'].strftime('%Y/%m/%d')
     return jsonify(user)
@@ -34,6 +36,8 @@ def get_user_snapshots(user_id):
 @app.route('/users/<int:user_id>/snapshots/<int:ss_id>', methods=['GET'])
 def get_user_snapshot(user_id, ss_id):
     user_snapshot = app.config['DB_CLIENT'].get_user_snapshot(user_id, ss_id)
+    if user_snapshot is None:
+        return _not_found(f'Snapshot {ss_id} of user {user_id}')
     return jsonify(user_snapshot)
 
 
@@ -41,6 +45,8 @@ def get_user_snapshot(user_id, ss_id):
 def get_user_snapshot_field(user_id, ss_id, field):
     _data_fields = {'image_color', 'image_depth'}
     result = app.config['DB_CLIENT'].get_user_snapshot_field(user_id, ss_id, field)
+    if result is None:
+        return _not_found(f'Field {field} of snapshot {ss_id} of user {user_id}')
     if field in _data_fields:
         result[field] = request.base_url + '/data'
     return jsonify(result)
@@ -49,4 +55,10 @@ def get_user_snapshot_field(user_id, ss_id, field):
 @app.route('/users/<int:user_id>/snapshots/<int:ss_id>/<string:field>/data', methods=['GET'])
 def get_user_snapshot_field_data(user_id, ss_id, field):
     data = app.config['DB_CLIENT'].get_user_snapshot_field_data(user_id, ss_id, field)
+    if data is None:
+        return _not_found(f'Field {field} of snapshot {ss_id} of user {user_id}')
     return data
+
+
+def _not_found(what):
+    return jsonify({'error': f'{what} not found'}), 404
@@ -0,0 +1 @@
+from .benchmark import Benchmark, run_benchmark, write_results, read_results, compare_results
@@ -0,0 +1,51 @@
+import sys
+import click
+from .benchmark import Benchmark, run_benchmark, write_results, read_results, compare_results
+from ..utils import strip_str
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name='run')
+@click.option('--count', '-n', type=int, default=20, show_default=True, help='Snapshots in the synthetic sample')
+@click.option('--color-size', type=(int, int), default=(1920, 1080), show_default=True,
+              help='Width and height of the color images')
+@click.option('--depth-size', type=(int, int), default=(224, 172), show_default=True,
+              help='Width and height of the depth images')
+@click.option('--repeat', '-r', type=int, default=3, show_default=True, help='Timed runs per case')
+@click.option('--output', '-o', type=str, default='', callback=strip_str, help='Path of a JSON file to write results to')
+@click.argument('names', type=str, nargs=-1)
+def _run(count, color_size, depth_size, repeat, output, names):
+    all_results = {}
+    for name in names or sorted(Benchmark._BENCHMARKS):
+        name = strip_str(None, None, name)
+        results = run_benchmark(name, count=count, color_size=color_size, depth_size=depth_size, repeat=repeat)
+        for case, result in results.items():
+            latency = f', p50 {result["p50_ms"]:.2f}ms, p99 {result["p99_ms"]:.2f}ms' if 'p50_ms' in result else ''
+            print(f'{name}[{case}]: {result["ops_per_sec"]:.2f} ops/sec ({result["seconds"]:.3f}s{latency})')
+        all_results[name] = results
+    if output:
+        write_results(output, all_results, count=count, color_size=color_size, depth_size=depth_size, repeat=repeat)
+
+
+@cli.command(name='compare')
+@click.option('--threshold', '-t', type=float, default=0.1, show_default=True,
+              help='Tolerated relative throughput drop')
+@click.argument('baseline', type=str, required=True, callback=strip_str)
+@click.argument('results', type=str, required=True, callback=strip_str)
+def _compare(threshold, baseline, results):
+    comparison = compare_results(read_results(baseline), read_results(results), threshold=threshold)
+    regressions = 0
+    for name, case, before, after, change, regressed in comparison:
+        regressions += regressed
+        print(f'{name}[{case}]: {before:.2f} -> {after:.2f} ops/sec ({change:+.1%})'
+              f'{"  REGRESSION" if regressed else ""}')
+    print(f'{regressions} regressions in {len(comparison)} cases')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    cli(prog_name='cortex.benchmarks')
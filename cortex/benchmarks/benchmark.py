@@ -0,0 +1,377 @@
+import importlib
+import json
+import platform
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+import bson
+import mongomock
+
+from .synthetic import write_sample
+from ..client.reader import Reader, convert_sample
+from ..net import blobstore, protocol
+from ..parsers.parser import Parser
+
+
+class Benchmark:
+    """Generic benchmark class.
+
+    Initialized by a benchmark name. By calling the instance with keyword options, the call will run the
+    registered benchmark function and return its measurements.
+
+    Note:
+        Adding new benchmarks:\n
+        A new benchmark function needs to be implemented and match the following requirements:
+            Registration
+                - Decorated by :meth:`Benchmark.register_benchmark` initialized with the benchmark name.
+            Interface
+                - Recieves keyword options (see :func:`run_benchmark`) and returns a dictionary mapping a case name
+                  to a measurement dictionary (see :func:`measure`).
+
+    Args:
+        name (str): The benchmark name
+    """
+    _BENCHMARKS = {}
+
+    def __init__(self, name):
+        self.name = name
+        try:
+            self.benchmark = Benchmark._BENCHMARKS[name]
+        except KeyError as e:
+            raise KeyError(f'No benchmark exists with the name: {name}', e)
+
+    def __call__(self, **options):
+        return self.benchmark(**options)
+
+    @staticmethod
+    def register_benchmark(name):
+        """A Decorator for registering benchmark functions.
+
+        Args:
+            name (str): The name of the registered benchmark
+        """
+        def decorator(f):
+            Benchmark._BENCHMARKS[name] = f
+            return f
+        return decorator
+
+
+def measure(function, count, repeat=3):
+    """Times a function and reports the best of ``repeat`` runs
+
+    Args:
+        function (callable): Function to time, called without arguments
+        count (int): Number of operations a single call performs
+        repeat (int, optional): Number of timed runs
+
+    Returns:
+        dict: Measurement dictionary {'seconds': val, 'ops_per_sec': val}
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return {'seconds': best, 'ops_per_sec': count / best}
+
+
+def _sample(workdir, count, color_size, depth_size):
+    path = Path(workdir) / 'synthetic.mind.gz'
+    write_sample(path, count=count, color_size=color_size, depth_size=depth_size)
+    return path
+
+
+@Benchmark.register_benchmark('read_snapshot')
+def bench_read_snapshot(count, color_size, depth_size, repeat):
+    """Snapshots/sec of :class:`cortex.client.reader.DriverProtobuf` in legacy and fast decoding modes, and of
+    :class:`cortex.client.reader.DriverMmap` on the uncompressed sample"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = _sample(workdir, count, color_size, depth_size)
+        mmap_path = convert_sample(path)
+
+        def read_all(fast, path=path, driver_type='protobuf'):
+            reader = Reader(path, driver_type, fast=fast)
+            reader.read_user()
+            for snapshot in reader:
+                snapshot.to_bson()
+
+        return {'legacy': measure(lambda: read_all(False), count, repeat),
+                'fast': measure(lambda: read_all(True), count, repeat),
+                'mmap': measure(lambda: read_all(True, mmap_path, 'mmap'), count, repeat)}
+
+
+@Benchmark.register_benchmark('read_projection')
+def bench_read_projection(count, color_size, depth_size, repeat):
+    """Snapshots/sec of :class:`cortex.client.reader.DriverProtobuf` decoding all fields vs. pose only"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = _sample(workdir, count, color_size, depth_size)
+
+        def read_all(fast, fields):
+            reader = Reader(path, 'protobuf', fast=fast)
+            reader.select_fields(fields)
+            reader.read_user()
+            for snapshot in reader:
+                snapshot.to_bson(fields=fields)
+
+        all_fields = ['pose', 'image_color', 'image_depth', 'feelings']
+        return {'legacy': measure(lambda: read_all(False, all_fields), count, repeat),
+                'legacy_pose': measure(lambda: read_all(False, ['pose']), count, repeat),
+                'fast': measure(lambda: read_all(True, all_fields), count, repeat),
+                'fast_pose': measure(lambda: read_all(True, ['pose']), count, repeat)}
+
+
+@Benchmark.register_benchmark('wire_format')
+def bench_wire_format(count, color_size, depth_size, repeat):
+    """Snapshots/sec of encoding and decoding upload messages with each of the protocol wire formats"""
+    with tempfile.TemporaryDirectory() as workdir:
+        reader = Reader(_sample(workdir, count, color_size, depth_size), 'protobuf')
+        user = reader.read_user().to_bson()
+        snapshots = list(reader)
+        reader.close()
+
+    results = {}
+    for wire_format in protocol.WIRE_FORMATS:
+        raw = wire_format != 'bson'
+        encoded = [protocol.encode_message({'user': user, 'snapshot': snapshot.to_bson(raw=raw)}, wire_format)
+                   for snapshot in snapshots]
+
+        def encode_all():
+            for snapshot in snapshots:
+                protocol.encode_message({'user': user, 'snapshot': snapshot.to_bson(raw=raw)}, wire_format)
+
+        def decode_all():
+            for data in encoded:
+                protocol.decode_message(data, wire_format)
+
+        results[f'{wire_format}_encode'] = measure(encode_all, count, repeat)
+        results[f'{wire_format}_decode'] = measure(decode_all, count, repeat)
+    return results
+
+
+def _messages(workdir, count, color_size, depth_size):
+    """Returns the messages the server publishes for a synthetic sample, with the raw images written to workdir"""
+    reader = Reader(_sample(workdir, count, color_size, depth_size), 'protobuf')
+    user = reader.read_user().to_bson()
+    messages = []
+    for snapshot in reader:
+        snapshot_doc = snapshot.to_bson()
+        snapshot_dir = Path(workdir) / str(protocol.timestamp_key(snapshot.timestamp_ms))
+        snapshot_dir.mkdir()
+        for fname in ('image_color', 'image_depth'):
+            image_path = snapshot_dir / f'{fname}.raw'
+            image_path.write_bytes(snapshot_doc[fname][fname])
+            snapshot_doc[fname][fname] = str(image_path)
+        messages.append(bson.encode({'user': user, 'snapshot': snapshot_doc}))
+    reader.close()
+    return messages
+
+
+@Benchmark.register_benchmark('protocol')
+def bench_protocol(count, color_size, depth_size, repeat):
+    """Snapshots/sec of :meth:`cortex.net.protocol.Snapshot.to_bson` and
+    :meth:`cortex.net.protocol.Snapshot.from_bson`, including the BSON encoding"""
+    with tempfile.TemporaryDirectory() as workdir:
+        reader = Reader(_sample(workdir, count, color_size, depth_size), 'protobuf')
+        reader.read_user()
+        snapshots = list(reader)
+        reader.close()
+    encoded = [bson.encode(snapshot.to_bson()) for snapshot in snapshots]
+
+    def encode_all():
+        for snapshot in snapshots:
+            bson.encode(snapshot.to_bson())
+
+    def decode_all():
+        for data in encoded:
+            protocol.Snapshot.from_bson(bson.decode(data))
+
+    return {'to_bson': measure(encode_all, count, repeat),
+            'from_bson': measure(decode_all, count, repeat)}
+
+
+@Benchmark.register_benchmark('parsers')
+def bench_parsers(count, color_size, depth_size, repeat):
+    """Messages/sec of every registered :class:`cortex.parsers.parser.Parser` on the published messages"""
+    with tempfile.TemporaryDirectory() as workdir:
+        messages = _messages(workdir, count, color_size, depth_size)
+        results = {}
+        for field in sorted(Parser._PARSERS):
+            parser = Parser(field)
+
+            def parse_all():
+                for message in messages:
+                    parser(message)
+
+            results[field] = measure(parse_all, count, repeat)
+        return results
+
+
+@Benchmark.register_benchmark('saver')
+def bench_saver(count, color_size, depth_size, repeat):
+    """Saves/sec of :class:`cortex.net.db.mongodb.SaverClient` against an in-memory MongoDB (mongomock),
+    saving the parsed result of every field of every snapshot one by one and in batches of 64 results"""
+    # Imported here, like the saver does, so the module binds pymongo's client only when it's used
+    mongodb = importlib.import_module(name='..net.db.mongodb', package='cortex.benchmarks')
+    with tempfile.TemporaryDirectory() as workdir:
+        messages = _messages(workdir, count, color_size, depth_size)
+        results = [(field, bson.decode(Parser(field)(message)))
+                   for message in messages for field in sorted(Parser._PARSERS)]
+
+    def save_all(batch_size):
+        with mock.patch.object(mongodb, 'MongoClient', mongomock.MongoClient):
+            client = mongodb.SaverClient('127.0.0.1', 27017)
+        if batch_size == 1:
+            for field, data in results:
+                client.save(field, data)
+        else:
+            for i in range(0, len(results), batch_size):
+                client.save_batch(results[i:i + batch_size])
+
+    return {'save': measure(lambda: save_all(1), len(results), repeat),
+            'save_batch': measure(lambda: save_all(64), len(results), repeat)}
+
+
+@Benchmark.register_benchmark('ingest')
+def bench_ingest(count, color_size, depth_size, repeat):
+    """Snapshots/sec and request latency percentiles of the server's /snapshot route, with the raw images written
+    before responding (sync) and by the write-behind :class:`cortex.server.writer.BlobWriter`. The write-behind
+    throughput includes waiting for the queued writes to be synced."""
+    from ..server import Server
+
+    with tempfile.TemporaryDirectory() as workdir:
+        reader = Reader(_sample(workdir, count, color_size, depth_size), 'protobuf')
+        user = reader.read_user().to_bson()
+        bodies = [protocol.encode_message({'user': user, 'snapshot': snapshot.to_bson(raw=True)}, 'frame')
+                  for snapshot in reader]
+        reader.close()
+
+        def ingest(write_behind):
+            config = {**Server._CONFIG, 'DATA_FOLDER': str(Path(workdir) / 'shared'), 'WRITE_BEHIND': write_behind}
+            with mock.patch.object(Server, '_CONFIG', config):
+                server = Server('127.0.0.1', 8000, publish=lambda message: None)
+            client = server.app.test_client()
+            latencies = []
+
+            def post_all():
+                for body in bodies:
+                    start = time.perf_counter()
+                    client.post('/snapshot', data=body, headers={'Content-Type': protocol.WIRE_FORMATS['frame']})
+                    latencies.append(time.perf_counter() - start)
+                if server.blob_writer is not None:
+                    server.blob_writer.flush()
+
+            result = measure(post_all, count, repeat)
+            if server.blob_writer is not None:
+                server.blob_writer.close()
+            latencies.sort()
+            result['p50_ms'] = 1000 * latencies[len(latencies) // 2]
+            result['p99_ms'] = 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            return result
+
+        return {'sync': ingest(False), 'write_behind': ingest(True)}
+
+
+@Benchmark.register_benchmark('blob_store')
+def bench_blob_store(count, color_size, depth_size, repeat):
+    """Snapshots/sec of writing (and syncing) and reading the raw images of a sample to each registered
+    :class:`cortex.net.blobstore.BlobStore`"""
+    with tempfile.TemporaryDirectory() as workdir:
+        reader = Reader(_sample(workdir, count, color_size, depth_size), 'protobuf')
+        reader.read_user()
+        images = [(protocol.timestamp_key(snapshot.timestamp_ms), snapshot.image_color.tobytes(),
+                   snapshot.image_depth.tobytes()) for snapshot in reader]
+        reader.close()
+
+        results = {}
+        for scheme in sorted(blobstore.BlobStore._STORES):
+            store = blobstore.open_store(scheme, Path(workdir) / scheme)
+            refs, runs = [], iter(range(repeat))
+
+            def write_all():
+                run = next(runs)
+                refs.clear()
+                for timestamp, color, depth in images:
+                    refs.append(store.put(f'42/{run}-{timestamp}/image_color.raw', color))
+                    refs.append(store.put(f'42/{run}-{timestamp}/image_depth.raw', depth))
+                store.sync(refs)
+
+            def read_all():
+                for ref in refs:
+                    bytes(store.get(ref))
+
+            results[f'{scheme}_write'] = measure(write_all, count, repeat)
+            results[f'{scheme}_read'] = measure(read_all, count, repeat)
+            store.close()
+        return results
+
+
+def write_results(path, results, **options):
+    """Writes benchmark results to a JSON file
+
+    Args:
+        path (str): Path of the written file
+        results (dict): Mapping of benchmark name to its results (see :func:`run_benchmark`)
+        **options: Options the benchmarks ran with, stored along the results
+    """
+    report = {'options': options,
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'results': results}
+    with open(path, 'w') as fd:
+        json.dump(report, fd, indent=2)
+
+
+def read_results(path):
+    """Reads benchmark results written by :func:`write_results`
+
+    Args:
+        path (str): Path of the results file
+
+    Returns:
+        dict: Mapping of benchmark name to its results
+    """
+    with open(path) as fd:
+        return json.load(fd)['results']
+
+
+def compare_results(baseline, results, threshold=0.1):
+    """Compares benchmark results against a baseline
+
+    A case regressed when its throughput dropped by more than ``threshold`` (a fraction of the baseline
+    throughput), cases missing from either side are ignored.
+
+    Args:
+        baseline (dict): Baseline results (see :func:`read_results`)
+        results (dict): Compared results
+        threshold (float, optional): Tolerated relative throughput drop
+
+    Returns:
+        list: (benchmark, case, baseline ops/sec, ops/sec, relative change, regressed) of every compared case,
+        sorted by name
+    """
+    comparison = []
+    for name in sorted(baseline.keys() & results.keys()):
+        for case in sorted(baseline[name].keys() & results[name].keys()):
+            before, after = baseline[name][case]['ops_per_sec'], results[name][case]['ops_per_sec']
+            change = after / before - 1
+            comparison.append((name, case, before, after, change, change < -threshold))
+    return comparison
+
+
+def run_benchmark(name, count=20, color_size=(1920, 1080), depth_size=(224, 172), repeat=3):
+    """Runs a registered benchmark on a synthetic sample
+
+    Args:
+        name (str): Benchmark name
+        count (int, optional): Number of snapshots in the synthetic sample
+        color_size (tuple, optional): (width, height) of the synthetic color images
+        depth_size (tuple, optional): (width, height) of the synthetic depth images
+        repeat (int, optional): Number of timed runs, the best one is reported
+
+    Returns:
+        dict: Mapping of case name to measurement dictionary
+    """
+    benchmark = Benchmark(name)
+    return benchmark(count=count, color_size=color_size, depth_size=depth_size, repeat=repeat)
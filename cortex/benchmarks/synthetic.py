@@ -0,0 +1,50 @@
+import gzip
+import struct
+import numpy as np
+
+from ..client.utils import cortex_pb2
+
+
+def write_sample(path, count=10, color_size=(1920, 1080), depth_size=(224, 172), uid=42, seed=0):
+    """Writes a synthetic gzipped protobuf sample file
+
+    The sample holds a single user followed by ``count`` snapshots with random pose, feelings and images
+    of the requested resolutions, one millisecond apart.
+
+    Args:
+        path (:obj:`str`): Path of the created sample file
+        count (:obj:`int`, optional): Number of snapshots
+        color_size (:obj:`tuple`, optional): (width, height) of the color images
+        depth_size (:obj:`tuple`, optional): (width, height) of the depth images
+        uid (:obj:`int`, optional): User ID of the sample user
+        seed (:obj:`int`, optional): Random seed
+    """
+    rng = np.random.default_rng(seed)
+    user = cortex_pb2.User(user_id=uid, username='Synthetic User', birthday=699746400, gender=0)
+
+    color_w, color_h = color_size
+    color_image = cortex_pb2.ColorImage(width=color_w, height=color_h,
+                                        data=rng.integers(0, 256, color_w * color_h * 3, dtype=np.uint8).tobytes())
+    depth_w, depth_h = depth_size
+    depth_image = cortex_pb2.DepthImage(width=depth_w, height=depth_h,
+                                        data=rng.random(depth_w * depth_h, dtype=np.float32).tolist())
+
+    with gzip.open(path, 'wb', compresslevel=1) as fd:
+        _write_message(fd, user)
+        for i in range(count):
+            translation, rotation, feelings = rng.random(3), rng.random(4), rng.random(4)
+            snapshot = cortex_pb2.Snapshot(datetime=1575446887339 + i)
+            snapshot.pose.translation.x, snapshot.pose.translation.y, snapshot.pose.translation.z = translation
+            (snapshot.pose.rotation.x, snapshot.pose.rotation.y,
+             snapshot.pose.rotation.z, snapshot.pose.rotation.w) = rotation
+            snapshot.color_image.CopyFrom(color_image)
+            snapshot.depth_image.CopyFrom(depth_image)
+            (snapshot.feelings.hunger, snapshot.feelings.thirst,
+             snapshot.feelings.exhaustion, snapshot.feelings.happiness) = feelings
+            _write_message(fd, snapshot)
+
+
+def _write_message(fd, message):
+    data = message.SerializeToString()
+    fd.write(struct.pack('<L', len(data)))
+    fd.write(data)
@@ -1 +1,2 @@
 from .client import Client, upload_sample
+from .bulk import upload_samples
@@ -1,5 +1,7 @@
 import click
+from .bulk import upload_samples, read_failures
 from .client import upload_sample
+from .reader import convert_sample
 from ..utils import strip_str
 
 
@@ -14,9 +16,59 @@ def cli():
 @click.option('--port', '-p', type=int, default=8000, show_default=True, help='Server port')
 @click.option('--sample-format', '-f', type=str, default='protobuf',
               show_default=True, help='Format of the uploaded sample', callback=strip_str)
+@click.option('--prefetch', type=int, default=4, show_default=True,
+              help='Number of snapshots decoded ahead while uploading (0 disables read-ahead)')
+@click.option('--concurrency', '-c', type=int, default=4, show_default=True, help='Number of uploads in flight')
+@click.option('--batch-size', '-b', type=int, default=16, show_default=True,
+              help='Snapshots per upload when the server supports batches (1 disables batching)')
+@click.option('--resume/--no-resume', default=True, show_default=True,
+              help='Skip the snapshots the server already accepted')
+@click.option('--wire-format', '-w', type=click.Choice(['frame', 'bson']), default='frame', show_default=True,
+              help='Preferred upload encoding, BSON is used when the server does not accept frames')
+@click.option('--max-retries', type=int, default=8, show_default=True,
+              help='Times an upload rejected by an overloaded server is sent again')
 @click.argument('sample_path', type=str, required=True, callback=strip_str)
-def _upload_sample(host, port, sample_format, sample_path):
-    upload_sample(host, port, sample_path, sample_format=sample_format)
+def _upload_sample(host, port, sample_format, prefetch, concurrency, batch_size, resume, wire_format, max_retries,
+                   sample_path):
+    upload_sample(host, port, sample_path, sample_format=sample_format, prefetch=prefetch, concurrency=concurrency,
+                  batch_size=batch_size, resume=resume, wire_format=wire_format, max_retries=max_retries)
+
+
+@cli.command(name='upload-samples')
+@click.option('--host', '-h', type=str, default='127.0.0.1', show_default=True, callback=strip_str,
+              help='Server IP address')
+@click.option('--port', '-p', type=int, default=8000, show_default=True, help='Server port')
+@click.option('--sample-format', '-f', type=str, default='protobuf',
+              show_default=True, help='Format of the uploaded samples', callback=strip_str)
+@click.option('--processes', '-j', type=int, default=None, help='Number of worker processes [default: CPU count]')
+@click.option('--concurrency', '-c', type=int, default=4, show_default=True,
+              help='Number of uploads in flight per sample')
+@click.option('--batch-size', '-b', type=int, default=16, show_default=True,
+              help='Snapshots per upload when the server supports batches (1 disables batching)')
+@click.option('--summary', '-s', type=str, default='upload-summary.json', show_default=True, callback=strip_str,
+              help='Path of the written run summary')
+@click.option('--retry', '-r', type=str, default='', callback=strip_str,
+              help='Re-upload the failed samples listed in a previous run summary')
+@click.argument('sources', type=str, nargs=-1)
+def _upload_samples(host, port, sample_format, processes, concurrency, batch_size, summary, retry, sources):
+    sources = [strip_str(None, None, source) for source in sources]
+    if retry:
+        sources += read_failures(retry)
+    return upload_samples(host, port, sources, sample_format=sample_format, processes=processes,
+                          concurrency=concurrency, batch_size=batch_size, summary_path=summary)
+
+
+@cli.command(name='convert-sample')
+@click.argument('sample_path', type=str, required=True, callback=strip_str)
+@click.argument('output_path', type=str, required=False, default='', callback=strip_str)
+def _convert_sample(sample_path, output_path):
+    try:
+        output_path = convert_sample(sample_path, output_path or None)
+        print(f'Converted {sample_path} to {output_path}, read it with --sample-format mmap')
+    except (IOError, ValueError) as e:
+        print(e)
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+import glob
+import json
+import multiprocessing
+import threading
+import time
+from pathlib import Path
+
+from .client import Client
+
+
+_SAMPLE_PATTERN = '*.mind.gz'
+_uploaded_counter = None
+
+
+def find_samples(sources):
+    """Expands sample sources into a sorted list of sample paths
+
+    Args:
+        sources (:obj:`list`): Sample files, directories (searched recursively for ``*.mind.gz`` files)
+            or glob patterns
+
+    Returns:
+        :obj:`list`: Sample paths
+    """
+    paths = set()
+    for source in sources:
+        source_path = Path(source)
+        if source_path.is_dir():
+            paths.update(str(path) for path in source_path.rglob(_SAMPLE_PATTERN))
+        elif glob.has_magic(source):
+            paths.update(path for path in glob.glob(source, recursive=True) if Path(path).is_file())
+        else:
+            paths.add(str(source_path))
+    return sorted(paths)
+
+
+def read_failures(summary_path):
+    """Reads the failed sample paths from a bulk upload summary (see :func:`upload_samples`)
+
+    Args:
+        summary_path (:obj:`str`): Path to the summary file
+
+    Returns:
+        :obj:`list`: Sample paths
+    """
+    with open(summary_path) as fd:
+        summary = json.load(fd)
+    return [failure['path'] for failure in summary['failures']]
+
+
+def _init_worker(counter):
+    global _uploaded_counter
+    _uploaded_counter = counter
+
+
+def _count_uploaded(count):
+    with _uploaded_counter.get_lock():
+        _uploaded_counter.value += count
+
+
+def _upload_file(job):
+    host, port, path, sample_format, concurrency, batch_size = job
+    start = time.perf_counter()
+    try:
+        client = Client(host, port, path, sample_format, concurrency=concurrency, batch_size=batch_size)
+        try:
+            uploaded = client.run(progress=_count_uploaded)
+        finally:
+            client.reader.close()
+        error = None
+    except Exception as e:
+        uploaded, error = None, f'{type(e).__name__}: {e}'
+    return {'path': path, 'uploaded': uploaded, 'seconds': time.perf_counter() - start, 'error': error}
+
+
+def _report_progress(counter, files, stop, interval):
+    start = time.perf_counter()
+    while not stop.wait(interval):
+        elapsed = time.perf_counter() - start
+        print(f'[{files["done"]}/{files["total"]} files] {counter.value} snapshots '
+              f'({counter.value / elapsed:.2f} snapshots/sec)')
+
+
+def upload_samples(host, port, sources, sample_format='protobuf', processes=None, concurrency=4, batch_size=16,
+                   summary_path='upload-summary.json', progress_interval=5):
+    """Uploads many sample files to the server using a pool of processes.
+
+    Each sample is uploaded by a single worker process with up to ``concurrency`` uploads in flight, the
+    aggregated progress is printed periodically. A JSON summary of the run is written to ``summary_path``,
+    its failed paths can be re-uploaded later (see :func:`read_failures`).
+
+    Args:
+        host (str): Hostname of the server
+        port (int): Port of the server
+        sources (list): Sample files, directories or glob patterns (see :func:`find_samples`)
+        sample_format (str, optional): Identifier for the sample format.
+            Note: Has to be supported by :class:`cortex.client.reader.Reader`
+        processes (int, optional): Number of worker processes, defaults to the number of CPUs
+        concurrency (int, optional): Maximal number of uploads in flight per sample
+        batch_size (int, optional): Maximal number of snapshots per upload when the server supports batches
+        summary_path (str, optional): Path of the written summary file
+        progress_interval (float, optional): Seconds between progress reports
+
+    Returns:
+        1 if any of the samples failed to upload, 0 otherwise.
+    """
+    paths = find_samples(sources)
+    counter = multiprocessing.Value('q', 0)
+    files = {'done': 0, 'total': len(paths)}
+    results = []
+    stop = threading.Event()
+    reporter = threading.Thread(target=_report_progress, args=(counter, files, stop, progress_interval), daemon=True)
+
+    start = time.perf_counter()
+    reporter.start()
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(counter,)) as pool:
+            jobs = [(host, port, path, sample_format, concurrency, batch_size) for path in paths]
+            for result in pool.imap_unordered(_upload_file, jobs):
+                files['done'] += 1
+                results.append(result)
+                if result['error'] is not None:
+                    print(f'ERROR: {result["path"]}: {result["error"]}')
+    finally:
+        stop.set()
+        reporter.join()
+    elapsed = time.perf_counter() - start
+
+    failures = [{'path': result['path'], 'error': result['error']} for result in results if result['error']]
+    uploaded = sum(result['uploaded'] for result in results if not result['error'])
+    summary = {'host': host,
+               'port': port,
+               'samples': len(paths),
+               'snapshots': uploaded,
+               'seconds': elapsed,
+               'failures': failures}
+    with open(summary_path, 'w') as fd:
+        json.dump(summary, fd, indent=2)
+
+    print(f'Uploaded {uploaded} snapshots from {len(paths) - len(failures)}/{len(paths)} samples in {elapsed:.2f}s '
+          f'({uploaded / elapsed if elapsed else 0:.2f} snapshots/sec), summary written to {summary_path}')
+    return 1 if failures else 0
@@ -1,4 +1,9 @@
+import itertools
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
+from requests.adapters import HTTPAdapter
 import bson
 from . import reader
 from ..net import protocol
@@ -10,11 +15,22 @@ class Client:
     By running the client, it will connect to the server, parse a sample file containing user info
     and snapshots, and finally upload the snapshots to the server.
 
+    All the requests go through a single pooled keep-alive session, so uploads running concurrently
+    (see :meth:`run`) reuse a bounded set of connections. When the server advertises batch uploads in its
+    configuration, snapshots are sent in batches of up to ``batch_size`` snapshots. When resuming, snapshots the
+    server reports as already accepted are skipped, so re-running an interrupted upload only sends the rest.
+    Uploads are encoded in the preferred wire format when the server accepts it, as BSON otherwise
+    (see :func:`cortex.net.protocol.encode_message`). Uploads the server rejects as overloaded (429 Too Many
+    Requests or 503 Service Unavailable) are sent again, up to ``max_retries`` times, after the delay the server
+    asks for in its Retry-After header or an exponentially growing one, whichever is longer. The delays are
+    jittered so clients rejected together don't come back together.
+
     Attributes:
         host (str): Hostname of the server
         port (int): Port of the server
         reader (:class:`cortex.client.reader.Reader`): Sample reader
         user (:class:`cortex.net.protocol.User`): Protocol User instance (holds the user information)
+        session (:class:`requests.Session`): Pooled HTTP session
 
     Args:
         host (str): Hostname of the server
@@ -22,24 +38,95 @@ class Client:
         sample (str): Path to the file containing user information and snapshots
         sample_format (str): Identifier for the sample format.
             Note: Has to be supported by :class:`cortex.client.reader.Reader`
+        prefetch (int, optional): Number of snapshots the reader decodes ahead while uploading, 0 disables it
+        concurrency (int, optional): Maximal number of uploads in flight (sizes the connection pool)
+        batch_size (int, optional): Maximal number of snapshots per upload when the server supports batches,
+            1 disables batching
+        resume (bool, optional): Skip the snapshots the server already accepted (when the server reports them)
+        wire_format (str, optional): Preferred wire format of the uploads, 'frame' or 'bson'
+        max_retries (int, optional): Maximal number of times an upload rejected as overloaded is sent again
+        retry_backoff (float, optional): Initial delay before sending a rejected upload again, in seconds
     """
-    def __init__(self, host, port, sample, sample_format):
+    _RETRY_STATUSES = (429, 503)
+    _MAX_RETRY_DELAY = 60
+
+    def __init__(self, host, port, sample, sample_format, prefetch=4, concurrency=4, batch_size=16, resume=True,
+                 wire_format='frame', max_retries=8, retry_backoff=0.5):
         self.host = host
         self.port = port
-        self.reader = reader.Reader(sample, sample_format)
+        self.reader = reader.Reader(sample, sample_format, prefetch=prefetch)
         self.user = self.reader.read_user()
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.resume = resume
+        self.wire_format = wire_format
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, pool_block=True))
 
-    def run(self):
+    def run(self, concurrency=None, progress=None):
         """Begins the sample uploading sequence.
 
-        Iterating over the sample and uploading its contained snapshots
+        Iterating over the sample and uploading its contained snapshots, keeping up to ``concurrency``
+        uploads in flight. The upload stops at the first failed snapshot and its error is raised.
+
+        Args:
+            concurrency (int, optional): Maximal number of uploads in flight, defaults to the client's concurrency
+            progress (callable, optional): Called with the number of snapshots of every completed upload
+
+        Returns:
+            int: Number of uploaded snapshots
         """
+        concurrency = concurrency or self.concurrency
         server_config = self._get_config()
+        # Fields the server doesn't parse would be dropped by to_bson, don't decode them at all
+        self.reader.select_fields(server_config.parsers)
+        if self.resume and server_config.progress:
+            accepted = self._get_progress()
+            if len(accepted) > 0:
+                self.reader.skip_snapshots(accepted)
+        batch_size = min(self.batch_size, server_config.max_batch_size)
+        wire_format = self.wire_format if self.wire_format in server_config.formats else 'bson'
+        upload = self._post_snapshots if batch_size > 1 else self._post_snapshot
+        uploaded = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            in_flight = set()
+            try:
+                for item in self._batches(batch_size) if batch_size > 1 else self.reader:
+                    if len(in_flight) >= concurrency:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        uploaded += self._check_uploads(done, progress)
+                    in_flight.add(executor.submit(upload, item, server_config.parsers, wire_format))
+                done, in_flight = wait(in_flight)
+                uploaded += self._check_uploads(done, progress)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+        return uploaded
+
+    def _batches(self, batch_size):
+        batch = []
         for snapshot in self.reader:
-            self._post_snapshot(snapshot, server_config.parsers)
+            batch.append(snapshot)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _check_uploads(done, progress=None):
+        uploaded = 0
+        for future in done:
+            result = future.result()
+            uploaded += len(result) if isinstance(result, list) else 1
+        if progress is not None:
+            progress(uploaded)
+        return uploaded
 
     def _get_config(self):
-        response = requests.get(f'http://{self.host}:{self.port}/config')
+        response = self.session.get(f'http://{self.host}:{self.port}/config')
         if hasattr(response, 'content'):
             content = response.content
         else:
@@ -48,22 +135,66 @@ class Client:
             config = protocol.Config.from_bson(bson.decode(content))
         else:
             raise ConnectionError(f'Unable to get server configuration:\n'
-                                  f'Status:{response.status_code} Message:{response.reason}')
+                                  f'Status:{response.status_code} Message:{_reason(response)}')
         return config
 
-    def _post_snapshot(self, snapshot, fields):
-        response = requests.post(f'http://{self.host}:{self.port}/snapshot',
-                                 headers={'Content-Type': 'application/bson'},
-                                 data=bson.encode({'user': self.user.to_bson(),
-                                                   'snapshot': snapshot.to_bson(fields=fields)}))
+    def _get_progress(self):
+        response = self.session.get(f'http://{self.host}:{self.port}/progress/{self.user.uid}')
+        content = response.content if hasattr(response, 'content') else response.data
+        if response.status_code != 200:
+            raise ConnectionError(f'Unable to get upload progress:\n'
+                                  f'Status:{response.status_code} Message:{_reason(response)}')
+        return protocol.Progress.from_bson(bson.decode(content)).timestamps
+
+    def _post(self, route, message, wire_format):
+        """Posts an upload, sending it again while the server rejects it as overloaded"""
+        data = protocol.encode_message(message, wire_format)
+        for attempt in itertools.count():
+            response = self.session.post(f'http://{self.host}:{self.port}{route}',
+                                         headers={'Content-Type': protocol.WIRE_FORMATS[wire_format]},
+                                         data=data)
+            if response.status_code not in self._RETRY_STATUSES or attempt >= self.max_retries:
+                return response
+            time.sleep(self._retry_delay(response, attempt))
+
+    def _retry_delay(self, response, attempt):
+        try:
+            retry_after = float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            # An HTTP date, fall back to the backoff
+            retry_after = 0
+        delay = min(max(retry_after, self.retry_backoff * 2 ** attempt), self._MAX_RETRY_DELAY)
+        # Jitter upwards, never coming back earlier than the server asked
+        return delay * (1 + random.random())
+
+    def _post_snapshot(self, snapshot, fields, wire_format='bson'):
+        raw = wire_format != 'bson'
+        message = {'user': self.user.to_bson(), 'snapshot': snapshot.to_bson(fields=fields, raw=raw)}
+        response = self._post('/snapshot', message, wire_format)
         if response.status_code != 200:
             raise ConnectionError(f'Unable to send snapshot to server:\n'
-                                  f'Status:{response.status_code} Message:{response.reason}')
+                                  f'Status:{response.status_code} Message:{_reason(response)}')
         return response.status_code
 
+    def _post_snapshots(self, snapshots, fields, wire_format='bson'):
+        raw = wire_format != 'bson'
+        message = {'user': self.user.to_bson(),
+                   'snapshots': [snapshot.to_bson(fields=fields, raw=raw) for snapshot in snapshots]}
+        response = self._post('/snapshots', message, wire_format)
+        if response.status_code != 200:
+            raise ConnectionError(f'Unable to send snapshots to server:\n'
+                                  f'Status:{response.status_code} Message:{_reason(response)}')
+        return snapshots
+
+
+def _reason(response):
+    # Flask test client responses only carry the full status line
+    return response.reason if hasattr(response, 'reason') else response.status
+
 
-def upload_sample(host, port, path, sample_format='protobuf'):
-    """ Uploads a sample file to the server.
+def upload_sample(host, port, path, sample_format='protobuf', prefetch=4, concurrency=4, batch_size=16,
+                  resume=True, wire_format='frame', max_retries=8):
+    """ Uploads a sample file to the server and reports the upload throughput.
 
     Args:
         host (str): Hostname of the server
@@ -71,13 +202,26 @@ def upload_sample(host, port, path, sample_format='protobuf'):
         path (str): Path to the file containing user information and snapshots
         sample_format (str, optional): Identifier for the sample format.
             Note: Has to be supported by :class:`cortex.client.reader.Reader`
+        prefetch (int, optional): Number of snapshots decoded ahead while uploading, 0 disables it
+        concurrency (int, optional): Maximal number of uploads in flight
+        batch_size (int, optional): Maximal number of snapshots per upload when the server supports batches
+        resume (bool, optional): Skip the snapshots the server already accepted
+        wire_format (str, optional): Preferred wire format of the uploads
+        max_retries (int, optional): Maximal number of times an upload rejected as overloaded is sent again
 
     Returns:
         1 if an IOError as occurred, 0 otherwise.
     """
     try:
-        client = Client(host, port, path, sample_format)
-        client.run()
+        client = Client(host, port, path, sample_format, prefetch=prefetch, concurrency=concurrency,
+                        batch_size=batch_size, resume=resume, wire_format=wire_format, max_retries=max_retries)
+        start = time.perf_counter()
+        try:
+            uploaded = client.run()
+        finally:
+            client.reader.close()
+        elapsed = time.perf_counter() - start
+        print(f'Uploaded {uploaded} snapshots in {elapsed:.2f}s ({uploaded / elapsed:.2f} snapshots/sec)')
     except IOError as e:
         print(f'ERROR: {e}')
         return 1
@@ -1,7 +1,14 @@
+import collections
+import mmap
+import os
+import shutil
+import queue
 import struct
+import threading
 import gzip
 import numpy as np
 import pytz
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 
@@ -20,28 +27,58 @@ class Reader:
     Initialized by a path to a mind sample file and parses the user information and snapshots it contains
     according to the file extension (assuming an appropriate parser for the extension exists).
 
+    Iterating over the reader streams the snapshots in order. Drivers supporting random access additionally
+    allow ``len(reader)``, ``reader[n]`` and ``reader[start:stop]`` (backed by a :class:`SampleIndex`)
+    and decoding ranges of the sample in parallel worker processes (see :meth:`iter_parallel`).
+
     Note:
         Extending the Reader's parsing capability:\n
         In order for the Reader to support new sample formats a new Driver class needs to be implemented
         and match the following requirements:
             Initialization
-                - Initialized by the path to the mind sample file.
+                - Initialized by the path to the mind sample file and optional driver specific keyword options.
             Registration
                 - Decorated by :meth:`register_driver` initialized with the appropriate extension.
             Interface
                 - read_user(): Reads the user information and returns a :class:`cortex.net.protocol.User` instance.
                 - read_snapshot(): Reads a snapshot and returns a :class:`cortex.net.protocol.Snapshot` instance.
+            Prefetch interface (optional)
+                - read_message(): Reads the next raw snapshot message, raises EOFError at the end.
+                - decode_snapshot(message): Decodes a raw snapshot message, has to be safe to call from any thread.
+                - message_timestamp(message): Returns the timestamp of a raw snapshot message without decoding it.
+            Random access interface (optional)
+                - tell(): Returns the current position in the (uncompressed) sample stream.
+                - seek(offset): Moves to a position previously returned by tell().
+                - skip_snapshot(): Moves past the next snapshot without decoding it and returns its timestamp,
+                  raises EOFError at the end.
+
+    When ``prefetch`` is set, snapshots are read ahead in the background (see :class:`Prefetcher`) so decoding
+    overlaps with whatever the caller does with the previous snapshot, the order of the snapshots is preserved.
 
     Args:
         path (:obj:`str`): Path to the sample file
         driver_type (:obj:`str`): Identifier for the appropriate format parser
+        prefetch (:obj:`int`, optional): Number of snapshots to decode ahead, 0 disables prefetching
+        prefetch_workers (:obj:`int`, optional): Number of decoding threads used when prefetching
+        **options: Keyword options passed on to the driver (e.g. ``fast`` for :class:`DriverProtobuf`)
     """
 
     _DRIVERS = {}
 
-    def __init__(self, path, driver_type):
+    def __init__(self, path, driver_type, prefetch=0, prefetch_workers=2, **options):
         self.path = Path(path)
-        self.driver = Reader._DRIVERS[driver_type](path)
+        self.driver_type = driver_type
+        self.options = options
+        self.driver = Reader._DRIVERS[driver_type](path, **options)
+        self.prefetch = prefetch
+        self.prefetch_workers = prefetch_workers
+        self._prefetcher = None
+        self._skipped = frozenset()
+        self._index = None
+        self._random_driver = None
+
+    def __del__(self):
+        self.close()
 
     def __iter__(self):
         return self
@@ -52,6 +89,21 @@ class Reader:
         except EOFError:
             raise StopIteration
 
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._read_range(start, stop - start)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('Snapshot index out of range')
+        return self._read_range(key, 1)[0]
+
     @staticmethod
     def register_driver(name):
         """A Decorator for registering driver classes.
@@ -64,6 +116,13 @@ class Reader:
             return driver
         return decorator
 
+    @property
+    def index(self):
+        """:class:`SampleIndex`: Snapshot offsets of the sample, loaded from (or built into) its sidecar file"""
+        if self._index is None:
+            self._index = SampleIndex.load_or_build(self.path, self._open_driver)
+        return self._index
+
     def read_user(self):
         """ Reads a user from the sample file.
 
@@ -81,11 +140,329 @@ class Reader:
         Returns:
             user (:class:`cortex.net.protocol.Snapshot`)
         """
-        ss = self.driver.read_snapshot()
+        if self.prefetch > 0:
+            if self._prefetcher is None:
+                self._prefetcher = Prefetcher(self.driver, self.prefetch, self.prefetch_workers, self._skipped)
+            ss = self._prefetcher.next()
+        else:
+            ss = _read_unskipped(self.driver, self._skipped)
         if not isinstance(ss, protocol.Snapshot):
             raise TypeError('Unsupported Snapshot class')
         return ss
 
+    def select_fields(self, fields):
+        """Restricts decoding to the given snapshot fields, the other fields are left out (None).
+
+        Fields are only skipped by drivers supporting it (a ``fields`` driver option), others keep decoding all
+        of them. Has to be called before the snapshots are read.
+
+        Args:
+            fields (iterable): Names of the snapshot fields to decode, None for all of them
+        """
+        fields = None if fields is None else frozenset(fields)
+        for driver in (self.driver, self._random_driver):
+            if driver is not None and hasattr(driver, 'fields'):
+                driver.fields = fields
+        if hasattr(self.driver, 'fields'):
+            self.options['fields'] = fields
+
+    def skip_snapshots(self, timestamps):
+        """Skips the snapshots with the given timestamps when reading the rest of the sample.
+
+        Drivers supporting random access jump straight to the first snapshot not skipped (using the
+        :class:`SampleIndex`), the remaining snapshots are skip-scanned: their timestamp is read without
+        decoding the rest of the message. Has to be called before the snapshots are read.
+
+        Args:
+            timestamps (iterable): Timestamp keys of the snapshots to skip (see
+                :func:`cortex.net.protocol.timestamp_key`)
+        """
+        self._skipped = frozenset(int(timestamp) for timestamp in timestamps)
+        if not self._skipped or not hasattr(self.driver, 'seek'):
+            return
+        skipped = np.isin(self.index.timestamps, np.fromiter(self._skipped, dtype=np.int64))
+        remaining = np.flatnonzero(~skipped)
+        self.driver.seek(self.index.offsets[remaining[0]] if len(remaining) else self.index.end)
+
+    def close(self):
+        """Stops the background prefetching, if running"""
+        if getattr(self, '_prefetcher', None) is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def iter_parallel(self, workers=None, chunk_size=None):
+        """Decodes the sample's snapshots in worker processes, yielding them in order.
+
+        The sample is split into ranges of ``chunk_size`` consecutive snapshots, each range is decoded by a
+        worker process which opens the sample on its own and seeks to the range. At most two ranges per
+        worker are in flight at a time so memory stays bounded.
+
+        Note:
+            Seeking in a gzip stream inflates everything before the seek target, so for gzipped samples the
+            gain comes from spreading the protobuf and image decoding across cores.
+
+        Args:
+            workers (:obj:`int`, optional): Number of worker processes (defaults to the number of CPUs)
+            chunk_size (:obj:`int`, optional): Snapshots per range (defaults to an even split between workers)
+
+        Yields:
+            :class:`cortex.net.protocol.Snapshot`
+        """
+        workers = workers or os.cpu_count() or 1
+        count = len(self)
+        chunk_size = chunk_size or max(1, -(-count // workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for start in range(0, count, chunk_size):
+                pending.append(executor.submit(_read_range_worker, str(self.path), self.driver_type, self.options,
+                                               self.index.offsets[start], min(chunk_size, count - start)))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _open_driver(self):
+        return Reader._DRIVERS[self.driver_type](self.path, **self.options)
+
+    def _read_range(self, start, count):
+        if count <= 0:
+            return []
+        # Random access uses its own driver so it doesn't disturb the position of the iteration
+        if self._random_driver is None:
+            self._random_driver = self._open_driver()
+        self._random_driver.seek(self.index.offsets[start])
+        return [self._random_driver.read_snapshot() for _ in range(count)]
+
+
+def _read_unskipped(driver, skipped):
+    if not skipped:
+        return driver.read_snapshot()
+    if hasattr(driver, 'message_timestamp'):
+        while True:
+            message = driver.read_message()
+            if protocol.timestamp_key(driver.message_timestamp(message)) not in skipped:
+                return driver.decode_snapshot(message)
+    while True:
+        snapshot = driver.read_snapshot()
+        if protocol.timestamp_key(snapshot.timestamp_ms) not in skipped:
+            return snapshot
+
+
+def _read_range_worker(path, driver_type, options, offset, count):
+    driver = Reader._DRIVERS[driver_type](path, **options)
+    driver.seek(offset)
+    return [driver.read_snapshot() for _ in range(count)]
+
+
+class Prefetcher:
+    """Read-ahead pipeline for a Reader driver
+
+    A background thread reads raw snapshot messages from the driver in order and hands them to a pool of
+    decoding threads, the pending results are kept in a FIFO queue of ``depth`` entries so at most ``depth``
+    snapshots (plus the one being read) are held in memory and :meth:`next` returns them in sample order.
+    Drivers without the prefetch interface (read_message/decode_snapshot) are read whole in the background.
+
+    Args:
+        driver: A Reader driver positioned at the first snapshot
+        depth (:obj:`int`): Maximal number of snapshots read ahead
+        workers (:obj:`int`, optional): Number of decoding threads
+        skipped (:obj:`frozenset`, optional): Timestamp keys of snapshots to skip (see :meth:`Reader.skip_snapshots`)
+    """
+    def __init__(self, driver, depth, workers=2, skipped=frozenset()):
+        self.driver = driver
+        self.skipped = skipped
+        self.queue = queue.Queue(maxsize=depth)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _read_ahead(self):
+        split = hasattr(self.driver, 'read_message') and hasattr(self.driver, 'decode_snapshot')
+        scan = split and self.skipped and hasattr(self.driver, 'message_timestamp')
+        try:
+            while not self.closed.is_set():
+                if scan:
+                    message = self.driver.read_message()
+                    if protocol.timestamp_key(self.driver.message_timestamp(message)) in self.skipped:
+                        continue
+                    result = self.executor.submit(self.driver.decode_snapshot, message)
+                elif split and not self.skipped:
+                    result = self.executor.submit(self.driver.decode_snapshot, self.driver.read_message())
+                else:
+                    result = Future()
+                    result.set_result(_read_unskipped(self.driver, self.skipped))
+                self._put(result)
+        except Exception as e:
+            # EOFError included, it is re-raised to the consumer in order
+            result = Future()
+            result.set_exception(e)
+            self._put(result)
+
+    def _put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def next(self):
+        """Returns the next snapshot in order
+
+        Raises:
+            EOFError: When the sample is exhausted
+        """
+        if self.closed.is_set():
+            raise EOFError()
+        try:
+            return self.queue.get().result()
+        except Exception:
+            # The read-ahead thread stops on the first error
+            self.close()
+            raise
+
+    def close(self):
+        """Stops reading ahead and releases the decoding threads"""
+        self.closed.set()
+        self.executor.shutdown(wait=False)
+
+
+class SampleIndex:
+    """Snapshot offset index of a sample file
+
+    Maps a snapshot number to the position of its message in the (uncompressed) sample stream and to its
+    timestamp key (see :func:`cortex.net.protocol.timestamp_key`).
+    The index is built once by skimming the sample with its driver and cached in a sidecar file next to the
+    sample (``<sample>.idx``), it is rebuilt whenever the sample size or modification time changes.
+
+    Args:
+        offsets (:obj:`numpy.ndarray`): uint64 array of snapshot offsets
+        timestamps (:obj:`numpy.ndarray`): int64 array of snapshot timestamp keys
+        end (:obj:`int`): Offset right after the last snapshot
+    """
+    _MAGIC = b'CTXIDX02'
+    _HEADER_FORMAT = '<8sQQQQ'
+
+    def __init__(self, offsets, timestamps, end):
+        self.offsets = offsets
+        self.timestamps = timestamps
+        self.end = end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @staticmethod
+    def sidecar_path(path):
+        path = Path(path)
+        return path.with_name(path.name + '.idx')
+
+    @staticmethod
+    def build(driver):
+        """Builds an index by skipping over all the snapshots of a freshly opened driver
+
+        Args:
+            driver: A Reader driver supporting the random access interface
+        Returns:
+            :class:`SampleIndex`: Sample index
+        """
+        driver.read_user()
+        offsets, timestamps = [], []
+        while True:
+            offset = driver.tell()
+            try:
+                timestamp = driver.skip_snapshot()
+            except EOFError:
+                break
+            offsets.append(offset)
+            timestamps.append(protocol.timestamp_key(timestamp))
+        return SampleIndex(np.array(offsets, dtype=np.uint64), np.array(timestamps, dtype=np.int64), offset)
+
+    @staticmethod
+    def load_or_build(path, driver_factory):
+        """Loads the sidecar index of a sample, building (and caching) it if it is missing or stale
+
+        Args:
+            path (:obj:`str`): Path to the sample file
+            driver_factory (callable): Returns a freshly opened driver for the sample
+        Returns:
+            :class:`SampleIndex`: Sample index
+        """
+        stat = os.stat(path)
+        sidecar = SampleIndex.sidecar_path(path)
+        header_size = struct.calcsize(SampleIndex._HEADER_FORMAT)
+        try:
+            data = sidecar.read_bytes()
+            magic, size, mtime_ns, count, end = struct.unpack_from(SampleIndex._HEADER_FORMAT, data)
+            if magic == SampleIndex._MAGIC and (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                return SampleIndex(np.frombuffer(data, dtype='<u8', count=count, offset=header_size),
+                                   np.frombuffer(data, dtype='<i8', count=count, offset=header_size + 8 * count),
+                                   end)
+        except (OSError, struct.error, ValueError):
+            pass
+
+        index = SampleIndex.build(driver_factory())
+        header = struct.pack(SampleIndex._HEADER_FORMAT, SampleIndex._MAGIC, stat.st_size, stat.st_mtime_ns,
+                             len(index), index.end)
+        try:
+            tmp_path = sidecar.with_name(sidecar.name + '.tmp')
+            tmp_path.write_bytes(header
+                                 + index.offsets.astype('<u8').tobytes()
+                                 + index.timestamps.astype('<i8').tobytes())
+            os.replace(tmp_path, sidecar)
+        except OSError:
+            # Read-only sample directories simply keep the index in memory
+            pass
+        return index
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf):
+    """Walks the top level fields of a serialized protobuf message without parsing it.
+
+    Length delimited fields are yielded as zero-copy slices of ``buf``, varints as integers and fixed
+    width fields as the raw slice.
+
+    Args:
+        buf (:obj:`memoryview`): Serialized message
+
+    Yields:
+        :obj:`tuple`: (field_number, wire_type, value)
+    """
+    pos, end = 0, len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos + length], pos + length
+        elif wire_type == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        elif wire_type == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type: {wire_type}')
+        yield number, wire_type, value
+
+
+def _to_local_datetime(timestamp_s):
+    return datetime.utcfromtimestamp(timestamp_s)\
+        .replace(tzinfo=pytz.utc)\
+        .astimezone(_LOCAL_TZ)\
+        .replace(tzinfo=None)
+
 
 @Reader.register_driver('protobuf')
 class DriverProtobuf:
@@ -93,17 +470,30 @@ class DriverProtobuf:
 
     A Driver for the :class:`Reader` class which supports the protobuf format gzipped.
 
+    By default snapshots are decoded in fast mode: the snapshot message is walked in place, the depth image
+    is viewed as a float32 buffer and the color image is kept as raw bytes, PIL images are only built when
+    accessed (see :class:`cortex.net.protocol.ImageColor`). The legacy mode parses the whole message with
+    the generated protobuf classes and converts both images to PIL eagerly.
+    In both modes, snapshot fields missing from ``fields`` are left out (None) without being decoded.
+
     Args:
         path (:obj:`str`): Path to the gzip file
+        fast (:obj:`bool`, optional): Use the fast decoding mode
+        fields (:obj:`set`, optional): Names of the snapshot fields to decode, all of them by default
     """
-    def __init__(self, path):
+    _FIELD_NUMBERS = {'pose': 2, 'image_color': 3, 'image_depth': 4, 'feelings': 5}
+
+    def __init__(self, path, fast=True, fields=None):
         self.fd = gzip.open(path, 'rb')
+        self.fast = fast
+        self.fields = fields
         self.msg_size_format = '<L'
         self.msg_size_length = struct.calcsize(self.msg_size_format)
         self.gender_enum = {0: 'm', 1: 'f', 2: 'o'}
 
     def __del__(self):
-        self.fd.close()
+        if hasattr(self, 'fd'):
+            self.fd.close()
 
     def _read(self, n):
         data = self.fd.read(n)
@@ -112,23 +502,65 @@ class DriverProtobuf:
         else:
             raise EOFError()
 
+    def read_message(self):
+        """Reads the next raw snapshot message
+
+        Returns:
+            :obj:`bytes`: Serialized protobuf Snapshot
+        """
+        msg_size, = struct.unpack(self.msg_size_format, self._read(self.msg_size_length))
+        message = self._read(msg_size)
+        if len(message) < msg_size:
+            # Truncated sample
+            raise EOFError()
+        return message
+
+    def tell(self):
+        """Returns the current position in the uncompressed sample stream"""
+        return self.fd.tell()
+
+    def seek(self, offset):
+        """Moves to a position in the uncompressed sample stream
+
+        Note:
+            Seeking in a gzip stream inflates the data in between (from the beginning when seeking backwards)
+        """
+        self.fd.seek(int(offset))
+
+    def skip_snapshot(self):
+        """Moves past the next snapshot without decoding it
+
+        Returns:
+            :obj:`datetime.datetime`: Timestamp of the skipped snapshot
+        """
+        return self.message_timestamp(self.read_message())
+
+    @staticmethod
+    def message_timestamp(message):
+        """Reads the timestamp of a serialized snapshot message without decoding the rest of it
+
+        Args:
+            message (:obj:`bytes`): Serialized protobuf Snapshot
+        Returns:
+            :obj:`datetime.datetime`: Snapshot timestamp
+        """
+        for number, _, value in _iter_fields(memoryview(message)):
+            if number == 1:
+                return _to_local_datetime(value / 1000)
+        return _to_local_datetime(0)
+
     def read_user(self):
         """Reads user information from the file
 
         Returns:
             protocol_user (:class:`cortex.net.protocol.User`)
         """
-        msg_size, = struct.unpack(self.msg_size_format, self._read(self.msg_size_length))
         user = cortex_pb2.User()
-        user.ParseFromString(self._read(msg_size))
+        user.ParseFromString(bytes(self.read_message()))
 
-        birthday = datetime.utcfromtimestamp(user.birthday)\
-            .replace(tzinfo=pytz.utc)\
-            .astimezone(_LOCAL_TZ)\
-            .replace(tzinfo=None)
         protocol_user = protocol.User(uid=user.user_id,
                                       name=user.username,
-                                      birthday=birthday,
+                                      birthday=_to_local_datetime(user.birthday),
                                       gender=self.gender_enum[user.gender])
         return protocol_user
 
@@ -138,19 +570,86 @@ class DriverProtobuf:
         Returns:
             protocol_snapshot (:class:`cortex.net.protocol.Snapshot`)
         """
-        msg_size, = struct.unpack(self.msg_size_format, self._read(self.msg_size_length))
+        return self.decode_snapshot(self.read_message())
+
+    def decode_snapshot(self, message):
+        """Decodes a single serialized snapshot message
+
+        Args:
+            message (:obj:`bytes`): Serialized protobuf Snapshot
+
+        Returns:
+            protocol_snapshot (:class:`cortex.net.protocol.Snapshot`)
+        """
+        if self.fast:
+            return self._decode_fast(message)
+        return self._decode_legacy(message)
+
+    def _selected(self, field):
+        return self.fields is None or field in self.fields
+
+    def _decode_fast(self, message):
+        snapshot = {'timestamp_ms': _to_local_datetime(0)}
+        numbers = {1} | {number for field, number in self._FIELD_NUMBERS.items() if self._selected(field)}
+        for number, _, value in _iter_fields(memoryview(message)):
+            if number not in numbers:
+                continue
+            if number == 1:
+                snapshot['timestamp_ms'] = _to_local_datetime(value / 1000)
+            elif number == 2:
+                snapshot['pose'] = self._decode_pose(cortex_pb2.Pose.FromString(bytes(value)))
+            elif number == 3:
+                snapshot['image_color'] = self._decode_image_color_fast(value)
+            elif number == 4:
+                snapshot['image_depth'] = self._decode_image_depth_fast(value)
+            elif number == 5:
+                snapshot['feelings'] = self._decode_feelings(cortex_pb2.Feelings.FromString(bytes(value)))
+        if 'pose' not in snapshot and self._selected('pose'):
+            snapshot['pose'] = self._decode_pose(cortex_pb2.Pose())
+        if 'feelings' not in snapshot and self._selected('feelings'):
+            snapshot['feelings'] = self._decode_feelings(cortex_pb2.Feelings())
+        return protocol.Snapshot(**snapshot)
+
+    @staticmethod
+    def _decode_image_color_fast(buf):
+        width = height = 0
+        data = b''
+        for number, _, value in _iter_fields(buf):
+            if number == 1:
+                width = value
+            elif number == 2:
+                height = value
+            elif number == 3:
+                data = value
+        if len(data) == 0:
+            return None
+        return protocol.ImageColor.from_buffer(data, width, height)
+
+    @staticmethod
+    def _decode_image_depth_fast(buf):
+        width = height = 0
+        chunks = []
+        for number, wire_type, value in _iter_fields(buf):
+            if number == 1:
+                width = value
+            elif number == 2:
+                height = value
+            elif number == 3:
+                # Packed (the proto3 default) arrives as one chunk, unpacked as one chunk per element
+                chunks.append(value)
+        if not chunks:
+            return None
+        data = chunks[0] if len(chunks) == 1 else b''.join(chunks)
+        # Keeps the legacy (width, height) row/column layout so the reported dimensions are unchanged
+        return protocol.ImageDepth.from_buffer(data, height, width)
+
+    def _decode_legacy(self, message):
         snapshot = cortex_pb2.Snapshot()
-        snapshot.ParseFromString(self._read(msg_size))
+        snapshot.ParseFromString(bytes(message))
 
-        pose = protocol.Pose(translation=(snapshot.pose.translation.x,
-                                          snapshot.pose.translation.y,
-                                          snapshot.pose.translation.z),
-                             rotation=(snapshot.pose.rotation.x,
-                                       snapshot.pose.rotation.y,
-                                       snapshot.pose.rotation.z,
-                                       snapshot.pose.rotation.w))
+        pose = self._decode_pose(snapshot.pose) if self._selected('pose') else None
 
-        if len(snapshot.color_image.data) == 0:
+        if len(snapshot.color_image.data) == 0 or not self._selected('image_color'):
             image_color = None
         else:
             image_color_arr = Image.frombytes('RGB',
@@ -158,27 +657,116 @@ class DriverProtobuf:
                                               snapshot.color_image.data)
             image_color = protocol.ImageColor(image_color_arr)
 
-        if len(snapshot.depth_image.data) == 0:
+        if len(snapshot.depth_image.data) == 0 or not self._selected('image_depth'):
             image_depth = None
         else:
-            image_depth_arr = np.array(snapshot.depth_image.data).reshape(snapshot.depth_image.width,
-                                                                          snapshot.depth_image.height)
+            image_depth_arr = np.array(snapshot.depth_image.data, dtype=np.float32)\
+                .reshape(snapshot.depth_image.width, snapshot.depth_image.height)
             image_depth = protocol.ImageDepth(Image.fromarray(image_depth_arr, 'F'))
 
-        feelings = protocol.Feelings(hunger=snapshot.feelings.hunger,
-                                     thirst=snapshot.feelings.thirst,
-                                     exhaustion=snapshot.feelings.exhaustion,
-                                     happiness=snapshot.feelings.happiness)
+        feelings = self._decode_feelings(snapshot.feelings) if self._selected('feelings') else None
 
-        timestamp_ms = datetime.utcfromtimestamp(snapshot.datetime/1000)\
-            .replace(tzinfo=pytz.utc)\
-            .astimezone(_LOCAL_TZ)\
-            .replace(tzinfo=None)
-        protocol_snapshot = protocol.Snapshot(timestamp_ms,
+        protocol_snapshot = protocol.Snapshot(_to_local_datetime(snapshot.datetime/1000),
                                               pose,
                                               image_color,
                                               image_depth,
                                               feelings)
         return protocol_snapshot
 
+    @staticmethod
+    def _decode_pose(pose):
+        return protocol.Pose(translation=(pose.translation.x,
+                                          pose.translation.y,
+                                          pose.translation.z),
+                             rotation=(pose.rotation.x,
+                                       pose.rotation.y,
+                                       pose.rotation.z,
+                                       pose.rotation.w))
+
+    @staticmethod
+    def _decode_feelings(feelings):
+        return protocol.Feelings(hunger=feelings.hunger,
+                                 thirst=feelings.thirst,
+                                 exhaustion=feelings.exhaustion,
+                                 happiness=feelings.happiness)
+
+
+@Reader.register_driver('mmap')
+class DriverMmap(DriverProtobuf):
+    """Memory mapped protobuf format reader
+
+    A Driver for the :class:`Reader` class which supports uncompressed protobuf samples (see
+    :func:`convert_sample`). The file is memory mapped and the length prefixed messages are walked in place,
+    every message is a zero-copy slice of the mapping so in fast mode the image payloads reach the
+    :class:`cortex.net.protocol.Snapshot` without being copied. Seeking is free, which makes random access
+    and :meth:`Reader.iter_parallel` cheap.
+
+    Decoding is shared with :class:`DriverProtobuf`, the options are the same.
+
+    Args:
+        path (:obj:`str`): Path to the uncompressed sample file
+        fast (:obj:`bool`, optional): Use the fast decoding mode
+        fields (:obj:`set`, optional): Names of the snapshot fields to decode, all of them by default
+    """
+    def __init__(self, path, fast=True, fields=None):
+        with open(path, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            # The mapping keeps its own handle, snapshots may hold slices of it after the driver is gone
+            self.buffer = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) if size else b'')
+        self.pos = 0
+        self.fast = fast
+        self.fields = fields
+        self.msg_size_format = '<L'
+        self.msg_size_length = struct.calcsize(self.msg_size_format)
+        self.gender_enum = {0: 'm', 1: 'f', 2: 'o'}
+
+    def _read(self, n):
+        if self.pos + n > len(self.buffer):
+            # Truncated sample
+            raise EOFError()
+        data = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def read_message(self):
+        """Reads the next raw snapshot message
+
+        Returns:
+            :obj:`memoryview`: Serialized protobuf Snapshot, a slice of the mapped file
+        """
+        msg_size, = struct.unpack(self.msg_size_format, self._read(self.msg_size_length))
+        return self._read(msg_size)
 
+    def tell(self):
+        """Returns the current position in the sample file"""
+        return self.pos
+
+    def seek(self, offset):
+        """Moves to a position in the sample file"""
+        self.pos = int(offset)
+
+
+def convert_sample(path, output=None):
+    """Converts a gzipped sample into an uncompressed sample readable by :class:`DriverMmap`
+
+    The sample is inflated in a single streaming pass into a temporary file which replaces ``output``
+    once complete.
+
+    Args:
+        path (:obj:`str`): Path to the gzipped sample file
+        output (:obj:`str`, optional): Path of the uncompressed sample, defaults to ``path`` without
+            its ``.gz`` suffix
+    Returns:
+        :obj:`pathlib.Path`: Path of the uncompressed sample
+    """
+    path = Path(path)
+    if output is None:
+        if path.suffix != '.gz':
+            raise ValueError(f'Cannot derive the output path of {path}, pass it explicitly')
+        output = path.with_suffix('')
+    output = Path(output)
+    tmp_path = output.with_name(output.name + '.tmp')
+    with gzip.open(path, 'rb') as src, tmp_path.open('wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(tmp_path, output)
+    return output
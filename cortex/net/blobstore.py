@@ -0,0 +1,430 @@
+import collections
+import mmap
+import os
+import secrets
+import threading
+from pathlib import Path, PurePosixPath
+from urllib.parse import parse_qsl, urlencode
+
+_OPEN_STORES = {}
+_OPEN_STORES_LOCK = threading.Lock()
+
+
+class BlobStore:
+    """Generic store of the binary blobs of the snapshots (raw and parsed images)
+
+    Blobs are written under a key, ``<uid>/<timestamp>/<name>``, and are referred to by the reference string the
+    store returns for them. References are what the messages and the database carry, they are self contained:
+    :func:`store_for` opens the store a reference belongs to from the reference alone, so the parsers and the API
+    read blobs written by the server without sharing its configuration.
+
+    Note:
+        Extending the supported stores:\n
+        A new store is a subclass of :class:`BlobStore` decorated by :meth:`BlobStore.register_store` with the
+        scheme its references start with (``<scheme>:...``) and implementing :meth:`create`, :meth:`get`,
+        :meth:`sync` and :meth:`parse_ref`.
+
+    Args:
+        root (:obj:`str`): Root folder of the store
+    """
+    _STORES = {}
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    @staticmethod
+    def register_store(scheme):
+        """A Decorator for registering blob store classes.
+
+        Args:
+            scheme (:obj:`str`): The name of the registered store, prefixes its references
+        """
+        def decorator(cls):
+            BlobStore._STORES[scheme] = cls
+            cls.scheme = scheme
+            return cls
+        return decorator
+
+    def create(self, key, length):
+        """Starts writing a blob of a known length, for data which arrives in chunks
+
+        Args:
+            key (:obj:`str`): Blob key
+            length (:obj:`int`): Blob length in bytes
+        Returns:
+            Blob handle with ``write(data)``, ``commit()`` (returns the blob reference) and ``abort()`` methods
+        """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """Writes a blob
+
+        Args:
+            key (:obj:`str`): Blob key
+            data (bytes-like): Blob data
+        Returns:
+            :obj:`str`: Blob reference
+        """
+        data = memoryview(data).cast('B')
+        blob = self.create(key, len(data))
+        try:
+            blob.write(data)
+        except BaseException:
+            blob.abort()
+            raise
+        return blob.commit()
+
+    def get(self, ref):
+        """Reads a blob
+
+        Args:
+            ref (:obj:`str`): Blob reference
+        Returns:
+            bytes-like: Blob data
+        """
+        raise NotImplementedError
+
+    def sync(self, refs=()):
+        """Blocks until the given blobs (and possibly others written before) are durable on disk
+
+        Args:
+            refs (:obj:`list`, optional): References of the blobs to sync
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the files held by the store"""
+
+    @classmethod
+    def parse_ref(cls, ref):
+        """Breaks down a reference of the store into the root of its store and its key
+
+        Args:
+            ref (:obj:`str`): Blob reference
+        Returns:
+            :obj:`tuple`: (root, key)
+        """
+        raise NotImplementedError
+
+
+@BlobStore.register_store('directory')
+class DirectoryStore(BlobStore):
+    """The legacy store, a file per blob at ``<root>/<key>`` referred to by its path
+
+    Plain paths (stored before blob stores were introduced) are read as references of this store.
+    """
+
+    def create(self, key, length):
+        return _FileBlob(self.root / key)
+
+    def get(self, ref):
+        return Path(ref).read_bytes()
+
+    def sync(self, refs=()):
+        paths = [Path(ref) for ref in refs]
+        for path in paths:
+            _fsync_path(path)
+        for folder in {path.parent for path in paths}:
+            _fsync_path(folder)
+
+    @classmethod
+    def parse_ref(cls, ref):
+        return '', ref
+
+
+@BlobStore.register_store('segment')
+class SegmentStore(BlobStore):
+    """Packs the blobs of each user into a few large segment files
+
+    Blobs are appended to the open segment of their user, ``<root>/<uid>/<writer>-<n>.seg``, which is replaced
+    by a new one once it reaches ``max_segment_size``. Every store instance writes its own segments (named
+    after its process and a random token), so several processes can share a root without coordinating.
+    Appending a blob only reserves its range under a lock, the data is written at its offset without holding
+    it, so concurrent writers don't wait on each other. Each committed blob is recorded in the segment's offset
+    index, ``<segment>.idx``, a line of ``<offset> <length> <key>`` per blob (see :meth:`index`); a reserved
+    range which was never committed isn't in it. References carry the segment path, offset and length, reads
+    go through a (cached) memory map of the segment and return a memoryview of it without copying.
+
+    Args:
+        root (:obj:`str`): Root folder of the store
+        max_segment_size (:obj:`int`, optional): Size in bytes from which a new segment is started
+        max_open_segments (:obj:`int`, optional): Maximal number of segments open for writing, the least
+            recently written is closed beyond it
+        max_maps (:obj:`int`, optional): Maximal number of memory maps cached for reading
+    """
+
+    def __init__(self, root, max_segment_size=256 << 20, max_open_segments=64, max_maps=256):
+        super().__init__(root)
+        self.max_segment_size = max_segment_size
+        self.max_open_segments = max_open_segments
+        self.max_maps = max_maps
+        self._writer = f'{os.getpid()}-{secrets.token_hex(4)}'
+        self._count = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._segments = collections.OrderedDict()
+        self._dirty = set()
+        self._new_folders = set()
+        self._maps = collections.OrderedDict()
+        self._maps_lock = threading.Lock()
+
+    def create(self, key, length):
+        user = PurePosixPath(key).parts[0]
+        retired = []
+        with self._lock:
+            segment = self._segments.get(user)
+            if segment is not None and segment.end and segment.end + length > self.max_segment_size:
+                retired.append(self._segments.pop(user))
+                segment = None
+            if segment is None:
+                segment = self._open_segment(user)
+                self._segments[user] = segment
+                while len(self._segments) > self.max_open_segments:
+                    retired.append(self._segments.popitem(last=False)[1])
+            self._segments.move_to_end(user)
+            offset = segment.end
+            segment.end += length
+            segment.pending += 1
+            for old in retired:
+                old.retired = True
+            retired = [old for old in retired if not old.pending]
+        self._close_segments(retired)
+        return _SegmentBlob(self, segment, key, offset, length)
+
+    def get(self, ref):
+        path, offset, length, _ = self._split_ref(ref)
+        if not length:
+            return memoryview(b'')
+        with self._maps_lock:
+            mapped = self._maps.get(path)
+            if mapped is None or len(mapped) < offset + length:
+                # The segment may have grown since it was mapped
+                with open(path, 'rb') as fd:
+                    mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[path] = mapped
+            self._maps.move_to_end(path)
+            while len(self._maps) > self.max_maps:
+                # Dropped maps are unmapped once the views returned from them are released
+                self._maps.popitem(last=False)
+        return memoryview(mapped)[offset:offset + length]
+
+    def sync(self, refs=()):
+        # Holding the sync lock until the files are synced makes a concurrent sync wait for this one, rather
+        # than return early on segments this one already took
+        with self._sync_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, set()
+                folders, self._new_folders = self._new_folders, set()
+            for segment in dirty:
+                if not segment.closed:
+                    os.fsync(segment.fd)
+                    os.fsync(segment.index_fd)
+            for folder in folders:
+                _fsync_path(folder)
+
+    def close(self):
+        with self._lock:
+            segments = list(self._segments.values())
+            self._segments.clear()
+        self._close_segments(segments)
+        with self._maps_lock:
+            self._maps.clear()
+
+    def index(self, segment_path):
+        """Reads the offset index of a segment
+
+        Args:
+            segment_path (:obj:`str`): Segment path
+        Returns:
+            :obj:`list`: (key, reference) pairs of the blobs committed to the segment, in writing order
+        """
+        entries = []
+        with open(f'{segment_path}.idx', 'r') as fd:
+            for line in fd:
+                offset, length, key = line.rstrip('\n').split(' ', 2)
+                entries.append((key, self._ref(segment_path, int(offset), int(length), key)))
+        return entries
+
+    def segments(self, uid):
+        """Returns the segment paths of a user"""
+        return sorted((self.root / str(uid)).glob('*.seg'))
+
+    @classmethod
+    def parse_ref(cls, ref):
+        path, _, _, key = cls._split_ref(ref)
+        return str(Path(path).parent.parent), key
+
+    @classmethod
+    def _ref(cls, path, offset, length, key):
+        return f'{cls.scheme}:{path}?{urlencode({"offset": offset, "length": length, "key": key})}'
+
+    @classmethod
+    def _split_ref(cls, ref):
+        path, _, query = ref[len(cls.scheme) + 1:].rpartition('?')
+        query = dict(parse_qsl(query))
+        return path, int(query['offset']), int(query['length']), query['key']
+
+    def _open_segment(self, user):
+        folder = self.root / user
+        if not folder.exists():
+            folder.mkdir(parents=True, exist_ok=True)
+            self._new_folders.update((folder, folder.parent))
+        path = folder / f'{self._writer}-{self._count:06d}.seg'
+        self._count += 1
+        self._new_folders.add(folder)
+        return _Segment(path, os.open(path, os.O_RDWR | os.O_CREAT, 0o644),
+                        os.open(f'{path}.idx', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644))
+
+    def _commit(self, segment, key, offset, length):
+        record = f'{offset} {length} {key}\n'.encode()
+        with self._lock:
+            os.write(segment.index_fd, record)
+            self._dirty.add(segment)
+            closed = self._release(segment)
+        self._close_segments(closed)
+        return self._ref(segment.path, offset, length, key)
+
+    def _abort(self, segment):
+        # The reserved range is left as a hole which isn't in the index
+        with self._lock:
+            closed = self._release(segment)
+        self._close_segments(closed)
+
+    @staticmethod
+    def _release(segment):
+        segment.pending -= 1
+        return [segment] if segment.retired and not segment.pending else []
+
+    def _close_segments(self, segments):
+        if segments:
+            with self._sync_lock:
+                for segment in segments:
+                    os.fsync(segment.fd)
+                    os.fsync(segment.index_fd)
+                    os.close(segment.fd)
+                    os.close(segment.index_fd)
+                    segment.closed = True
+
+
+class _Segment:
+    __slots__ = ('path', 'fd', 'index_fd', 'end', 'pending', 'retired', 'closed')
+
+    def __init__(self, path, fd, index_fd):
+        self.path = path
+        self.fd = fd
+        self.index_fd = index_fd
+        self.end = 0
+        self.pending = 0
+        self.retired = False
+        self.closed = False
+
+
+class _SegmentBlob:
+    def __init__(self, store, segment, key, offset, length):
+        self.store = store
+        self.segment = segment
+        self.key = key
+        self.offset = offset
+        self.length = length
+        self.written = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        if self.written + len(data) > self.length:
+            raise ValueError(f'Blob {self.key} exceeds its length of {self.length} bytes')
+        while data:
+            size = os.pwrite(self.segment.fd, data, self.offset + self.written)
+            self.written += size
+            data = data[size:]
+
+    def commit(self):
+        if self.written != self.length:
+            self.abort()
+            raise ValueError(f'Blob {self.key} got {self.written} of its {self.length} bytes')
+        return self.store._commit(self.segment, self.key, self.offset, self.length)
+
+    def abort(self):
+        self.store._abort(self.segment)
+
+
+class _FileBlob:
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.fd = path.open(mode='wb')
+
+    def write(self, data):
+        self.fd.write(data)
+
+    def commit(self):
+        self.fd.close()
+        return str(self.path)
+
+    def abort(self):
+        self.fd.close()
+        self.path.unlink()
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def open_store(scheme, root):
+    """Opens a blob store
+
+    Args:
+        scheme (:obj:`str`): Registered store name, 'directory' or 'segment'
+        root (:obj:`str`): Root folder of the store
+    Returns:
+        :class:`BlobStore`
+    """
+    try:
+        return BlobStore._STORES[scheme](root)
+    except KeyError as e:
+        raise KeyError(f'No blob store exists for scheme: {scheme}', e)
+
+
+def store_for(ref):
+    """Returns the (shared, per process) store a reference belongs to
+
+    Args:
+        ref (:obj:`str`): Blob reference
+    Returns:
+        :class:`BlobStore`
+    """
+    scheme = ref.partition(':')[0]
+    cls = BlobStore._STORES.get(scheme, DirectoryStore)
+    root, _ = cls.parse_ref(ref)
+    with _OPEN_STORES_LOCK:
+        if (cls.scheme, root) not in _OPEN_STORES:
+            _OPEN_STORES[cls.scheme, root] = cls(root)
+        return _OPEN_STORES[cls.scheme, root]
+
+
+def close_stores():
+    """Closes the stores shared by the process (see :func:`store_for`), later references open them again"""
+    with _OPEN_STORES_LOCK:
+        stores = list(_OPEN_STORES.values())
+        _OPEN_STORES.clear()
+    for store in stores:
+        store.close()
+
+
+def blob_key(ref):
+    """Returns the key of the blob a reference refers to"""
+    return BlobStore._STORES.get(ref.partition(':')[0], DirectoryStore).parse_ref(ref)[1]
+
+
+def read_blob(ref):
+    """Reads the blob a reference refers to
+
+    Args:
+        ref (:obj:`str`): Blob reference
+    Returns:
+        bytes-like: Blob data
+    """
+    return store_for(ref).get(ref)
@@ -1,4 +1,5 @@
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from .. import blobstore, protocol
 
 
 class SaverClient:
@@ -6,6 +7,10 @@ class SaverClient:
 
     A Client that saves data to MongoDB instances
 
+    Users are saved in the ``hivemind.users`` collection, and their snapshots in the ``hivemind.snapshots``
+    collection, a document per snapshot which holds the user ID, the timestamp and the parsed fields, under a
+    unique (uid, timestamp_ms) index.
+
     Args:
         host (:obj:`str`): Hostname of the MongoDB server
         port (:obj:`int`): Port of the MongoDB server
@@ -14,6 +19,9 @@ class SaverClient:
         self.client = MongoClient(host=host, port=port)
         self.db = self.client.hivemind
         self.users = self.db.users
+        self.snapshots = self.db.snapshots
+        self.users.create_index('uid', unique=True)
+        self.snapshots.create_index([('uid', ASCENDING), ('timestamp_ms', ASCENDING)], unique=True)
 
     def save(self, field, data):
         """Saves data (user info, snapshots) to the appropriate field
@@ -26,28 +34,75 @@ class SaverClient:
             field (:obj:`str`): Field name the data is related to
             data (:obj:`dict`): BSON dictionary of the data
         """
-        user = data['user'].copy()
-        user['snapshots'] = []
+        user = data['user']
         snapshot = data['snapshot']
 
         # Insert user in case it doesn't exist
         self.users.update_one({'uid': user['uid']}, {'$setOnInsert': user}, upsert=True)
 
-        # Insert snapshot in case it doesn't exist
-        result = self.users.update_one({'uid': user['uid'], 'snapshots.timestamp_ms': {'$ne': snapshot['timestamp_ms']}},
-                                       {'$push': {'snapshots': snapshot}})
+        # Insert snapshot in case it doesn't exist and set the field
+        self.snapshots.update_one({'uid': user['uid'], 'timestamp_ms': snapshot['timestamp_ms']},
+                                  {'$set': {field: snapshot[field]}}, upsert=True)
+
+    def save_batch(self, results):
+        """Saves a batch of parsed results (see :meth:`save`) with two unordered bulk writes
+
+        The fields of results of the same snapshot (user ID and timestamp) are merged, so a snapshot is written
+        once per batch whatever the number of its parsed fields: the users are upserted, then the snapshots.
+
+        Args:
+            results (:obj:`list`): (field, data) pairs, the field name and the BSON dictionary of its data
+        """
+        users, snapshots = {}, {}
+        for field, data in results:
+            uid, snapshot = data['user']['uid'], data['snapshot']
+            users.setdefault(uid, data['user'])
+            snapshots.setdefault((uid, snapshot['timestamp_ms']), {})[field] = snapshot[field]
+        if not users:
+            return
+
+        self.users.bulk_write([UpdateOne({'uid': uid}, {'$setOnInsert': user}, upsert=True)
+                               for uid, user in users.items()], ordered=False)
+        self.snapshots.bulk_write([UpdateOne({'uid': uid, 'timestamp_ms': timestamp}, {'$set': fields}, upsert=True)
+                                   for (uid, timestamp), fields in snapshots.items()], ordered=False)
+
+    def migrate(self, batch_size=1000):
+        """Moves the snapshots embedded in the user documents (the former layout) to the snapshots collection
 
-        # Update snapshot if it exists
-        if result.matched_count == 0:
-            self.users.update_one(
-                {'uid': user['uid'], 'snapshots.timestamp_ms': {'$eq': snapshot['timestamp_ms']}},
-                {'$set': {f'snapshots.$.{field}': snapshot[field]}})
+        The snapshots of a user are written in batches of ``batch_size`` upserts, then removed from the user
+        document. Snapshots are upserted, so the migration can be run again after it was interrupted.
+
+        Args:
+            batch_size (:obj:`int`, optional): Number of snapshots written per bulk write
+        Returns:
+            :obj:`int`: Number of snapshots moved
+        """
+        moved = 0
+        users = self.users.find({'snapshots': {'$exists': True}}, projection={'uid': True, 'snapshots': True},
+                                batch_size=1)
+        for user in users:
+            snapshots = user['snapshots']
+            for i in range(0, len(snapshots), batch_size):
+                requests = []
+                for snapshot in snapshots[i:i + batch_size]:
+                    snapshot = snapshot.copy()
+                    timestamp = snapshot.pop('timestamp_ms')
+                    requests.append(UpdateOne({'uid': user['uid'], 'timestamp_ms': timestamp},
+                                              {'$set': snapshot}, upsert=True))
+                if requests:
+                    self.snapshots.bulk_write(requests, ordered=False)
+            self.users.update_one({'_id': user['_id']}, {'$unset': {'snapshots': ''}})
+            moved += len(snapshots)
+            print(f'Moved {len(snapshots)} snapshots of user {user["uid"]}')
+        return moved
 
 
 class APIClient:
     """MongoDB API client
 
-    A Client exposes the MongoDB user-snapshot collection
+    A Client exposes the MongoDB users and snapshots collections (see :class:`SaverClient`). Snapshots are
+    addressed by their stable ID, the key of their timestamp (see :func:`cortex.net.protocol.timestamp_key`):
+    snapshots of a user have distinct timestamps, so the ID doesn't change as snapshots are added.
 
     Args:
         host (:obj:`str`): Hostname of the MongoDB server
@@ -58,6 +113,7 @@ class APIClient:
         self.client = MongoClient(host=host, port=port)
         self.db = self.client.hivemind
         self.users = self.db.users
+        self.snapshots = self.db.snapshots
 
     def get_users(self):
         """Returns a list of <id,name> of all the users in the DB
@@ -84,7 +140,7 @@ class APIClient:
         return user
 
     def get_user_snapshots(self, user_id):
-        """Returns a list of the specified user snapshots information
+        """Returns a list of the specified user snapshots information, ordered by time
 
         The information includes: snapshot id, timestamp
 
@@ -93,11 +149,11 @@ class APIClient:
         Returns:
             :obj:`list`: List of user snapshots {'id': val, 'datetime': val}
         """
-        result = self.users.aggregate([{'$match': {'uid': user_id}},
-                                       {'$project': {'_id': False, 'datetime': {'$map': {'input': '$snapshots', 'as': 's', 'in': '$$s.timestamp_ms'}}}}
-                                       ])
-        ss_date = result.next()
-        snapshots = [{'id': i, 'datetime': date} for i, date in enumerate(ss_date['datetime'])]
+        result = self.snapshots.find(filter={'uid': user_id},
+                                     projection={'_id': False, 'timestamp_ms': True},
+                                     sort=[('timestamp_ms', ASCENDING)])
+        snapshots = [{'id': protocol.timestamp_key(snapshot['timestamp_ms']),
+                      'datetime': snapshot['timestamp_ms']} for snapshot in result]
         return snapshots
 
     def get_user_snapshot(self, user_id, ss_id):
@@ -109,12 +165,12 @@ class APIClient:
             user_id (:obj:`int`): id of the requested user
             ss_id (:obj:`int`): id of the requested snapshot
         Returns:
-            :obj:`dict`: Snapshot dictionary
+            :obj:`dict`: Snapshot dictionary, None if the user has no such snapshot
         """
-        result = self.users.aggregate([{'$match': {'uid': user_id}},
-                                       {'$project': {'_id': False, 'snapshot': {'$arrayElemAt': ['$snapshots', ss_id]}}}
-                                       ])
-        snapshot = result.next()['snapshot']
+        snapshot = self.snapshots.find_one(filter={'uid': user_id, 'timestamp_ms': protocol.timestamp_from_key(ss_id)},
+                                           projection={'_id': False, 'uid': False})
+        if snapshot is None:
+            return None
         snapshot_details = {'ss_id': ss_id,
                             'datetime': snapshot.pop('timestamp_ms'),
                             'fields': list(snapshot.keys())}
@@ -128,18 +184,25 @@ class APIClient:
             ss_id (:obj:`int`): id of the requested snapshot
             field (:obj:`str`): name of the requested field
         Returns:
-            :obj:`dict`: Snapshot field result
+            :obj:`dict`: Snapshot field result, None if the user has no such snapshot or it has no such field
         """
-        result = self.users.aggregate([{'$match': {'uid': user_id}},
-                                       {'$project': {'_id': False, 'snapshot': {'$arrayElemAt': ['$snapshots', ss_id]}}},
-                                       {'$project': {'field': f'$snapshot.{field}'}}
-                                       ])
-        result = result.next()['field']
-        return result
+        snapshot = self.snapshots.find_one(filter={'uid': user_id, 'timestamp_ms': protocol.timestamp_from_key(ss_id)},
+                                           projection={'_id': False, field: True})
+        if snapshot is None:
+            return None
+        return snapshot.get(field)
 
     def get_user_snapshot_field_data(self, user_id, ss_id, field):
-        result = self.get_user_snapshot_field(user_id, ss_id, field)
-        with open(result[field], 'rb') as fd:
-            data = fd.read()
-        return data
+        """Returns the binary data of a snapshot field (parsed images), read from the blob store it is in
 
+        Args:
+            user_id (:obj:`int`): id of the requested user
+            ss_id (:obj:`int`): id of the requested snapshot
+            field (:obj:`str`): name of the requested field
+        Returns:
+            :obj:`bytes`: Field data, None if the user has no such snapshot or it has no such field
+        """
+        result = self.get_user_snapshot_field(user_id, ss_id, field)
+        if result is None:
+            return None
+        return bytes(blobstore.read_blob(result[field]))
@@ -0,0 +1,335 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+import bson
+from concurrent.futures.process import BrokenProcessPool
+from ..protocol import Snapshot
+
+_BROKERS = {}
+_BROKERS_LOCK = threading.Lock()
+
+
+def get_broker(name=''):
+    """Returns the in-process broker of the given name, created on first use
+
+    The host of a ``local://<name>`` URL names the broker, so clients of the same process given the same URL
+    exchange messages, and clients given different names are isolated.
+
+    Args:
+        name (:obj:`str`, optional): Broker name
+    Returns:
+        :class:`Broker`
+    """
+    with _BROKERS_LOCK:
+        if name not in _BROKERS:
+            _BROKERS[name] = Broker()
+        return _BROKERS[name]
+
+
+class MessageQueue:
+    """Unbounded queue of (routing key, body) messages, consumed in batches
+
+    Consumers report the messages they are done with (:meth:`task_done`, the counterpart of an acknowledgement),
+    so :meth:`join` can wait until every queued message was handled.
+    """
+    def __init__(self):
+        self.messages = collections.deque()
+        self.unfinished = 0
+        self.condition = threading.Condition()
+
+    def qsize(self):
+        """Returns the number of messages waiting in the queue"""
+        return len(self.messages)
+
+    def put(self, routing_key, body):
+        """Queues a message"""
+        with self.condition:
+            self.messages.append((routing_key, body))
+            self.unfinished += 1
+            self.condition.notify()
+
+    def get_batch(self, size, timeout):
+        """Takes up to ``size`` messages, waiting up to ``timeout`` seconds for them to arrive
+
+        Returns:
+            :obj:`list`: (routing key, body) pairs, empty when no message arrived in time
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while len(self.messages) < size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.messages.popleft() for _ in range(min(size, len(self.messages)))]
+
+    def task_done(self, count=1):
+        """Reports that ``count`` messages taken from the queue were handled"""
+        with self.condition:
+            self.unfinished -= count
+            if not self.unfinished:
+                self.condition.notify_all()
+
+    def join(self, timeout=None):
+        """Waits until every queued message was handled
+
+        Returns:
+            :obj:`bool`: False when the timeout expired first
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.unfinished, timeout)
+
+
+class Broker:
+    """In-process message broker, routing messages published to exchanges into queues
+
+    Queues are bound to exchanges with routing key patterns following the RabbitMQ topic exchange semantics: keys
+    are words separated by dots, ``*`` matches a single word and ``#`` any number of words. A pattern without
+    wildcards matches its key only, as a direct exchange binding does. A message is queued once in every queue
+    bound with a matching pattern, and messages which match no binding are dropped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.bindings = collections.defaultdict(list)
+        self.routes = {}
+
+    def queue(self, name):
+        """Returns the queue of the given name, declared on first use"""
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = MessageQueue()
+            return self.queues[name]
+
+    def bind(self, exchange, queue_name, routing_key):
+        """Binds a queue to an exchange with a routing key pattern"""
+        queue = self.queue(queue_name)
+        with self.lock:
+            self.bindings[exchange].append((routing_key.split('.'), queue))
+            self.routes.clear()
+
+    def publish(self, exchange, routing_key, body):
+        """Queues a message in the queues bound to the exchange with a matching pattern"""
+        with self.lock:
+            try:
+                queues = self.routes[exchange, routing_key]
+            except KeyError:
+                words = routing_key.split('.')
+                queues = self.routes[exchange, routing_key] = list(dict.fromkeys(
+                    queue for pattern, queue in self.bindings[exchange] if _matches(pattern, words)))
+        for queue in queues:
+            queue.put(routing_key, body)
+
+    def depth(self, names):
+        """Returns the number of messages waiting in the most backed up of the given queues"""
+        return max((self.queue(name).qsize() for name in names), default=0)
+
+
+def _matches(pattern, words):
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == '#':
+        return any(_matches(rest, words[i:]) for i in range(len(words) + 1))
+    return bool(words) and head in ('*', words[0]) and _matches(rest, words[1:])
+
+
+class SnapshotClient:
+    """In-process Snapshot client
+
+    Used by the main server to communicate Snapshots to the Parsers and the Savers running in the same process,
+    with the routing of :class:`cortex.net.mq.rabbitmq.SnapshotClient` and no broker to go through.
+
+    Args:
+        host (:obj:`str`): Name of the in-process broker (see :func:`get_broker`)
+        port (:obj:`int`): Unused
+        **config: Server configuration, uses PARSERS
+    """
+    def __init__(self, host, port, **config):
+        self.parsers = config['PARSERS']
+        self.broker = get_broker(host)
+
+    def close(self):
+        """Nothing to flush, messages are queued as they are published"""
+
+    def queue_depth(self):
+        """Returns the depth of the most backed up parser (or saver) queue"""
+        return self.broker.depth([*self.parsers, 'save'])
+
+    def publish(self, message):
+        """Publishes a message to the queue
+
+        Args:
+            message (:obj:`str`): Message to publish
+        """
+        # Intersect between the snapshot fields and the supported parsers
+        exist_supported_fields = message['snapshot'].keys() & set(self.parsers)
+        self.broker.publish('snapshots', '.'.join(exist_supported_fields), bson.encode(message))
+
+    def publish_batch(self, messages):
+        """Publishes a list of messages to the queue, in order
+
+        Args:
+            messages (:obj:`list`): Messages to publish
+        """
+        for message in messages:
+            self.publish(message)
+
+
+class ParserClient:
+    """In-process Parser client
+
+    Envelopes a :class:`cortex.parsers.parser.Parser` like :class:`cortex.net.mq.rabbitmq.ParserClient`: batches
+    of up to ``batch_size`` consumed messages are parsed by a pool of ``workers`` processes (or threads), with at
+    most ``prefetch`` messages handed to the pool at a time, and the results are published by the consuming
+    thread. Messages which fail to parse are dropped.
+
+    Args:
+        host (:obj:`str`): Name of the in-process broker (see :func:`get_broker`)
+        port (:obj:`int`): Unused
+        parser (:class:`cortex.parsers.parser.Parser`): A Snapshot parser
+        workers (:obj:`int`, optional): Number of parsing workers
+        prefetch (:obj:`int`, optional): Maximal number of messages being parsed, defaults to twice the messages
+            the workers take at once
+        pool (:obj:`str`, optional): 'process' parses in worker processes, 'thread' in threads
+        batch_size (:obj:`int`, optional): Maximal number of messages parsed together
+        batch_timeout (:obj:`float`, optional): Seconds to wait for a batch to fill up before parsing it
+    """
+    def __init__(self, host, port, parser, workers=1, prefetch=None, pool='process', batch_size=1,
+                 batch_timeout=0.05):
+        self.parser = parser
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.prefetch = prefetch or 2 * workers * batch_size
+        if pool == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        elif pool == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise KeyError(f'Unsupported worker pool: {pool}')
+        self.broker = get_broker(host)
+        self.queue = self.broker.queue(self.parser.field)
+        self.broker.bind('snapshots', self.parser.field, f'#.{self.parser.field}.#')
+        self.parsed = queue.Queue()
+        self.in_flight = 0
+        self._closed = threading.Event()
+
+    def close(self):
+        """Stops consuming once the batches being parsed are published"""
+        self._closed.set()
+
+    def consume(self):
+        """Start consuming from the message queue, until :meth:`close` is called
+
+        Raises:
+            :class:`concurrent.futures.process.BrokenProcessPool`: A worker process died, the consumer stopped
+        """
+        try:
+            while not self._closed.is_set():
+                self._publish_parsed(wait=self.in_flight >= self.prefetch)
+                if self.in_flight < self.prefetch:
+                    batch = self.queue.get_batch(min(self.batch_size, self.prefetch - self.in_flight),
+                                                 self.batch_timeout)
+                    if batch:
+                        future = self.executor.submit(self.parser.parse_batch, [body for _, body in batch])
+                        future.add_done_callback(lambda done, count=len(batch): self.parsed.put((count, done)))
+                        self.in_flight += len(batch)
+        finally:
+            self.executor.shutdown(wait=True)
+            while self.in_flight:
+                self._publish_parsed(wait=True)
+
+    def _publish_parsed(self, wait):
+        # Publishes the parsed batches, waiting for one when asked to
+        parsed = []
+        try:
+            parsed.append(self.parsed.get(timeout=self.batch_timeout) if wait else self.parsed.get_nowait())
+            while True:
+                parsed.append(self.parsed.get_nowait())
+        except queue.Empty:
+            pass
+        for count, future in parsed:
+            self.in_flight -= count
+            try:
+                results = future.result()
+            except BrokenProcessPool:
+                self.queue.task_done(count)
+                raise
+            except Exception as e:
+                results = [e] * count
+            for result in results:
+                if isinstance(result, Exception):
+                    print(result)
+                else:
+                    self.broker.publish('parsed_data', self.parser.field, result)
+            self.queue.task_done(count)
+
+
+class SaverClient:
+    """In-process Saver client
+
+    Envelopes a Database SaverClient from :mod:`cortex.net.db` and saves consumed Snapshots in batches of up to
+    ``batch_size`` messages, like :class:`cortex.net.mq.rabbitmq.SaverClient`. When a batch fails to save its
+    messages are saved one at a time, those which fail are retried together and dropped after ``retries``
+    attempts.
+
+    Args:
+        host (:obj:`str`): Name of the in-process broker (see :func:`get_broker`)
+        port (:obj:`int`): Unused
+        db_client: A Database SaverClient from :mod:`cortex.net.db`
+        batch_size (:obj:`int`, optional): Maximal number of messages saved together
+        batch_timeout (:obj:`float`, optional): Seconds to wait for a batch to fill up before saving it
+        retries (:obj:`int`, optional): Attempts to save a batch
+        retry_delay (:obj:`float`, optional): Initial delay between attempts, doubled after every attempt
+    """
+    def __init__(self, host, port, db_client, batch_size=1, batch_timeout=0.5, retries=5, retry_delay=0.5):
+        self.db_client = db_client
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.broker = get_broker(host)
+        self.queue = self.broker.queue('save')
+        for field in Snapshot.fields.keys():
+            self.broker.bind('parsed_data', 'save', field)
+        self._closed = threading.Event()
+
+    def close(self):
+        """Stops consuming once the current batch is saved"""
+        self._closed.set()
+
+    def consume(self):
+        """Start consuming from the message queue, until :meth:`close` is called
+        """
+        while not self._closed.is_set():
+            batch = self.queue.get_batch(self.batch_size, self.batch_timeout)
+            if batch:
+                self._save(batch)
+                self.queue.task_done(len(batch))
+
+    def _save(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.retries):
+            try:
+                self.db_client.save_batch(batch)
+                return
+            except Exception as e:
+                print(e)
+            # Only the messages which can't be saved on their own are retried
+            batch = [(field, body) for field, body in batch if not self._save_one(field, body)]
+            if not batch:
+                return
+            if attempt + 1 < self.retries:
+                time.sleep(delay)
+                delay *= 2
+        print(f'Dropping {len(batch)} messages after {self.retries} failed attempts to save them')
+
+    def _save_one(self, field, body):
+        try:
+            self.db_client.save(field, body)
+            return True
+        except Exception as e:
+            print(e)
+            return False
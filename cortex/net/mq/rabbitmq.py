@@ -1,42 +1,254 @@
+import concurrent.futures
+import queue
+import threading
+import time
 import pika
 import bson
+from concurrent.futures.process import BrokenProcessPool
+from .. import blobstore
 from ..protocol import Snapshot
 
 
+class Publisher:
+    """Thread-safe RabbitMQ publisher
+
+    A pika connection may only be used by the thread that created it, so the publisher owns its connection in a
+    dedicated I/O thread and any number of threads hand it messages through a bounded queue (:meth:`publish`
+    waits up to ``put_timeout`` seconds while the queue is full, then fails the message, so callers aren't stuck
+    while the broker is unreachable). The I/O thread drains up to ``batch_size`` queued messages at a time and
+    publishes them in order. With ``confirms`` the channel is put in confirm mode and every message is
+    acknowledged by the broker before the next one is sent.
+    :meth:`publish` returns a future completed once the message was published (and acknowledged, with
+    ``confirms``), only then may the caller consider it delivered. Messages dropped on shutdown fail their future.
+    When the connection is lost (or the broker rejects a message) the publisher reconnects with an exponential
+    backoff and publishes the unacknowledged messages again, so delivery is at-least-once.
+    The I/O thread also polls the number of messages waiting in the ``watch_queues`` every ``depth_interval``
+    seconds, the largest is kept in :attr:`queue_depth`.
+
+    Attributes:
+        queue_depth (:obj:`int`): Largest number of messages waiting in a watched queue, as last polled
+
+    Args:
+        host (:obj:`str`): Hostname of the RabbitMQ server
+        port (:obj:`int`): Port of the RabbitMQ server
+        exchange (:obj:`str`): Exchange to publish to
+        exchange_type (:obj:`str`, optional): Type the exchange is declared with
+        confirms (:obj:`bool`, optional): Wait for publisher confirms
+        max_queue (:obj:`int`, optional): Maximal number of queued messages
+        put_timeout (:obj:`float`, optional): Seconds :meth:`publish` waits for room in a full queue
+        batch_size (:obj:`int`, optional): Maximal number of messages published per wake-up of the I/O thread
+        reconnect_delay (:obj:`float`, optional): Initial delay between reconnection attempts, in seconds
+        watch_queues (:obj:`list`, optional): Names of the queues whose depth is polled
+        depth_interval (:obj:`float`, optional): Seconds between polls of the queue depths
+    """
+    _STOP = object()
+    _MAX_RECONNECT_DELAY = 30
+
+    def __init__(self, host, port, exchange, exchange_type='topic', confirms=False, max_queue=1024, put_timeout=1.0,
+                 batch_size=64, reconnect_delay=0.5, watch_queues=(), depth_interval=1.0):
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.confirms = confirms
+        self.put_timeout = put_timeout
+        self.batch_size = batch_size
+        self.reconnect_delay = reconnect_delay
+        self.watch_queues = list(watch_queues)
+        self.depth_interval = depth_interval
+        self.queue_depth = 0
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._connection = self._channel = None
+        self._thread = threading.Thread(target=self._run, name=f'publisher-{exchange}', daemon=True)
+        self._thread.start()
+
+    def publish(self, routing_key, body):
+        """Queues a message for publishing, waits up to ``put_timeout`` seconds while the queue is full
+
+        Args:
+            routing_key (:obj:`str`): Routing key of the message
+            body (:obj:`bytes`): Message body
+        Returns:
+            :class:`concurrent.futures.Future`: Completed once the message was published, fails with a
+            :class:`ConnectionError` if it was dropped or the queue stayed full
+        """
+        if self._closed:
+            raise RuntimeError('Publisher is closed')
+        future = concurrent.futures.Future()
+        try:
+            self.queue.put((routing_key, body, future), timeout=self.put_timeout)
+        except queue.Full:
+            future.set_exception(ConnectionError(f'The publisher queue of {self.exchange} is full'))
+        return future
+
+    def flush(self):
+        """Blocks until every queued message was published"""
+        self.queue.join()
+
+    def close(self):
+        """Publishes the queued messages, then closes the connection and stops the I/O thread"""
+        if not self._closed:
+            self._closed = True
+            self.queue.put(self._STOP)
+            self._thread.join()
+
+    def _connect(self):
+        self._disconnect()
+        self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host, port=self.port,
+                                                                             heartbeat=0))
+        self._open_channel()
+
+    def _open_channel(self):
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=self.exchange, exchange_type=self.exchange_type)
+        if self.confirms:
+            self._channel.confirm_delivery()
+
+    def _disconnect(self):
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except (pika.exceptions.AMQPError, OSError):
+                pass
+        self._connection = self._channel = None
+
+    def _next_batch(self, timeout=None):
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, messages):
+        sent, delay = 0, self.reconnect_delay
+        while sent < len(messages):
+            try:
+                if self._channel is None or not self._channel.is_open:
+                    self._connect()
+                for routing_key, body, future in messages[sent:]:
+                    self._channel.basic_publish(exchange=self.exchange, routing_key=routing_key, body=body)
+                    sent += 1
+                    future.set_result(None)
+            except (pika.exceptions.AMQPError, OSError) as e:
+                print(f'Publishing to {self.exchange} failed, reconnecting in {delay}s:')
+                print(repr(e))
+                self._disconnect()
+                if self._closed and delay > self.reconnect_delay:
+                    print(f'Dropping {len(messages) - sent} messages on shutdown')
+                    _drop(messages[sent:])
+                    return
+                time.sleep(delay)
+                delay = min(2 * delay, self._MAX_RECONNECT_DELAY)
+
+    def _poll_depth(self):
+        depths = []
+        try:
+            if self._channel is None or not self._channel.is_open:
+                self._connect()
+            for name in self.watch_queues:
+                try:
+                    depths.append(self._channel.queue_declare(queue=name, passive=True).method.message_count)
+                except pika.exceptions.ChannelClosedByBroker:
+                    # The queue wasn't declared by its consumer yet, which closes the channel
+                    self._open_channel()
+            self.queue_depth = max(depths, default=0)
+        except (pika.exceptions.AMQPError, OSError):
+            # Keep the last known depth, publishing reports the connection errors
+            self._disconnect()
+
+    def _run(self):
+        stopped = False
+        next_poll = time.monotonic()
+        while not stopped:
+            if self.watch_queues and time.monotonic() >= next_poll:
+                self._poll_depth()
+                next_poll = time.monotonic() + self.depth_interval
+            batch = self._next_batch(timeout=max(0, next_poll - time.monotonic()) if self.watch_queues else None)
+            if not batch:
+                continue
+            stopped = batch[-1] is self._STOP
+            self._send(batch[:-1] if stopped else batch)
+            for _ in batch:
+                self.queue.task_done()
+        self._disconnect()
+        # Messages queued by threads which raced with close() are never published
+        while True:
+            try:
+                _drop([self.queue.get_nowait()])
+            except queue.Empty:
+                break
+            self.queue.task_done()
+
+
+def _drop(messages):
+    for _, _, future in messages:
+        future.set_exception(ConnectionError('The message was dropped when the publisher closed'))
+
+
 class SnapshotClient:
     """RabbitMQ Snapshot client
 
     Used by the main server as to communicate Snapshots to other listeners on the exchange
-    such as the Parsers and the Savers
+    such as the Parsers and the Savers.
+    Messages are encoded by the calling thread and published by a :class:`Publisher`, so the client can be
+    shared by all the server's request threads.
 
     Args:
         host (:obj:`str`): Hostname of the RabbitMQ server
         port (:obj:`int`): Port of the RabbitMQ server
+        **config: Server configuration, uses PARSERS and optionally PUBLISH_CONFIRMS, PUBLISH_QUEUE_SIZE,
+            PUBLISH_QUEUE_TIMEOUT, PUBLISH_BATCH_SIZE and ADMISSION_QUEUE_HIGH (the parsers and saver queues are
+            watched when set)
     """
     def __init__(self, host, port, **config):
         self.parsers = config['PARSERS']
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, heartbeat=0))
-        self.channel = self.connection.channel()
-
-        # Declare Snapshot exchange
-        self.channel.exchange_declare(exchange='snapshots', exchange_type='topic')
+        watch_queues = [*self.parsers, 'save'] if config.get('ADMISSION_QUEUE_HIGH') else []
+        self.publisher = Publisher(host, port, exchange='snapshots', exchange_type='topic',
+                                   confirms=config.get('PUBLISH_CONFIRMS', False),
+                                   max_queue=config.get('PUBLISH_QUEUE_SIZE', 1024),
+                                   put_timeout=config.get('PUBLISH_QUEUE_TIMEOUT', 1),
+                                   batch_size=config.get('PUBLISH_BATCH_SIZE', 64),
+                                   watch_queues=watch_queues)
 
     def __del__(self):
-        self.connection.close()
+        if hasattr(self, 'publisher'):
+            self.close()
+
+    def close(self):
+        """Publishes the queued messages and closes the connection"""
+        self.publisher.close()
+
+    def queue_depth(self):
+        """Returns the depth of the most backed up parser (or saver) queue, plus the messages not published yet"""
+        return self.publisher.queue_depth + self.publisher.queue.qsize()
 
     def publish(self, message):
         """Publishes a message to the queue
 
         Args:
             message (:obj:`str`): Message to publish
+        Returns:
+            :class:`concurrent.futures.Future`: Completed once the message was published (see :class:`Publisher`)
         """
-        # TODO: remove print
-        # print('published')
         # Intersect between the snapshot fields and the supported parsers
         exist_supported_fields = message['snapshot'].keys() & set(self.parsers)
-        self.channel.basic_publish(exchange='snapshots',
-                                   routing_key='.'.join(exist_supported_fields),
-                                   body=bson.encode(message))
+        return self.publisher.publish(routing_key='.'.join(exist_supported_fields), body=bson.encode(message))
+
+    def publish_batch(self, messages):
+        """Publishes a list of messages to the queue, in order
+
+        Args:
+            messages (:obj:`list`): Messages to publish
+        Returns:
+            :obj:`list`: A future per message, completed once it was published
+        """
+        return [self.publish(message) for message in messages]
 
 
 class ParserClient:
@@ -45,13 +257,45 @@ class ParserClient:
     Envelopes a :class:`cortex.parsers.parser.Parser` and uses it to parse consumed Snapshots and publish
     parsed Snapshots
 
+    Messages are parsed by a pool of ``workers`` processes (or threads), so a parser service uses as many cores
+    as it is given, while the pika connection stays with the consuming thread: finished parses are handed back
+    to it with :meth:`pika.BlockingConnection.add_callback_threadsafe`, which publishes the result and only then
+    acknowledges the message. Up to ``prefetch`` messages are delivered unacknowledged at a time (``basic_qos``),
+    which keeps the pool busy without buffering the queue in memory, and messages in flight when the parser dies
+    are delivered again. Messages which fail to parse are rejected without requeueing.
+    Consumed messages are gathered into batches of up to ``batch_size`` messages, a batch which doesn't fill up
+    within ``batch_timeout`` seconds is parsed as is. A batch is handed to a worker at once and parsed by
+    :meth:`cortex.parsers.parser.Parser.parse_batch`, which amortizes the hand-off to the worker (and calls the
+    batch variant of the parser, when it has one).
+
     Args:
         host (:obj:`str`): Hostname of the RabbitMQ server
         port (:obj:`int`): Port of the RabbitMQ server
-        port (:class:`cortex.parsers.parser.Parser`): A Snapshot parser
+        parser (:class:`cortex.parsers.parser.Parser`): A Snapshot parser
+        workers (:obj:`int`, optional): Number of parsing workers
+        prefetch (:obj:`int`, optional): Maximal number of unacknowledged messages, defaults to twice the
+            messages the workers take at once
+        pool (:obj:`str`, optional): 'process' parses in worker processes, 'thread' in threads of the parser
+            process (enough for parsers which release the GIL)
+        batch_size (:obj:`int`, optional): Maximal number of messages parsed together
+        batch_timeout (:obj:`float`, optional): Seconds to wait for a batch to fill up before parsing it
     """
-    def __init__(self, host, port, parser):
+    def __init__(self, host, port, parser, workers=1, prefetch=None, pool='process', batch_size=1,
+                 batch_timeout=0.05):
         self.parser = parser
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.prefetch = prefetch or 2 * workers * batch_size
+        if pool == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        elif pool == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise KeyError(f'Unsupported worker pool: {pool}')
+        self.pending = set()
+        self.batch = []
+        self.batch_timer = None
+        self.error = None
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, heartbeat=0))
         self.channel = self.connection.channel()
 
@@ -61,32 +305,87 @@ class ParserClient:
         self.channel.queue_bind(exchange='snapshots',
                                 queue=self.parser.field,
                                 routing_key=f'#.{self.parser.field}.#')
+        self.channel.basic_qos(prefetch_count=self.prefetch)
         self.channel.basic_consume(queue=self.parser.field,
                                    on_message_callback=self.on_consume,
-                                   auto_ack=True)
+                                   auto_ack=False)
 
         # Declare Parsed Data exchange
         self.channel.exchange_declare(exchange='parsed_data', exchange_type='direct')
 
     def __del__(self):
-        self.connection.close()
+        if hasattr(self, 'connection'):
+            self.close()
+
+    def close(self):
+        """Stops the workers and closes the connection, unacknowledged messages are delivered again"""
+        for future in list(self.pending):
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        # Thread workers parse with the blob stores of this process
+        blobstore.close_stores()
+        if self.connection.is_open:
+            self.connection.close()
 
     def consume(self):
         """Start consuming from the message queue
+
+        Raises:
+            :class:`concurrent.futures.process.BrokenProcessPool`: A worker process died, the consumer stopped
         """
         self.channel.start_consuming()
+        if self.error is not None:
+            raise self.error
 
     def on_consume(self, channel, method, properties, body):
         """Callback function on message consuming
 
-        The callback basically parses the consumed message and publishes it to the saver exchange
+        The callback adds the message to the current batch and hands the batch to a parsing worker once it is full,
+        the results are published to the saver exchange (and the messages acknowledged) once they are parsed
         """
-        # TODO: remove print
-        # print(f'consumed: {body}')      # DEBUG
-        parsed_data_encoded = self.parser(body)
-        channel.basic_publish(exchange='parsed_data',
-                              routing_key=self.parser.field,
-                              body=parsed_data_encoded)
+        self.batch.append((method.delivery_tag, body))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = self.connection.call_later(self.batch_timeout, self.flush_batch)
+
+    def flush_batch(self):
+        """Hands the current batch to a parsing worker, runs on the consuming thread"""
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+        if not self.batch:
+            return
+        delivery_tags, bodies = zip(*self.batch)
+        self.batch = []
+        future = self.executor.submit(self.parser.parse_batch, list(bodies))
+        self.pending.add(future)
+        future.add_done_callback(
+            lambda done: self.connection.add_callback_threadsafe(lambda: self.on_parsed(delivery_tags, done)))
+
+    def on_parsed(self, delivery_tags, future):
+        """Publishes a parsed batch and acknowledges its messages, runs on the consuming thread"""
+        self.pending.discard(future)
+        if future.cancelled():
+            return
+        try:
+            results = future.result()
+        except BrokenProcessPool as e:
+            # The remaining messages will be delivered again to the next consumer
+            self.error = e
+            self.channel.stop_consuming()
+            return
+        except Exception as e:
+            results = [e] * len(delivery_tags)
+        for delivery_tag, result in zip(delivery_tags, results):
+            if isinstance(result, Exception):
+                print(result)
+                self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+                continue
+            self.channel.basic_publish(exchange='parsed_data',
+                                       routing_key=self.parser.field,
+                                       body=result)
+            self.channel.basic_ack(delivery_tag=delivery_tag)
 
 
 class SaverClient:
@@ -94,13 +393,26 @@ class SaverClient:
 
     Envelopes a Database SaverClient from :mod:`cortex.net.db` and uses it to save consumed Snapshots to the database
 
+    Consumed messages are buffered and saved in batches of up to ``batch_size`` messages by the saver's
+    ``save_batch``, a batch which doesn't fill up within ``batch_timeout`` seconds is saved as is. The messages of
+    a batch are acknowledged once it is saved, and delivered again if the saver dies, so a snapshot is saved at
+    least once. When saving a batch fails its messages are saved one at a time, and only those which fail again
+    are rejected: a message is requeued once, and dropped (or dead-lettered, when the queue has a dead letter
+    exchange) when its redelivery fails too, so a message which can't be saved isn't delivered forever.
+
     Args:
         host (:obj:`str`): Hostname of the RabbitMQ server
         port (:obj:`int`): Port of the RabbitMQ server
         db_client: A Database SaverClient from :mod:`cortex.net.db`
+        batch_size (:obj:`int`, optional): Maximal number of messages saved together
+        batch_timeout (:obj:`float`, optional): Seconds to wait for a batch to fill up before saving it
     """
-    def __init__(self, host, port, db_client):
+    def __init__(self, host, port, db_client, batch_size=1, batch_timeout=0.5):
         self.db_client = db_client
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch = []
+        self.batch_timer = None
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=port, heartbeat=0))
         self.channel = self.connection.channel()
 
@@ -112,9 +424,10 @@ class SaverClient:
             self.channel.queue_bind(exchange='parsed_data',
                                     queue='save',
                                     routing_key=field)
+        self.channel.basic_qos(prefetch_count=2 * batch_size)
         self.channel.basic_consume(queue='save',
                                    on_message_callback=self.on_consume,
-                                   auto_ack=True)
+                                   auto_ack=False)
 
     def __del__(self):
         self.connection.close()
@@ -127,8 +440,39 @@ class SaverClient:
     def on_consume(self, channel, method, properties, body):
         """Callback function on message consuming
 
-        The callback basically calls the db client save method with the consumed message
+        The callback adds the message to the current batch, which is saved with the db client once it is full
         """
-        # TODO Remove print
-        # print(f'consumed: {body}')      # DEBUG
-        self.db_client.save(field=method.routing_key, data=body)
+        self.batch.append((method.delivery_tag, method.redelivered, method.routing_key, body))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = self.connection.call_later(self.batch_timeout, self.flush_batch)
+
+    def flush_batch(self):
+        """Saves the current batch and acknowledges its messages"""
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        try:
+            self.db_client.save_batch([(field, body) for _, _, field, body in batch])
+        except Exception as e:
+            print(e)
+            for message in batch:
+                self._save_one(*message)
+            return
+        # Messages are delivered (and buffered) in order, the last tag settles the whole batch
+        self.channel.basic_ack(delivery_tag=batch[-1][0], multiple=True)
+
+    def _save_one(self, delivery_tag, redelivered, field, body):
+        try:
+            self.db_client.save(field, body)
+        except Exception as e:
+            print(e)
+            if redelivered:
+                print(f'Rejecting a {field} message which failed to save twice')
+            self.channel.basic_nack(delivery_tag=delivery_tag, multiple=False, requeue=not redelivered)
+            return
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=False)
@@ -1,11 +1,161 @@
+import datetime
+import struct
 import bson
+import numpy as np
 from PIL import Image
 
 """
 This module encompasses the protocol used for communication between the Server and the Client.
 Basically, each class in this module represents a message which can be encoded/decoded by the BSON format.
+Encoded messages travel either as plain BSON or as frames (see :func:`encode_message`).
 """
 
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+WIRE_FORMATS = {'bson': 'application/bson',
+                'frame': 'application/vnd.cortex.frame'}
+
+_FRAME_MAGIC = b'CTXF'
+_FRAME_HEADER_FORMAT = '<4sII'
+_SECTION_KEY = '__section__'
+FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER_FORMAT)
+
+
+def timestamp_key(timestamp):
+    """Maps a snapshot timestamp to an integer key identifying the snapshot among the user's snapshots
+
+    Args:
+        timestamp (:obj:`datetime.datetime`): Snapshot timestamp, naive in UTC (as carried by :class:`Snapshot`
+            and returned by MongoDB) or aware
+    Returns:
+        int: Milliseconds between the epoch and the timestamp
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (timestamp - _EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def timestamp_from_key(key):
+    """Maps a timestamp key (see :func:`timestamp_key`) back to the naive snapshot timestamp
+
+    Args:
+        key (int): Milliseconds since the epoch
+    Returns:
+        :obj:`datetime.datetime`: Naive snapshot timestamp
+    """
+    return _EPOCH + datetime.timedelta(milliseconds=int(key))
+
+
+def encode_message(document, wire_format='bson'):
+    """Encodes a message dictionary in one of the :data:`WIRE_FORMATS`
+
+    A frame starts with a small header (magic, metadata length, section count), followed by the BSON encoded
+    metadata, a table of the section lengths (little endian uint64) and the sections themselves. Every binary
+    value of the message (bytes or any buffer, e.g. the pixels of ``Snapshot.to_bson(raw=True)``) is moved
+    out of the metadata into its own raw section, so the pixels are written once and never go through the
+    BSON encoder.
+
+    Args:
+        document (dict): Message dictionary
+        wire_format (str, optional): 'bson' or 'frame'
+    Returns:
+        bytes: Encoded message
+    """
+    if wire_format == 'bson':
+        return bson.encode(document)
+    if wire_format != 'frame':
+        raise KeyError(f'Unsupported wire format: {wire_format}')
+    sections = []
+    metadata = bson.encode(_extract_sections(document, sections))
+    header = struct.pack(_FRAME_HEADER_FORMAT, _FRAME_MAGIC, len(metadata), len(sections))
+    lengths = np.array([len(section) for section in sections], dtype='<u8').tobytes()
+    return b''.join([header, metadata, lengths, *sections])
+
+
+def decode_message(data, wire_format='bson'):
+    """Decodes a message encoded by :func:`encode_message`
+
+    The binary values of a decoded frame are zero-copy memoryview slices of ``data`` (convert them with
+    ``bytes()`` before encoding them as BSON again).
+
+    Args:
+        data (bytes): Encoded message
+        wire_format (str, optional): 'bson' or 'frame'
+    Returns:
+        dict: Message dictionary
+    """
+    if wire_format == 'bson':
+        return bson.decode(data)
+    if wire_format != 'frame':
+        raise KeyError(f'Unsupported wire format: {wire_format}')
+    data = memoryview(data).cast('B')
+    metadata_length, count = decode_frame_header(data)
+    pos = FRAME_HEADER_SIZE
+    metadata = bson.decode(data[pos:pos + metadata_length])
+    pos += metadata_length
+    lengths = np.frombuffer(data, dtype='<u8', count=count, offset=pos).tolist()
+    pos += 8 * count
+    sections = []
+    for length in lengths:
+        sections.append(data[pos:pos + length])
+        pos += length
+    if pos != len(data):
+        raise ValueError('Truncated frame')
+    return restore_sections(metadata, sections)
+
+
+def decode_frame_header(data):
+    """Decodes the fixed size header which starts a frame (see :func:`encode_message`)
+
+    Used along with :func:`section_index` and :func:`restore_sections` to decode a frame as it is received.
+
+    Args:
+        data (bytes): The first :data:`FRAME_HEADER_SIZE` bytes of the frame
+    Returns:
+        tuple: (metadata length, section count)
+    """
+    magic, metadata_length, count = struct.unpack_from(_FRAME_HEADER_FORMAT, data)
+    if magic != _FRAME_MAGIC:
+        raise ValueError('Invalid frame')
+    return metadata_length, count
+
+
+def section_index(value):
+    """Returns the section a value of the decoded frame metadata stands for, None if it isn't a section"""
+    if isinstance(value, dict) and len(value) == 1 and _SECTION_KEY in value:
+        return value[_SECTION_KEY]
+    return None
+
+
+def restore_sections(value, sections):
+    """Replaces the section references of decoded frame metadata by the sections
+
+    Args:
+        value (dict): Decoded frame metadata
+        sections (list): Frame sections, in order
+    Returns:
+        dict: Message dictionary
+    """
+    index = section_index(value)
+    if index is not None:
+        return sections[index]
+    if isinstance(value, dict):
+        return {key: restore_sections(val, sections) for key, val in value.items()}
+    if isinstance(value, list):
+        return [restore_sections(val, sections) for val in value]
+    return value
+
+
+def _extract_sections(value, sections):
+    if isinstance(value, dict):
+        return {key: _extract_sections(val, sections) for key, val in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_extract_sections(val, sections) for val in value]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        sections.append(memoryview(value).cast('B'))
+        return {_SECTION_KEY: len(sections) - 1}
+    return value
+
 
 class User:
     """User message
@@ -52,13 +202,20 @@ class Config:
     """Config message
 
     Contains information about the server configuration, more specifically, which snapshot fields the server
-    is able to parse.
+    is able to parse, how many snapshots it accepts in a single batch upload and whether it reports upload
+    progress (see :class:`Progress`) and which wire formats it accepts uploads in (see :data:`WIRE_FORMATS`).
 
     Args:
         parsers (list[str]): List of parser names.
+        max_batch_size (int, optional): Maximal number of snapshots per batch upload, 0 if batches are not supported
+        progress (bool, optional): Whether the server reports the snapshots it already accepted
+        formats (list[str], optional): Accepted wire formats
     """
-    def __init__(self, parsers):
+    def __init__(self, parsers, max_batch_size=0, progress=False, formats=('bson',)):
         self.parsers = parsers
+        self.max_batch_size = max_batch_size
+        self.progress = progress
+        self.formats = list(formats)
 
     def to_bson(self):
         """Encodes the config message into a dictionary
@@ -66,7 +223,10 @@ class Config:
         Returns:
             dict: Config message dictionary
         """
-        config_doc = {'parsers': self.parsers}
+        config_doc = {'parsers': self.parsers,
+                      'max_batch_size': self.max_batch_size,
+                      'progress': self.progress,
+                      'formats': self.formats}
         return config_doc
 
     @staticmethod
@@ -81,6 +241,42 @@ class Config:
         return Config(**data)
 
 
+class Progress:
+    """Progress message
+
+    Contains the snapshots the server already accepted for a user, identified by their timestamp keys
+    (see :func:`timestamp_key`). The keys are packed as little endian int64 values when encoded.
+
+    Args:
+        uid (int): User ID
+        timestamps (list[int]): Timestamp keys of the accepted snapshots
+    """
+    def __init__(self, uid, timestamps=()):
+        self.uid = uid
+        self.timestamps = timestamps
+
+    def to_bson(self):
+        """Encodes the progress message into a dictionary
+
+        Returns:
+            dict: Progress message dictionary
+        """
+        progress_doc = {'uid': self.uid,
+                        'timestamps': np.asarray(self.timestamps, dtype='<i8').tobytes()}
+        return progress_doc
+
+    @staticmethod
+    def from_bson(data):
+        """Decodes a progress dictionary into a :class:`Progress` instance
+
+        Args:
+            data (dict): BSON Dictionary containing progress information
+        Returns:
+            :class:`Progress`: Progress instance
+        """
+        return Progress(uid=data['uid'], timestamps=np.frombuffer(data['timestamps'], dtype='<i8'))
+
+
 class Snapshot:
     """Snapshot message
 
@@ -118,18 +314,23 @@ class Snapshot:
         self.image_depth = image_depth
         self.feelings = feelings
 
-    def to_bson(self, fields=None):
-        """Encodes the config message into a dictionary
+    def to_bson(self, fields=None, raw=False):
+        """Encodes the snapshot message into a dictionary
 
+        Args:
+            fields (list[str], optional): Fields to encode, all of them by default
+            raw (bool, optional): Keep the image pixels as zero-copy buffers instead of bytes, for
+                :func:`encode_message` frames (such a dictionary can't be BSON encoded)
         Returns:
-            dict: Config message dictionary
+            dict: Snapshot message dictionary
         """
         fields = fields or Snapshot.fields
         snapshot_doc = {'timestamp_ms': self.timestamp_ms}
         for fname in fields:
             fval = getattr(self, fname)
-            if fval is not None:
-                snapshot_doc[fname] = fval.to_bson()
+            if fval is None:
+                continue
+            snapshot_doc[fname] = fval.to_bson(raw=True) if raw and isinstance(fval, _BufferImage) else fval.to_bson()
         return snapshot_doc
 
     @staticmethod
@@ -206,28 +407,119 @@ class Pose:
         return Pose(**pose_doc)
 
 
+class _BufferImage:
+    """Base class of the image sub-messages
+
+    An image is backed by its raw pixel buffer (bytes, memoryview or any object supporting the buffer protocol)
+    together with its shape and dtype. A PIL image or a NumPy view of the pixels are only built when asked
+    for, and encoding passes the buffer on as is, so the pixels are not copied on the way from the reader
+    to the wire more than the encoding itself requires.
+    Images created from a PIL image (the legacy way) are converted to a buffer when first encoded.
+
+    Args:
+        image (:obj:`PIL.Image.Image`, optional): Image of the sub-message mode
+    """
+    _MODE = None
+    _DTYPE = None
+    _CHANNELS = 1
+
+    def __init__(self, image=None):
+        self._image = image
+        self._data = None
+        self.width, self.height = (0, 0) if image is None else image.size
+
+    @classmethod
+    def from_buffer(cls, data, width, height):
+        """Creates a buffer backed image sub-message without copying the buffer
+
+        Args:
+            data (:obj:`bytes`): Raw pixels (any object supporting the buffer protocol)
+            width (:obj:`int`): Width of the image
+            height (:obj:`int`): Height of the image
+        Returns:
+            Image sub-message instance
+        """
+        image = cls()
+        image._data = data
+        image.width, image.height = width, height
+        return image
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(state['_data'], memoryview):
+            state['_data'] = bytes(state['_data'])
+        return state
+
+    @property
+    def shape(self):
+        """:obj:`tuple`: Shape of the pixel array, (height, width) followed by the channels if there are several"""
+        return (self.height, self.width) if self._CHANNELS == 1 else (self.height, self.width, self._CHANNELS)
+
+    @property
+    def dtype(self):
+        """:obj:`numpy.dtype`: Data type of the pixels"""
+        return np.dtype(self._DTYPE)
+
+    @property
+    def data(self):
+        """:obj:`memoryview`: Raw pixel buffer (empty if the image is empty)"""
+        if self._data is None:
+            self._data = b'' if self._image is None else self._image.tobytes()
+        return memoryview(self._data).cast('B')
+
+    def to_numpy(self):
+        """Returns a read-only NumPy view of the pixels, shaped as :attr:`shape`
+
+        Returns:
+            :obj:`numpy.ndarray`: Pixel array
+        """
+        return np.frombuffer(self.data, dtype=self.dtype).reshape(self.shape)
+
+    def to_pil(self):
+        """Returns the image as a PIL image, built on first access
+
+        Returns:
+            :obj:`PIL.Image.Image`: The image, None if the image is empty
+        """
+        if self._image is None and self.width * self.height > 0:
+            self._image = Image.frombuffer(self._MODE, (self.width, self.height), self.data, 'raw', self._MODE, 0, 1)
+        return self._image
+
+    def tobytes(self):
+        """Returns the raw pixels as bytes, without copying them if the buffer already is a bytes object"""
+        data = self._data if self._data is not None else self.data
+        return data if isinstance(data, bytes) else bytes(memoryview(data).cast('B'))
+
+
 @Snapshot.field('image_color')
-class ImageColor:
+class ImageColor(_BufferImage):
     """ImageColor sub-message
 
-    Contains information about the ImageColor of the snapshot
+    Contains information about the ImageColor of the snapshot, an RGB image (see :class:`_BufferImage`).
 
     Args:
-        image_color (:obj:`numpy.ndarray`): RGB Image represented as a 3d numpy array
+        image_color (:obj:`PIL.Image.Image`, optional): RGB Image
         width (:obj:`int`): Width of image_color
         height (:obj:`int`): Height of image_color
     """
-    def __init__(self, image_color=None):
-        self.image_color = image_color
-        self.width, self.height = (0, 0) if image_color is None else image_color.size
+    _MODE = 'RGB'
+    _DTYPE = 'u1'
+    _CHANNELS = 3
 
-    def to_bson(self):
+    @property
+    def image_color(self):
+        """:obj:`PIL.Image.Image`: The image as a PIL image (see :meth:`to_pil`)"""
+        return self.to_pil()
+
+    def to_bson(self, raw=False):
         """Encodes the ImageColor sub-message into a dictionary
 
+        Args:
+            raw (bool, optional): Keep the pixels as a zero-copy buffer instead of bytes
         Returns:
             dict: ImageColor sub-message dictionary
         """
-        image_doc = {'image_color': b'' if self.image_color is None else self.image_color.tobytes(),
+        image_doc = {'image_color': self.data if raw else self.tobytes(),
                      'width': self.width,
                      'height': self.height}
         return image_doc
@@ -243,32 +535,38 @@ class ImageColor:
         """
         image_doc = data
         image_bytes, w, h = image_doc['image_color'], image_doc['width'], image_doc['height']
-        image_color = None if len(image_bytes) == 0 else Image.frombytes('RGB', (w, h), image_bytes)
-        return ImageColor(image_color)
+        return ImageColor() if len(image_bytes) == 0 else ImageColor.from_buffer(image_bytes, w, h)
 
 
 @Snapshot.field('image_depth')
-class ImageDepth:
+class ImageDepth(_BufferImage):
     """ImageDepth sub-message
 
-    Contains information about the ImageDepth of the snapshot
+    Contains information about the ImageDepth of the snapshot, a single channel little endian float32 image
+    (see :class:`_BufferImage`).
 
     Args:
-        image_depth (:obj:`numpy.ndarray`): Image represented as a 1d float numpy array
+        image_depth (:obj:`PIL.Image.Image`, optional): Float ('F') image
         width (:obj:`int`): Width of image_depth
         height (:obj:`int`): Height of image_depth
     """
-    def __init__(self, image_depth=None):
-        self.image_depth = image_depth
-        self.width, self.height = (0, 0) if image_depth is None else image_depth.size
+    _MODE = 'F'
+    _DTYPE = '<f4'
 
-    def to_bson(self):
+    @property
+    def image_depth(self):
+        """:obj:`PIL.Image.Image`: The image as a PIL image (see :meth:`to_pil`)"""
+        return self.to_pil()
+
+    def to_bson(self, raw=False):
         """Encodes the ImageDepth sub-message into a dictionary
 
+        Args:
+            raw (bool, optional): Keep the pixels as a zero-copy buffer instead of bytes
         Returns:
             dict: ImageDepth sub-message dictionary
         """
-        image_doc = {'image_depth': b'' if self.image_depth is None else self.image_depth.tobytes(),
+        image_doc = {'image_depth': self.data if raw else self.tobytes(),
                      'width': self.width,
                      'height': self.height}
         return image_doc
@@ -284,8 +582,7 @@ class ImageDepth:
         """
         image_doc = data
         image_bytes, w, h = image_doc['image_depth'], image_doc['width'], image_doc['height']
-        image_depth = None if len(image_bytes) == 0 else Image.frombytes('F', (w, h), image_bytes)
-        return ImageColor(image_depth)
+        return ImageDepth() if len(image_bytes) == 0 else ImageDepth.from_buffer(image_bytes, w, h)
 
 
 @Snapshot.field('feelings')
@@ -329,3 +626,142 @@ class Feelings:
         """
         feelings_doc = data
         return Feelings(**feelings_doc)
+
+
+class SnapshotBatch:
+    """Columnar batch of snapshots
+
+    Holds N snapshots column by column: the timestamps as an int64 array of timestamp keys (see
+    :func:`timestamp_key`), the poses as an (N, 7) float64 array of translation (x, y, z) followed by rotation
+    (x, y, z, w), the feelings as an (N, 4) float64 array of hunger, thirst, exhaustion and happiness, and the
+    images as lists of :class:`ImageColor`/:class:`ImageDepth` (pixel buffers are not copied).
+    Snapshots missing a pose or feelings have a row of NaNs, missing images are None, a column missing from
+    all the snapshots is None altogether.
+
+    Encoded, the numeric columns are packed little endian bytes, so a batch is a handful of binary values
+    rather than a dictionary per snapshot, and decoding views them in place.
+
+    Args:
+        timestamps (:obj:`numpy.ndarray`): int64 array of timestamp keys
+        poses (:obj:`numpy.ndarray`, optional): (N, 7) float64 array of poses
+        feelings (:obj:`numpy.ndarray`, optional): (N, 4) float64 array of feelings
+        image_color (list[:class:`ImageColor`], optional): Color images
+        image_depth (list[:class:`ImageDepth`], optional): Depth images
+    """
+    _FEELINGS = ('hunger', 'thirst', 'exhaustion', 'happiness')
+
+    def __init__(self, timestamps, poses=None, feelings=None, image_color=None, image_depth=None):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.poses = None if poses is None else np.asarray(poses, dtype=np.float64).reshape(-1, 7)
+        self.feelings = None if feelings is None else np.asarray(feelings, dtype=np.float64).reshape(-1, 4)
+        self.image_color = image_color
+        self.image_depth = image_depth
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.snapshot(i)
+
+    @property
+    def translations(self):
+        """:obj:`numpy.ndarray`: (N, 3) view of the pose translations"""
+        return None if self.poses is None else self.poses[:, :3]
+
+    @property
+    def rotations(self):
+        """:obj:`numpy.ndarray`: (N, 4) view of the pose rotations"""
+        return None if self.poses is None else self.poses[:, 3:]
+
+    def snapshot(self, i):
+        """Returns the i-th snapshot of the batch
+
+        Args:
+            i (int): Snapshot index
+        Returns:
+            :class:`Snapshot`: Snapshot instance
+        """
+        pose = feelings = None
+        if self.poses is not None and not np.isnan(self.poses[i]).all():
+            pose = Pose(translation=tuple(self.poses[i, :3].tolist()), rotation=tuple(self.poses[i, 3:].tolist()))
+        if self.feelings is not None and not np.isnan(self.feelings[i]).all():
+            feelings = Feelings(**dict(zip(self._FEELINGS, self.feelings[i].tolist())))
+        return Snapshot(timestamp_from_key(self.timestamps[i]),
+                        pose=pose,
+                        image_color=None if self.image_color is None else self.image_color[i],
+                        image_depth=None if self.image_depth is None else self.image_depth[i],
+                        feelings=feelings)
+
+    @staticmethod
+    def from_snapshots(snapshots):
+        """Gathers snapshots into a :class:`SnapshotBatch`
+
+        Args:
+            snapshots (list[:class:`Snapshot`]): Snapshots
+        Returns:
+            :class:`SnapshotBatch`: SnapshotBatch instance
+        """
+        snapshots = list(snapshots)
+        timestamps = [timestamp_key(snapshot.timestamp_ms) for snapshot in snapshots]
+        poses = feelings = image_color = image_depth = None
+        if any(snapshot.pose is not None for snapshot in snapshots):
+            poses = np.full((len(snapshots), 7), np.nan)
+            for i, snapshot in enumerate(snapshots):
+                if snapshot.pose is not None:
+                    poses[i] = (*snapshot.pose.translation, *snapshot.pose.rotation)
+        if any(snapshot.feelings is not None for snapshot in snapshots):
+            feelings = np.full((len(snapshots), 4), np.nan)
+            for i, snapshot in enumerate(snapshots):
+                if snapshot.feelings is not None:
+                    feelings[i] = [getattr(snapshot.feelings, name) for name in SnapshotBatch._FEELINGS]
+        if any(snapshot.image_color is not None for snapshot in snapshots):
+            image_color = [snapshot.image_color for snapshot in snapshots]
+        if any(snapshot.image_depth is not None for snapshot in snapshots):
+            image_depth = [snapshot.image_depth for snapshot in snapshots]
+        return SnapshotBatch(timestamps, poses, feelings, image_color, image_depth)
+
+    def to_bson(self, fields=None, raw=False):
+        """Encodes the batch into a dictionary
+
+        Args:
+            fields (list[str], optional): Fields to encode, all of them by default
+            raw (bool, optional): Keep the image pixels as zero-copy buffers instead of bytes (see
+                :meth:`Snapshot.to_bson`)
+        Returns:
+            dict: SnapshotBatch dictionary
+        """
+        fields = fields or Snapshot.fields
+        batch_doc = {'timestamps': self.timestamps.astype('<i8').tobytes()}
+        if 'pose' in fields and self.poses is not None:
+            batch_doc['pose'] = self.poses.astype('<f8').tobytes()
+        if 'feelings' in fields and self.feelings is not None:
+            batch_doc['feelings'] = self.feelings.astype('<f8').tobytes()
+        for fname in ('image_color', 'image_depth'):
+            images = getattr(self, fname)
+            if fname in fields and images is not None:
+                batch_doc[fname] = [None if image is None else image.to_bson(raw=raw) for image in images]
+        return batch_doc
+
+    @staticmethod
+    def from_bson(data):
+        """Decodes a batch dictionary into a :class:`SnapshotBatch` instance, the numeric columns are viewed in place
+
+        Args:
+            data (dict): BSON Dictionary containing batch information
+        Returns:
+            :class:`SnapshotBatch`: SnapshotBatch instance
+        """
+        batch_doc = data
+        columns = {'timestamps': np.frombuffer(batch_doc['timestamps'], dtype='<i8')}
+        if 'pose' in batch_doc:
+            columns['poses'] = np.frombuffer(batch_doc['pose'], dtype='<f8')
+        if 'feelings' in batch_doc:
+            columns['feelings'] = np.frombuffer(batch_doc['feelings'], dtype='<f8')
+        if 'image_color' in batch_doc:
+            columns['image_color'] = [None if image is None else ImageColor.from_bson(image)
+                                      for image in batch_doc['image_color']]
+        if 'image_depth' in batch_doc:
+            columns['image_depth'] = [None if image is None else ImageDepth.from_bson(image)
+                                      for image in batch_doc['image_depth']]
+        return SnapshotBatch(**columns)
@@ -20,10 +20,19 @@ def _parse(field, data_path):
 
 
 @cli.command(name='run-parser')
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help='Number of parsing workers')
+@click.option('--prefetch', type=int, default=None,
+              help='Unacknowledged messages at a time [default: 2 x workers x batch size]')
+@click.option('--pool', type=click.Choice(['process', 'thread']), default='process', show_default=True,
+              help='Parse in worker processes or threads')
+@click.option('--batch-size', type=int, default=1, show_default=True, help='Maximal number of messages parsed together')
+@click.option('--batch-timeout', type=float, default=0.05, show_default=True,
+              help='Seconds to wait for a batch to fill up')
 @click.argument('field', type=str, required=True, callback=strip_str)
 @click.argument('message_queue', type=str, required=True, callback=strip_str)
-def _setup_parser(field, message_queue):
-    parser = setup_parser(field, message_queue)
+def _setup_parser(workers, prefetch, pool, batch_size, batch_timeout, field, message_queue):
+    parser = setup_parser(field, message_queue, workers=workers, prefetch=prefetch, pool=pool,
+                          batch_size=batch_size, batch_timeout=batch_timeout)
     parser.consume()
 
 
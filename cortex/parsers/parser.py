@@ -1,7 +1,9 @@
 import importlib
-from pathlib import Path
+import io
+from pathlib import PurePosixPath
 import bson
 from PIL import Image
+from ..net import blobstore
 from ..utils import parse_url
 
 
@@ -20,10 +22,15 @@ class Parser:
             Interface
                 - Recieves a :class:`cortex.net.protocol.Snapshot` in a form of dictionary and parses the appropriate field.
 
+        A parser may also register a batch variant with :meth:`Parser.register_batch_parser`, which receives a list
+        of snapshot dictionaries and returns the list of their parsed fields. :meth:`Parser.parse_batch` uses it
+        to parse a batch of messages in a single call.
+
     Args:
         field (str): The snapshot field name to be parsed
     """
     _PARSERS = {}
+    _BATCH_PARSERS = {}
 
     def __init__(self, field):
         self.field = field
@@ -34,9 +41,40 @@ class Parser:
 
     def __call__(self, data):
         data = bson.decode(data)
-        snapshot = data['snapshot']
-        parsed_snapshot = {'timestamp_ms': snapshot['timestamp_ms'],
-                           self.field: self.parser(snapshot)}
+        return self._encode(data, self.parser(data['snapshot']))
+
+    def parse_batch(self, data):
+        """Parses a batch of messages
+
+        The batch variant of the parser is called once with all the snapshots when one is registered, otherwise
+        the messages are parsed one by one. When the batch variant fails the messages are parsed one by one as
+        well, so a bad message doesn't fail the whole batch.
+
+        Args:
+            data (list): BSON encoded messages
+
+        Returns:
+            list: The BSON encoded parsed data of every message, or the exception raised parsing it
+        """
+        batch_parser = Parser._BATCH_PARSERS.get(self.field)
+        if batch_parser is not None:
+            try:
+                messages = [bson.decode(message) for message in data]
+                parsed = batch_parser([message['snapshot'] for message in messages])
+                return [self._encode(message, field) for message, field in zip(messages, parsed)]
+            except Exception as e:
+                print(f'Parsing a batch of {len(data)} {self.field} messages failed, parsing them one by one: {e!r}')
+        results = []
+        for message in data:
+            try:
+                results.append(self(message))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _encode(self, data, parsed):
+        parsed_snapshot = {'timestamp_ms': data['snapshot']['timestamp_ms'],
+                           self.field: parsed}
         return bson.encode({'user': data['user'], 'snapshot': parsed_snapshot})
 
     @staticmethod
@@ -51,6 +89,18 @@ class Parser:
             return f
         return decorator
 
+    @staticmethod
+    def register_batch_parser(field):
+        """A Decorator for registering the batch variant of a parser function.
+
+        Args:
+            field (str): The name of the parser the function is a batch variant of
+        """
+        def decorator(f):
+            Parser._BATCH_PARSERS[field] = f
+            return f
+        return decorator
+
 
 @Parser.register_parser('pose')
 def parse_translation(data):
@@ -69,49 +119,46 @@ def parse_translation(data):
 def parse_image_color(data):
     """Color image field parser
 
+    Reads the raw image from the blob store it was uploaded to and writes the PNG image next to it.
+
     Args:
         data (dict): Snapshot dictionary
 
     Returns:
         Color image information
     """
-    data = data['image_color']
-    raw_path = Path(data['image_color'])
-    w, h = data['width'], data['height']
-    if w * h == 0:
-        data['image_color'] = ''
-    else:
-        with raw_path.open(mode='rb') as fd:
-            raw_img = fd.read()
-            img_path = str(raw_path.parent / raw_path.stem) + '.png'
-            img = Image.frombytes('RGB', (w, h), raw_img)
-            img.save(img_path)
-            data['image_color'] = img_path
-    return data
+    return _convert_image(data['image_color'], 'image_color', 'RGB', 'png')
 
 
 @Parser.register_parser('image_depth')
 def parse_image_depth(data):
     """Depth image field parser
 
+    Reads the raw image from the blob store it was uploaded to and writes the TIFF image next to it.
+
     Args:
         data (dict): Snapshot dictionary
 
     Returns:
         Depth image information
     """
-    data = data['image_depth']
-    raw_path = Path(data['image_depth'])
+    return _convert_image(data['image_depth'], 'image_depth', 'F', 'tiff')
+
+
+def _convert_image(data, field, mode, image_format):
+    raw_ref = data[field]
     w, h = data['width'], data['height']
     if w * h == 0:
-        data['image_depth'] = ''
+        data[field] = ''
     else:
-        with raw_path.open(mode='rb') as fd:
-            raw_img = fd.read()
-            img_path = str(raw_path.parent / raw_path.stem) + '.tiff'
-            img = Image.frombytes('F', (w, h), raw_img)
-            img.save(img_path)
-            data['image_depth'] = img_path
+        store = blobstore.store_for(raw_ref)
+        img = Image.frombuffer(mode, (w, h), store.get(raw_ref), 'raw', mode, 0, 1)
+        fd = io.BytesIO()
+        img.save(fd, format=image_format)
+        key = PurePosixPath(blobstore.blob_key(raw_ref)).with_suffix(f'.{image_format}')
+        data[field] = store.put(str(key), fd.getbuffer())
+        # The parsed result refers to the image, it must be on disk before the result is published
+        store.sync([data[field]])
     return data
 
 
@@ -143,7 +190,7 @@ def run_parser(field, data):
     return data_bytes
 
 
-def setup_parser(field, message_queue):
+def setup_parser(field, message_queue, workers=1, prefetch=None, pool='process', batch_size=1, batch_timeout=0.05):
     """Sets up a message client queue with the 'field' parser as a consumer
 
     The parser client is dynamically imported from the :mod:`cortex.net.mq` module and
@@ -154,6 +201,12 @@ def setup_parser(field, message_queue):
     Args:
         field (str): Field name to parse
         message_queue (str): message queue URL in the format <mq_name>://<host>:<port>
+        workers (int, optional): Number of parsing workers
+        prefetch (int, optional): Maximal number of messages delivered to the parser unacknowledged,
+            defaults to twice the messages the workers take at once
+        pool (str, optional): 'process' or 'thread' workers
+        batch_size (int, optional): Maximal number of messages parsed together
+        batch_timeout (float, optional): Seconds to wait for a batch to fill up before parsing it
 
     Returns:
         ParserClient
@@ -162,6 +215,6 @@ def setup_parser(field, message_queue):
     scheme, host, port = parse_url(message_queue)
     mq_module = importlib.import_module(name=f'..net.mq.{scheme}',
                                         package='cortex.parser')
-    mq_client = mq_module.ParserClient(host, port, parser)
+    mq_client = mq_module.ParserClient(host, port, parser, workers=workers, prefetch=prefetch, pool=pool,
+                                       batch_size=batch_size, batch_timeout=batch_timeout)
     return mq_client
-
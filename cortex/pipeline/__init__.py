@@ -0,0 +1 @@
+from .pipeline import run_pipeline, Pipeline
@@ -0,0 +1,34 @@
+import click
+from .pipeline import run_pipeline
+from ..utils import strip_str
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command(name='run-pipeline')
+@click.option('--host', '-h', type=str, default='127.0.0.1', show_default=True, callback=strip_str,
+              help='Server IP address')
+@click.option('--port', '-p', type=int, default=8000, show_default=True, help='Server port')
+@click.option('--database', '-d', type=str, default='mongodb://127.0.0.1:27017', show_default=True,
+              callback=strip_str, help='Database URL')
+@click.option('--parser', 'parsers', type=str, multiple=True,
+              help='Field to parse, may be given several times [default: every field the server supports]')
+@click.option('--workers', '-w', type=int, default=1, show_default=True, help='Parsing workers of every parser')
+@click.option('--pool', type=click.Choice(['process', 'thread']), default='process', show_default=True,
+              help='Parse in worker processes or threads')
+@click.option('--batch-size', type=int, default=1, show_default=True,
+              help='Maximal number of messages parsed and saved together')
+@click.option('--engine', '-e', type=click.Choice(['flask', 'asyncio']), default='flask', show_default=True,
+              help='Server implementation')
+@click.option('--blob-store', '-b', type=click.Choice(['directory', 'segment']), default='directory',
+              show_default=True, help='Layout of the uploaded images')
+def _run_pipeline(host, port, database, parsers, workers, pool, batch_size, engine, blob_store):
+    run_pipeline(host=host, port=port, database_url=database, parsers=parsers, workers=workers, pool=pool,
+                 batch_size=batch_size, engine=engine, blob_store=blob_store)
+
+
+if __name__ == '__main__':
+    cli(prog_name='cortex.pipeline')
@@ -0,0 +1,111 @@
+import signal
+import threading
+from ..parsers.parser import setup_parser
+from ..saver.saver import setup_saver
+from ..server.server import Server, _mq_client, run_server
+
+_MQ_URL = 'local://pipeline'
+
+
+class Pipeline:
+    """The parsers and the saver of a single node, connected by the in-process message queue
+    (:mod:`cortex.net.mq.local`)
+
+    Every parser and the saver consume in a thread of their own, parsers parse in their own worker processes (or
+    threads), and snapshots are handed to them by publishing with :attr:`mq_client`, which is what the server
+    publishes with. Messages are never serialized to a broker, which saves a process and the round trips to it.
+
+    Note:
+        Messages are only kept in memory, those not saved yet are lost if the process dies.
+
+    Attributes:
+        mq_client (:class:`cortex.net.mq.local.SnapshotClient`): Client to publish snapshots with
+        parsers (:obj:`list`): Parser clients, a :class:`cortex.net.mq.local.ParserClient` per field
+        saver (:class:`cortex.net.mq.local.SaverClient`): Saver client
+
+    Args:
+        database_url (:obj:`str`): Database URL in the format <db_name>://<host>:<port>
+        fields (:obj:`list`): Fields to parse
+        workers (:obj:`int`, optional): Number of parsing workers of every parser
+        pool (:obj:`str`, optional): 'process' or 'thread' parsing workers
+        batch_size (:obj:`int`, optional): Maximal number of messages parsed (and saved) together
+        mq_url (:obj:`str`, optional): URL of the in-process message queue, pipelines with different URLs are
+            isolated
+    """
+    def __init__(self, database_url, fields, workers=1, pool='process', batch_size=1, mq_url=_MQ_URL):
+        # Consumers bind their queues before anything is published, messages matching no queue are dropped
+        self.saver = setup_saver(database_url, mq_url, batch_size=batch_size)
+        self.parsers = [setup_parser(field, mq_url, workers=workers, pool=pool, batch_size=batch_size)
+                        for field in fields]
+        self.mq_client = _mq_client(mq_url)
+        consumers = [(f'parser-{client.parser.field}', client) for client in self.parsers]
+        self.threads = [threading.Thread(target=_consume, args=(client,), name=name, daemon=True)
+                        for name, client in [*consumers, ('saver', self.saver)]]
+
+    def start(self):
+        """Starts consuming"""
+        for thread in self.threads:
+            thread.start()
+
+    def close(self, drain_timeout=30):
+        """Parses and saves the snapshots published so far, then stops the parsers and the saver
+
+        Args:
+            drain_timeout (:obj:`float`, optional): Seconds to wait for the parsers, then the saver, to handle the
+                queued messages
+        """
+        self.mq_client.close()
+        for stage in (self.parsers, [self.saver]):
+            for client in stage:
+                client.queue.join(timeout=drain_timeout)
+            for client in stage:
+                client.close()
+        for thread in self.threads:
+            thread.join()
+
+
+def _consume(client):
+    try:
+        client.consume()
+    except Exception as e:
+        print(e)
+
+
+def run_pipeline(host='127.0.0.1', port=8000, database_url='mongodb://127.0.0.1:27017', parsers=None, workers=1,
+                 pool='process', batch_size=1, engine='flask', blob_store='directory', drain_timeout=30):
+    """Runs the server, the parsers and the saver in a single process, without a message broker
+
+    The server publishes the snapshots it receives to a :class:`Pipeline`. When the server stops (on SIGINT or
+    SIGTERM) the snapshots it accepted are parsed and saved before returning.
+
+    Args:
+        host (:obj:`str`): Hostname of the server
+        port (:obj:`int`): Port of the server
+        database_url (:obj:`str`): Database URL in the format <db_name>://<host>:<port>
+        parsers (:obj:`list`, optional): Fields to parse, defaults to the fields the server supports
+        workers (:obj:`int`, optional): Number of parsing workers of every parser
+        pool (:obj:`str`, optional): 'process' or 'thread' parsing workers
+        batch_size (:obj:`int`, optional): Maximal number of messages parsed (and saved) together
+        engine (:obj:`str`, optional): Server engine, 'flask' or 'asyncio'
+        blob_store (:obj:`str`, optional): Blob store of the uploaded images, 'directory' or 'segment'
+        drain_timeout (:obj:`float`, optional): Seconds to wait for the queued messages to be handled when stopping
+    """
+    Server._CONFIG['PARSERS'] = list(parsers or Server._CONFIG['PARSERS'])
+    Server._CONFIG['BLOB_STORE'] = blob_store
+    pipeline = Pipeline(database_url, Server._CONFIG['PARSERS'], workers=workers, pool=pool, batch_size=batch_size)
+    pipeline.start()
+    handler = None
+    if threading.current_thread() is threading.main_thread():
+        handler = signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        run_server(host, port, pipeline.mq_client.publish, publish_batch=pipeline.mq_client.publish_batch,
+                   engine=engine, queue_depth=pipeline.mq_client.queue_depth)
+    finally:
+        if handler is not None:
+            signal.signal(signal.SIGTERM, handler)
+        pipeline.close(drain_timeout=drain_timeout)
+
+
+def _interrupt(signum, frame):
+    # Stops the server like ^C does
+    raise KeyboardInterrupt
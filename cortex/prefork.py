@@ -0,0 +1,148 @@
+import os
+import signal
+import socket
+import threading
+import time
+from werkzeug.serving import make_server
+
+
+class Supervisor:
+    """Pre-forks worker processes which serve a WSGI application on a shared listening socket
+
+    The supervisor binds the socket, then forks ``workers`` processes which all accept connections on it, so
+    requests are spread over processes (and cores) by the kernel rather than serialized by a single
+    interpreter. Each worker builds its own application by entering the ``worker`` context manager after the
+    fork, which is where it has to open its connections (message queue and database clients must not be
+    shared between processes). A worker which exits is restarted, after a growing delay when it keeps
+    crashing right away.
+
+    SIGTERM or SIGINT shut the supervisor down gracefully: the workers stop accepting connections, finish the
+    requests in flight and exit the ``worker`` context (flushing their clients); workers still running after
+    ``shutdown_timeout`` seconds are killed.
+
+    Note:
+        Forking requires a POSIX system.
+
+    Attributes:
+        host (:obj:`str`): Hostname the workers listen on
+        port (:obj:`int`): Port the workers listen on (the bound port once serving, when 0 was given)
+        workers (:obj:`int`): Number of worker processes
+        pids (:obj:`set`): Process IDs of the running workers
+
+    Args:
+        host (:obj:`str`): Hostname to listen on
+        port (:obj:`int`): Port to listen on, 0 binds an ephemeral port
+        worker (callable): Takes no arguments and returns a context manager which yields a WSGI application,
+            entered in every worker process
+        workers (:obj:`int`): Number of worker processes
+        threaded (:obj:`bool`, optional): Handle every request of a worker in its own thread
+        shutdown_timeout (:obj:`float`, optional): Seconds to wait for the workers to exit when shutting down
+        restart_delay (:obj:`float`, optional): Initial delay before restarting a crashed worker
+    """
+    _BACKLOG = 1024
+    _MAX_RESTART_DELAY = 30
+    _STABLE_AFTER = 10
+
+    def __init__(self, host, port, worker, workers, threaded=True, shutdown_timeout=10, restart_delay=0.5):
+        self.host = host
+        self.port = int(port)
+        self.worker = worker
+        self.workers = workers
+        self.threaded = threaded
+        self.shutdown_timeout = shutdown_timeout
+        self.restart_delay = restart_delay
+        self.pids = set()
+        self.started = threading.Event()
+        self._stopping = threading.Event()
+        self._socket = None
+
+    def run(self):
+        """Starts the workers and supervises them until :meth:`stop` is called or a termination signal arrives"""
+        self._socket = socket.create_server((self.host, self.port), backlog=self._BACKLOG)
+        self._socket.set_inheritable(True)
+        self.port = self._socket.getsockname()[1]
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                handlers[signum] = signal.signal(signum, lambda *args: self._stopping.set())
+        started_at = {}
+        delay = self.restart_delay
+        try:
+            for _ in range(self.workers):
+                pid = self._spawn()
+                started_at[pid] = time.monotonic()
+            self.started.set()
+            while not self._stopping.wait(0.1):
+                for pid in self._reap():
+                    if time.monotonic() - started_at.pop(pid) < self._STABLE_AFTER:
+                        # Back off while workers crash right after starting, e.g. on a refused connection
+                        if self._stopping.wait(delay):
+                            break
+                        delay = min(2 * delay, self._MAX_RESTART_DELAY)
+                    else:
+                        delay = self.restart_delay
+                    pid = self._spawn()
+                    started_at[pid] = time.monotonic()
+        finally:
+            self._shutdown()
+            self._socket.close()
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def stop(self):
+        """Stops the supervisor, may be called from any thread"""
+        self._stopping.set()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._serve()
+                code = 0
+            except BaseException as e:
+                print(e, flush=True)
+            finally:
+                os._exit(code)
+        self.pids.add(pid)
+        return pid
+
+    def _serve(self):
+        # The worker only stops on the supervisor's SIGTERM, ^C in a terminal reaches the whole process group
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        with self.worker() as app:
+            server = make_server(self.host, self.port, app, threaded=self.threaded, fd=self._socket.fileno())
+            # Let the requests in flight complete when shutting down
+            server.daemon_threads = False
+            server.block_on_close = True
+            signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+
+    def _reap(self):
+        exited = []
+        for pid in list(self.pids):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                self.pids.discard(pid)
+                exited.append(pid)
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                print(f'Worker {pid} exited with status {code}')
+        return exited
+
+    def _shutdown(self):
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.pids and time.monotonic() < deadline:
+            for pid in list(self.pids):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    self.pids.discard(pid)
+            time.sleep(0.05)
+        for pid in self.pids:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.pids.clear()
@@ -1,5 +1,5 @@
 import click
-from .saver import _cli_save, _cli_run_saver
+from .saver import _cli_save, _cli_run_saver, _cli_migrate
 from ..utils import strip_str
 
 
@@ -18,10 +18,20 @@ def _save(database, field, data_path):
 
 
 @cli.command(name='run-saver')
+@click.option('--batch-size', type=int, default=1, show_default=True, help='Maximal number of messages saved together')
+@click.option('--batch-timeout', type=float, default=0.5, show_default=True,
+              help='Seconds to wait for a batch to fill up')
 @click.argument('database', type=str, required=True, callback=strip_str)
 @click.argument('message_queue', type=str, required=True, callback=strip_str)
-def _run_saver(database, message_queue):
-    _cli_run_saver(db_url=database, mq_url=message_queue)
+def _run_saver(batch_size, batch_timeout, database, message_queue):
+    _cli_run_saver(db_url=database, mq_url=message_queue, batch_size=batch_size, batch_timeout=batch_timeout)
+
+
+@cli.command(name='migrate')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Snapshots written at a time')
+@click.argument('database', type=str, required=True, callback=strip_str)
+def _migrate(batch_size, database):
+    _cli_migrate(db_url=database, batch_size=batch_size)
 
 
 if __name__ == '__main__':
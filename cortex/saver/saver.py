@@ -33,6 +33,27 @@ class Saver:
         result = self.client.save(field, data)
         return result
 
+    def save_batch(self, results):
+        """Saves a batch of data in one go, merging the fields of the same snapshot
+
+        Args:
+            results (:obj:`list`): (field, data) pairs, the field name and the BSON string of its data
+        Raises:
+            :class:`bson.errors.InvalidBSON`: Data of the batch failed to decode, nothing was saved
+        """
+        decoded = [(field, bson.decode(data)) for field, data in results]
+        return self.client.save_batch(decoded)
+
+    def migrate(self, batch_size=1000):
+        """Migrates the data saved in a former layout of the database to the current one
+
+        Args:
+            batch_size (:obj:`int`, optional): Number of records written at a time
+        Returns:
+            :obj:`int`: Number of records migrated
+        """
+        return self.client.migrate(batch_size=batch_size)
+
 
 def _cli_save(db_url, field, data_path):
     saver = Saver(db_url)
@@ -41,12 +62,36 @@ def _cli_save(db_url, field, data_path):
         saver.save(field, raw_data)
 
 
-def _cli_run_saver(db_url, mq_url):
+def _cli_migrate(db_url, batch_size):
+    saver = Saver(db_url)
+    moved = saver.migrate(batch_size=batch_size)
+    print(f'Migrated {moved} snapshots')
+
+
+def _cli_run_saver(db_url, mq_url, batch_size=1, batch_timeout=0.5):
+    mq_client = setup_saver(db_url, mq_url, batch_size=batch_size, batch_timeout=batch_timeout)
+    mq_client.consume()
+
+
+def setup_saver(db_url, mq_url, batch_size=1, batch_timeout=0.5):
+    """Sets up a message queue client with a saver of the given database as a consumer
+
+    The saver client is dynamically imported from the :mod:`cortex.net.mq` module according to the message queue
+    URL scheme, for example a SaverClient is imported from :mod:`cortex.net.mq.rabbitmq` for 'rabbitmq://...'.
+
+    Args:
+        db_url (:obj:`str`): Database URL in the format <db_name>://<host>:<port>
+        mq_url (:obj:`str`): Message queue URL in the format <mq_name>://<host>:<port>
+        batch_size (:obj:`int`, optional): Maximal number of messages saved together
+        batch_timeout (:obj:`float`, optional): Seconds to wait for a batch to fill up before saving it
+
+    Returns:
+        SaverClient
+    """
     saver = Saver(db_url)
 
     # Import message queue module
     mq_scheme, mq_host, mq_port = parse_url(mq_url)
     mq_module = importlib.import_module(name=f'..net.mq.{mq_scheme}',
-                                        package='cortex.server')
-    mq_client = mq_module.SaverClient(mq_host, mq_port, saver)
-    mq_client.consume()
+                                        package='cortex.saver')
+    return mq_module.SaverClient(mq_host, mq_port, saver, batch_size=batch_size, batch_timeout=batch_timeout)
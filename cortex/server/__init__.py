@@ -1 +1,2 @@
-from .server import run_server, Server
\ No newline at end of file
+from .server import run_server, Server
+from .async_server import AsyncServer
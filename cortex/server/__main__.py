@@ -12,9 +12,23 @@ def cli():
 @click.option('--host', '-h', type=str, default='127.0.0.1', show_default=True, callback=strip_str,
               help='Server IP address')
 @click.option('--port', '-p', type=str, default=8000, show_default=True, help='Server port')
+@click.option('--confirms/--no-confirms', default=False, show_default=True,
+              help='Wait for the message queue to confirm every published message')
+@click.option('--engine', '-e', type=click.Choice(['flask', 'asyncio']), default='flask', show_default=True,
+              help='Server implementation, asyncio streams uploads to disk as they arrive')
+@click.option('--max-uploads', type=int, default=16, show_default=True,
+              help='Uploads received concurrently by the asyncio engine')
+@click.option('--write-behind/--no-write-behind', default=False, show_default=True,
+              help='Respond once the uploaded images are queued for writing, publish once they are on disk '
+                   '(flask engine)')
+@click.option('--blob-store', '-b', type=click.Choice(['directory', 'segment']), default='directory',
+              show_default=True, help='Layout of the uploaded images, a file each or packed per user segments')
+@click.option('--workers', '-w', type=int, default=1, show_default=True,
+              help='Worker processes of the flask engine, sharing the listening socket')
 @click.argument('message_queue', type=str, required=True, callback=strip_str)
-def _run_server(host, port, message_queue):
-    _cli_run_server(host=host, port=port, message_queue=message_queue)
+def _run_server(host, port, confirms, engine, max_uploads, write_behind, blob_store, workers, message_queue):
+    _cli_run_server(host=host, port=port, message_queue=message_queue, confirms=confirms, engine=engine,
+                    max_uploads=max_uploads, write_behind=write_behind, blob_store=blob_store, workers=workers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import threading
+
+
+class AdmissionControl:
+    """Decides whether the server takes another upload or asks the client to come back later
+
+    Two signals are watched. The first is the number of uploads the server is busy with: uploads being received,
+    plus the uploads accepted by the write-behind writer and not published yet (``backlog``). The second is the
+    depth of the downstream queues (``queue_depth``), which grows when the parsers fall behind. An upload is
+    rejected while the uploads in flight reach ``max_in_flight``, and once the queue depth reaches
+    ``queue_high`` until it drains back to ``queue_low``, so the server doesn't flap around a single
+    watermark. Rejected uploads are told to retry after ``retry_after`` seconds.
+
+    Args:
+        max_in_flight (:obj:`int`, optional): Maximal number of uploads in flight, 0 for no limit
+        queue_high (:obj:`int`, optional): Queue depth from which uploads are rejected, 0 ignores the queue depth
+        queue_low (:obj:`int`, optional): Queue depth under which uploads are accepted again
+        retry_after (:obj:`int`, optional): Seconds rejected clients are asked to wait
+        queue_depth (:obj:`function`, optional): Returns the current depth of the downstream queues
+        backlog (:obj:`function`, optional): Returns the number of accepted uploads not processed yet
+    """
+    def __init__(self, max_in_flight=0, queue_high=0, queue_low=0, retry_after=1, queue_depth=None, backlog=None):
+        self.max_in_flight = max_in_flight
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+        self.backlog = backlog or (lambda: 0)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.overloaded = False
+
+    @staticmethod
+    def from_config(config, queue_depth=None, backlog=None):
+        """Creates an admission control from the server configuration (see :attr:`cortex.server.Server._CONFIG`)"""
+        return AdmissionControl(max_in_flight=config['ADMISSION_MAX_IN_FLIGHT'],
+                                queue_high=config['ADMISSION_QUEUE_HIGH'],
+                                queue_low=config['ADMISSION_QUEUE_LOW'],
+                                retry_after=config['ADMISSION_RETRY_AFTER'],
+                                queue_depth=queue_depth, backlog=backlog)
+
+    def admit(self):
+        """Admits an upload, which has to be released by :meth:`release` once handled
+
+        Returns:
+            :obj:`int`: None when the upload is admitted, otherwise the number of seconds to retry after
+        """
+        with self.lock:
+            if self.queue_high and self.queue_depth is not None:
+                depth = self.queue_depth()
+                if depth >= self.queue_high:
+                    self.overloaded = True
+                elif depth <= self.queue_low:
+                    self.overloaded = False
+                if self.overloaded:
+                    return self.retry_after
+            if self.max_in_flight and self.in_flight + self.backlog() >= self.max_in_flight:
+                return self.retry_after
+            self.in_flight += 1
+        return None
+
+    def release(self):
+        """Releases an upload admitted by :meth:`admit`"""
+        with self.lock:
+            self.in_flight -= 1
@@ -1,39 +1,133 @@
+import functools
 import flask
 import bson
-from pathlib import Path
 from . import app
+from .. import metrics, publishing, storage
 from ...net import protocol
 
 
 @app.route('/config', methods=['GET'])
 def get_config():
-    config_string = protocol.Config(app.config['PARSERS']).to_bson()
+    config_string = protocol.Config(app.config['PARSERS'], app.config['MAX_BATCH_SIZE'], progress=True,
+                                    formats=list(protocol.WIRE_FORMATS)).to_bson()
     return bson.encode(config_string)
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return flask.Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.after_request
+def count_request(response):
+    route = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unmatched'
+    metrics.REQUESTS.inc(route, str(response.status_code))
+    metrics.REQUEST_BYTES.inc(route, amount=flask.request.content_length or 0)
+    return response
+
+
+@app.route('/progress/<int:user_id>', methods=['GET'])
+def get_progress(user_id):
+    progress = protocol.Progress(user_id, app.config['PROGRESS_LOG'].accepted(user_id)).to_bson()
+    return bson.encode(progress)
+
+
+def _admitted(route):
+    """Rejects uploads with 429 Too Many Requests and a Retry-After header while the server is overloaded"""
+    @functools.wraps(route)
+    def admitted_route(*args, **kwargs):
+        admission = app.config['ADMISSION']
+        retry_after = admission.admit()
+        if retry_after is not None:
+            response = flask.make_response('Server is overloaded', 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        try:
+            return route(*args, **kwargs)
+        finally:
+            admission.release()
+    return admitted_route
+
+
 @app.route('/snapshot', methods=['POST'])
+@_admitted
 def post_snapshot():
-    data = bson.decode(flask.request.data)
     try:
+        data = _decode_request()
         user, snapshot = data['user'], data['snapshot']
-        fields = app.config['PARSERS']
-        data_dir = Path(app.config['DATA_FOLDER'])
-        user_dir = data_dir / str(user['uid']) / snapshot['timestamp_ms'].strftime('%Y-%m-%d_%H-%M-%S-%f')
-        user_dir.mkdir(parents=True, exist_ok=True)
-
-        if 'image_color' in fields:
-            image_path = user_dir / 'image_color.raw'
-            with image_path.open(mode='wb') as fd:
-                fd.write(snapshot['image_color']['image_color'])
-            snapshot['image_color']['image_color'] = str(image_path)
-
-        if 'image_depth' in fields:
-            image_path = user_dir / 'image_depth.raw'
-            with image_path.open(mode='wb') as fd:
-                fd.write(snapshot['image_depth']['image_depth'])
-            snapshot['image_depth']['image_depth'] = str(image_path)
-
-        app.config['PUBLISH_MESSAGE'](data)
+    except (KeyError, ValueError, TypeError, bson.InvalidBSON) as e:
+        return _malformed(e)
+    return _ingest(user, [snapshot], lambda: app.config['PUBLISH_MESSAGE'](data))
+
+
+@app.route('/snapshots', methods=['POST'])
+@_admitted
+def post_snapshots():
+    try:
+        data = _decode_request()
+        user, snapshots = data['user'], data['snapshots']
+    except (KeyError, ValueError, TypeError, bson.InvalidBSON) as e:
+        return _malformed(e)
+    if len(snapshots) > app.config['MAX_BATCH_SIZE']:
+        return flask.make_response(f'Batch exceeds {app.config["MAX_BATCH_SIZE"]} snapshots', 413)
+    messages = [{'user': user, 'snapshot': snapshot} for snapshot in snapshots]
+    return _ingest(user, snapshots, lambda: app.config['PUBLISH_BATCH'](messages))
+
+
+def _malformed(error):
+    print(error)
+    return flask.make_response(f'Malformed upload: {error}', 400)
+
+
+def _decode_request():
+    """Decodes the request body according to its content type, BSON by default"""
+    wire_format = 'frame' if flask.request.content_type == protocol.WIRE_FORMATS['frame'] else 'bson'
+    data = flask.request.get_data()
+    with metrics.DECODE_SECONDS.time():
+        return protocol.decode_message(data, wire_format)
+
+
+def _ingest(user, snapshots, publish):
+    """Stores the raw image data of snapshots, then publishes them and records them as accepted
+
+    Snapshots are only recorded once the message queue has them (see :func:`cortex.server.publishing.publish`).
+    With a write-behind BLOB_WRITER the blobs are queued and the rest happens once they are on disk,
+    otherwise everything happens before returning, waiting up to PUBLISH_TIMEOUT seconds for the publish.
+
+    Returns:
+        The response: 400 for malformed snapshots, 500 when storing the blobs failed and 503 when publishing
+        failed (clients retry it), snapshots answered with an error are not recorded as accepted
+    """
+    try:
+        writes = []
+        for snapshot in snapshots:
+            writes += storage.snapshot_writes(app.config['PARSERS'], user, snapshot)
+        uid = user['uid']
+        timestamps = [protocol.timestamp_key(snapshot['timestamp_ms']) for snapshot in snapshots]
+    except (KeyError, ValueError, TypeError) as e:
+        return _malformed(e)
+    progress_log = app.config['PROGRESS_LOG']
+    metrics.count_snapshots(snapshots)
+
+    def on_durable():
+        return publishing.publish(publish, lambda: progress_log.record(uid, timestamps))
+
+    if app.config['BLOB_WRITER'] is not None:
+        app.config['BLOB_WRITER'].submit(writes, lambda: on_durable().add_done_callback(_report_failure))
+        return ''
+    try:
+        storage.write_blobs(app.config['BLOB_STORE'], writes)
+    except OSError as e:
+        print(e)
+        return flask.make_response('Failed to store the snapshots', 500)
+    try:
+        on_durable().result(timeout=app.config['PUBLISH_TIMEOUT'])
     except Exception as e:
         print(e)
+        return flask.make_response('Failed to publish the snapshots', 503)
     return ''
+
+
+def _report_failure(published):
+    if published.exception() is not None:
+        print(published.exception())
@@ -0,0 +1,286 @@
+import asyncio
+import functools
+import re
+import threading
+import time
+import bson
+import numpy as np
+from http import HTTPStatus
+
+from . import metrics, publishing, storage
+from .admission import AdmissionControl
+from .progress import ProgressLog
+from ..net import blobstore, protocol
+
+
+class AsyncServer:
+    """An asyncio server serving the same routes as :class:`cortex.server.Server`
+
+    The server speaks a minimal HTTP/1.1 (keep-alive, Content-Length bodies) on top of :mod:`asyncio` streams, so
+    an upload in flight costs a coroutine rather than a thread. Frame uploads (see
+    :func:`cortex.net.protocol.encode_message`) are decoded as they arrive: the image sections are streamed to
+    the blob store in chunks and never held in memory as a whole. BSON uploads can't be decoded
+    incrementally and are read whole. At most ``max_uploads`` uploads are received at a time, further uploads
+    wait for a slot. Uploads past the admission watermarks (see :class:`cortex.server.admission.AdmissionControl`)
+    are rejected with 429 Too Many Requests, malformed uploads with 400 Bad Request, uploads whose blobs failed to
+    be stored with 500 Internal Server Error and uploads which failed to be published with 503 Service Unavailable.
+    Writing files and publishing are blocking calls, they run in the event loop's default executor.
+
+    Attributes:
+        host (:obj:`str`): Hostname of the server
+        port (:obj:`int`): Port of the server (the bound port once serving, when 0 was given)
+        config (:obj:`dict`): Server configuration (see :attr:`cortex.server.Server._CONFIG`)
+        blob_store (:class:`cortex.net.blobstore.BlobStore`): Store of the raw image data
+        admission (:class:`cortex.server.admission.AdmissionControl`): Admission control of the uploads
+
+    Args:
+        host (:obj:`str`): Hostname of the server
+        port (:obj:`int`): Port of the server, 0 binds an ephemeral port
+        publish (:obj:`function`): Publish function, takes a message and publishes it
+        publish_batch (:obj:`function`, optional): Batch publish function, takes a list of messages and
+            publishes them. Defaults to calling publish on each message.
+        max_uploads (:obj:`int`, optional): Maximal number of uploads received concurrently
+        config (:obj:`dict`, optional): Server configuration, defaults to :attr:`cortex.server.Server._CONFIG`
+        queue_depth (:obj:`function`, optional): Returns the depth of the downstream queues
+    """
+    _CHUNK_SIZE = 1 << 20
+    _MAX_HEADER_SIZE = 1 << 16
+    _PROGRESS_ROUTE = re.compile(r'/progress/(\d+)')
+
+    def __init__(self, host, port, publish, publish_batch=None, max_uploads=16, config=None, queue_depth=None):
+        from .server import Server
+        self.host = host
+        self.port = port
+        self.publish = publish
+        self.publish_batch = publish_batch or (lambda messages: [publish(message) for message in messages])
+        self.max_uploads = max_uploads
+        self.config = dict(config or Server._CONFIG)
+        self.progress_log = ProgressLog(self.config['DATA_FOLDER'])
+        self.blob_store = blobstore.open_store(self.config['BLOB_STORE'], self.config['DATA_FOLDER'])
+        self.admission = AdmissionControl.from_config(self.config, queue_depth=queue_depth)
+        metrics.IN_FLIGHT.set_function(lambda: self.admission.in_flight)
+        self.started = threading.Event()
+        self._loop = None
+        self._stop = None
+        self._uploads = None
+
+    def start(self):
+        """Runs the server until :meth:`stop` is called"""
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """Stops the server, may be called from any thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def serve(self):
+        """Serves requests until :meth:`stop` is called"""
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._uploads = asyncio.Semaphore(self.max_uploads)
+        server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                            limit=self._MAX_HEADER_SIZE)
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        async with server:
+            await self._stop.wait()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                method, path, headers = self._parse_head(head)
+                if method is None:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, close=True)
+                    break
+                close = headers.get('connection', '').lower() == 'close'
+                response_headers = {}
+                try:
+                    status, body, response_headers = await self._dispatch(method, path, headers, reader)
+                except (KeyError, ValueError, TypeError, bson.InvalidBSON) as e:
+                    # The rest of the body can't be told apart from the next request
+                    print(e)
+                    status, body, close = HTTPStatus.BAD_REQUEST, b'', True
+                except ConnectionError:
+                    raise
+                except OSError as e:
+                    # Storing a blob failed, possibly before the whole body was read
+                    print(e)
+                    status, body, close = HTTPStatus.INTERNAL_SERVER_ERROR, b'Failed to store the snapshots', True
+                metrics.REQUESTS.inc(self._route(method, path), str(status.value))
+                metrics.REQUEST_BYTES.inc(self._route(method, path), amount=int(headers.get('content-length', 0)))
+                await self._respond(writer, status, body, close=close, headers=response_headers)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_head(head):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, path, _ = lines[0].split(' ', 2)
+        except ValueError:
+            return None, None, None
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, path.split('?', 1)[0], headers
+
+    def _route(self, method, path):
+        if path in ('/config', '/metrics', '/snapshot', '/snapshots'):
+            return path
+        return '/progress/<int:user_id>' if self._PROGRESS_ROUTE.fullmatch(path) else 'unmatched'
+
+    @staticmethod
+    async def _respond(writer, status, body=b'', close=False, headers=None):
+        head = f'HTTP/1.1 {status.value} {status.phrase}\r\nContent-Length: {len(body)}\r\n'
+        for name, value in (headers or {}).items():
+            head += f'{name}: {value}\r\n'
+        if close:
+            head += 'Connection: close\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        await writer.drain()
+
+    async def _dispatch(self, method, path, headers, reader):
+        if method == 'GET' and path == '/config':
+            config = protocol.Config(self.config['PARSERS'], self.config['MAX_BATCH_SIZE'], progress=True,
+                                     formats=list(protocol.WIRE_FORMATS))
+            return HTTPStatus.OK, bson.encode(config.to_bson()), {}
+        if method == 'GET' and path == '/metrics':
+            return HTTPStatus.OK, metrics.REGISTRY.render().encode(), {'Content-Type': metrics.CONTENT_TYPE}
+        progress_route = self._PROGRESS_ROUTE.fullmatch(path)
+        if method == 'GET' and progress_route:
+            uid = int(progress_route.group(1))
+            accepted = await self._run(self.progress_log.accepted, uid)
+            return HTTPStatus.OK, bson.encode(protocol.Progress(uid, accepted).to_bson()), {}
+        if method == 'POST' and path in ('/snapshot', '/snapshots'):
+            if 'content-length' not in headers:
+                raise ValueError('Uploads without a Content-Length are not supported')
+            retry_after = self.admission.admit()
+            if retry_after is not None:
+                await self._discard(reader, int(headers['content-length']))
+                return HTTPStatus.TOO_MANY_REQUESTS, b'Server is overloaded', {'Retry-After': str(retry_after)}
+            try:
+                async with self._uploads:
+                    return (*await self._receive(path, headers, reader, int(headers['content-length'])), {})
+            finally:
+                self.admission.release()
+        await self._discard(reader, int(headers.get('content-length', 0)))
+        return HTTPStatus.NOT_FOUND, b'', {}
+
+    async def _receive(self, path, headers, reader, length):
+        frame = headers.get('content-type') == protocol.WIRE_FORMATS['frame']
+        if frame:
+            data, lengths = await self._read_frame_head(reader, length)
+        else:
+            body = await reader.readexactly(length)
+            with metrics.DECODE_SECONDS.time():
+                data = protocol.decode_message(body)
+        user = data['user']
+        snapshots = [data['snapshot']] if path == '/snapshot' else data['snapshots']
+        if len(snapshots) > self.config['MAX_BATCH_SIZE'] and path == '/snapshots':
+            if frame:
+                await self._discard(reader, sum(lengths))
+            return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, \
+                f'Batch exceeds {self.config["MAX_BATCH_SIZE"]} snapshots'.encode()
+
+        if frame:
+            data = await self._read_sections(reader, data, snapshots, lengths)
+            user = data['user']
+            snapshots = [data['snapshot']] if path == '/snapshot' else data['snapshots']
+        metrics.count_snapshots(snapshots)
+        if not frame:
+            await self._run(self._store, user, snapshots)
+        try:
+            published = await self._run(self._publish, user, snapshots, path == '/snapshot')
+            await asyncio.wait_for(asyncio.wrap_future(published), self.config['PUBLISH_TIMEOUT'])
+        except Exception as e:
+            print(e)
+            return HTTPStatus.SERVICE_UNAVAILABLE, b'Failed to publish the snapshots'
+        return HTTPStatus.OK, b''
+
+    def _store(self, user, snapshots):
+        for snapshot in snapshots:
+            storage.store_snapshot(self.blob_store, self.config['PARSERS'], user, snapshot)
+
+    def _publish(self, user, snapshots, single):
+        if single:
+            publish = functools.partial(self.publish, {'user': user, 'snapshot': snapshots[0]})
+        else:
+            publish = functools.partial(self.publish_batch, [{'user': user, 'snapshot': snapshot}
+                                                             for snapshot in snapshots])
+        timestamps = [protocol.timestamp_key(snapshot['timestamp_ms']) for snapshot in snapshots]
+        return publishing.publish(publish, lambda: self.progress_log.record(user['uid'], timestamps))
+
+    async def _read_frame_head(self, reader, length):
+        metadata_length, count = protocol.decode_frame_header(await reader.readexactly(protocol.FRAME_HEADER_SIZE))
+        metadata = await reader.readexactly(metadata_length)
+        with metrics.DECODE_SECONDS.time():
+            metadata = bson.decode(metadata)
+        lengths = np.frombuffer(await reader.readexactly(8 * count), dtype='<u8').tolist()
+        if protocol.FRAME_HEADER_SIZE + metadata_length + 8 * count + sum(lengths) != length:
+            raise ValueError('Frame size does not match the Content-Length')
+        return metadata, lengths
+
+    async def _read_sections(self, reader, metadata, snapshots, lengths):
+        # Route the sections of the stored image fields straight to the blob store
+        targets = {}
+        for snapshot in snapshots:
+            for key, image, field in storage.snapshot_writes(self.config['PARSERS'], metadata['user'], snapshot):
+                index = protocol.section_index(image[field])
+                if index is not None:
+                    targets[index] = (key, image, field)
+
+        sections = []
+        for index, section_length in enumerate(lengths):
+            if index in targets:
+                key, image, field = targets[index]
+                image[field] = await self._stream_to_store(reader, section_length, key)
+                sections.append(None)
+            else:
+                sections.append(await reader.readexactly(section_length))
+        return protocol.restore_sections(metadata, sections)
+
+    async def _discard(self, reader, length):
+        while length > 0:
+            chunk = await reader.read(min(length, self._CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', length)
+            length -= len(chunk)
+
+    async def _stream_to_store(self, reader, length, key):
+        # Only the time spent writing counts as blob write latency, not the time waiting for the client
+        start = time.perf_counter()
+        blob = await self._run(self.blob_store.create, key, length)
+        elapsed = time.perf_counter() - start
+        try:
+            while length > 0:
+                chunks, size = [], 0
+                while size < min(length, self._CHUNK_SIZE):
+                    chunk = await reader.read(min(length, self._CHUNK_SIZE) - size)
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', length - size)
+                    chunks.append(chunk)
+                    size += len(chunk)
+                start = time.perf_counter()
+                await self._run(blob.write, b''.join(chunks))
+                elapsed += time.perf_counter() - start
+                length -= size
+        except BaseException:
+            await self._run(blob.abort)
+            raise
+        start = time.perf_counter()
+        ref = await self._run(blob.commit)
+        metrics.BLOB_WRITE_SECONDS.observe(elapsed + time.perf_counter() - start)
+        return ref
+
+    async def _run(self, function, *args, **kwargs):
+        return await self._loop.run_in_executor(None, lambda: function(*args, **kwargs))
@@ -0,0 +1,363 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Sharded:
+    """Base class of the metrics updated without locking
+
+    Every thread updates its own shard of the values (held in a thread local), so an update is a dictionary or list
+    update with no lock and no contention. The lock is only taken the first time a thread updates the metric and
+    when the shards are summed up for :meth:`collect`. Shards of threads which ended are folded into a single one,
+    the server runs a thread per request.
+    """
+    _FOLD_AT = 256
+
+    def __init__(self, name, documentation, kind):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = self._new_shard()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def _merge(total, shard):
+        raise NotImplementedError
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new_shard()
+            with self._lock:
+                if len(self._shards) >= self._FOLD_AT:
+                    self._fold()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _fold(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self._retired, shard)
+        self._shards = alive
+
+    def _total(self):
+        with self._lock:
+            self._fold()
+            total = self._new_shard()
+            self._merge(total, self._retired)
+            for _, shard in self._shards:
+                self._merge(total, shard)
+        return total
+
+    def _reset(self):
+        with self._lock:
+            self._local = threading.local()
+            self._shards = []
+            self._retired = self._new_shard()
+
+    def dump(self):
+        """Returns the values of the metric in this process, as JSON serializable data"""
+        raise NotImplementedError
+
+    def collect(self, dumps=None):
+        """Returns the lines of the metric in the Prometheus text format
+
+        Args:
+            dumps (:obj:`list`, optional): :meth:`dump` results of several processes, which are summed up rather
+                than collecting the values of this process
+        """
+        raise NotImplementedError
+
+
+class Counter(_Sharded):
+    """Monotonic counter, optionally split by labels
+
+    Args:
+        name (:obj:`str`): Metric name
+        documentation (:obj:`str`): Metric help text
+        labels (:obj:`tuple`, optional): Label names
+    """
+    def __init__(self, name, documentation, labels=()):
+        self.labels = tuple(labels)
+        super().__init__(name, documentation, 'counter')
+
+    def _new_shard(self):
+        return {}
+
+    @staticmethod
+    def _merge(total, shard):
+        # dict.copy() doesn't release the GIL, the owner thread can't resize the shard under it
+        for key, value in shard.copy().items():
+            total[key] = total.get(key, 0) + value
+
+    def inc(self, *label_values, amount=1):
+        """Increments the counter
+
+        Args:
+            *label_values: Values of the counter labels, in order
+            amount (:obj:`float`, optional): Increment
+        """
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        """Returns the current value of the counter"""
+        return self._total().get(label_values, 0)
+
+    def dump(self):
+        return [[list(key), value] for key, value in self._total().items()]
+
+    def collect(self, dumps=None):
+        if dumps is None:
+            total = self._total()
+        else:
+            total = {}
+            for dump in dumps:
+                self._merge(total, {tuple(key): value for key, value in dump})
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+                for key, value in sorted(total.items())]
+
+
+class Histogram(_Sharded):
+    """Histogram of observed values (latencies in seconds)
+
+    Args:
+        name (:obj:`str`): Metric name
+        documentation (:obj:`str`): Metric help text
+        buckets (:obj:`tuple`, optional): Sorted upper bounds of the buckets, +Inf is implied
+    """
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, 'histogram')
+
+    def _new_shard(self):
+        # A count per bucket (and +Inf), then the sum of the observed values
+        return [0] * (len(self.buckets) + 2)
+
+    @staticmethod
+    def _merge(total, shard):
+        for i, value in enumerate(shard):
+            total[i] += value
+
+    def observe(self, value):
+        """Records an observed value"""
+        shard = self._shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """Context manager which observes the time it took to run its block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def count(self):
+        """Returns the number of observed values"""
+        return sum(self._total()[:-1])
+
+    def dump(self):
+        return self._total()
+
+    def collect(self, dumps=None):
+        if dumps is None:
+            total = self._total()
+        else:
+            total = self._new_shard()
+            for dump in dumps:
+                self._merge(total, dump)
+        lines, cumulative = [], 0
+        for bound, count in zip((*self.buckets, '+Inf'), total[:-1]):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_sum {_number(total[-1])}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from a function when collected
+
+    Args:
+        name (:obj:`str`): Metric name
+        documentation (:obj:`str`): Metric help text
+    """
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.kind = 'gauge'
+        self.function = lambda: 0
+
+    def set_function(self, function):
+        """Sets the function returning the value of the gauge"""
+        self.function = function
+
+    def dump(self):
+        return self.function()
+
+    def collect(self, dumps=None):
+        return [f'{self.name} {_number(self.function() if dumps is None else sum(dumps))}']
+
+
+class Registry:
+    """A set of metrics exposed together
+
+    Processes which serve the same metrics (the pre-forked workers of a server, see
+    :class:`cortex.prefork.Supervisor`) aggregate them by sharing a directory (see :meth:`share`): every process
+    dumps its values into a file of its own, and :meth:`render` sums the files up, whichever process renders them.
+    Counters and histograms of the processes which exited are kept, so the totals never go down, gauges only sum
+    up the running processes.
+
+    Attributes:
+        directory (:obj:`pathlib.Path`): Directory the metrics are shared in, None when they are not shared
+    """
+    def __init__(self):
+        self.metrics = []
+        self.directory = None
+        self._path = None
+        self._dump_lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric to the registry and returns it"""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Renders the metrics in the Prometheus text exposition format
+
+        Returns:
+            :obj:`str`: Metrics text
+        """
+        dumps = self._load() if self.directory is not None else None
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.collect(None if dumps is None else dumps[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+    def share(self, directory, interval=1.0):
+        """Shares the metrics with the other processes sharing the directory, from zero
+
+        The values are dumped every ``interval`` seconds, so the other processes render values up to
+        ``interval`` seconds old, and this process renders its own as they are. Values counted before sharing
+        (by the parent of a forked process) are dropped.
+
+        Args:
+            directory (:obj:`str`): Directory shared by the processes
+            interval (:obj:`float`, optional): Seconds between dumps of the values of this process
+        """
+        for metric in self.metrics:
+            if isinstance(metric, _Sharded):
+                metric._reset()
+        self.directory = Path(directory)
+        # Named after the process and its start, a recycled PID doesn't overwrite an exited process' values
+        self._path = self.directory / f'{os.getpid()}-{time.time_ns()}.json'
+        self.dump()
+        threading.Thread(target=self._dump_every, args=(interval,), name='metrics-dump', daemon=True).start()
+
+    def dump(self):
+        """Dumps the values of this process into the shared directory, see :meth:`share`"""
+        if self._path is None:
+            return
+        values = json.dumps({metric.name: metric.dump() for metric in self.metrics})
+        temp_path = self._path.with_suffix('.tmp')
+        with self._dump_lock:
+            temp_path.write_text(values)
+            os.replace(temp_path, self._path)
+
+    def _dump_every(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(e)
+
+    def _load(self):
+        # Dumps of every process sharing the directory, by metric name
+        self.dump()
+        dumps = {metric.name: [] for metric in self.metrics}
+        kinds = {metric.name: metric.kind for metric in self.metrics}
+        for path in self.directory.glob('*.json'):
+            try:
+                values = json.loads(path.read_text())
+            except (OSError, ValueError):
+                # Removed or replaced under us
+                continue
+            alive = _alive(int(path.stem.split('-')[0]))
+            for name, dump in values.items():
+                if name in dumps and (alive or kinds[name] != 'gauge'):
+                    dumps[name].append(dump)
+        return dumps
+
+
+def count_snapshots(snapshots):
+    """Counts accepted snapshots and their fields"""
+    for snapshot in snapshots:
+        SNAPSHOTS.inc()
+        for field in snapshot:
+            if field != 'timestamp_ms':
+                SNAPSHOT_FIELDS.inc(field)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+REGISTRY = Registry()
+REQUESTS = REGISTRY.register(Counter('cortex_server_requests_total', 'HTTP requests handled',
+                                     ('route', 'status')))
+REQUEST_BYTES = REGISTRY.register(Counter('cortex_server_request_bytes_total', 'Bytes of the HTTP request bodies',
+                                          ('route',)))
+SNAPSHOTS = REGISTRY.register(Counter('cortex_server_snapshots_total', 'Snapshots accepted'))
+SNAPSHOT_FIELDS = REGISTRY.register(Counter('cortex_server_snapshot_fields_total',
+                                            'Fields of the accepted snapshots', ('field',)))
+PUBLISH_FAILURES = REGISTRY.register(Counter('cortex_server_publish_failures_total',
+                                             'Uploads whose snapshots failed to publish'))
+IN_FLIGHT = REGISTRY.register(Gauge('cortex_server_in_flight_requests', 'Uploads being handled'))
+DECODE_SECONDS = REGISTRY.register(Histogram('cortex_server_decode_seconds', 'Upload body decoding latency'))
+BLOB_WRITE_SECONDS = REGISTRY.register(Histogram('cortex_server_blob_write_seconds',
+                                                 'Latency of writing a raw image blob'))
+BLOB_WRITE_FAILURES = REGISTRY.register(Counter('cortex_server_blob_write_failures_total',
+                                                'Write-behind jobs whose raw image blobs failed to be written'))
+PUBLISH_SECONDS = REGISTRY.register(Histogram('cortex_server_publish_seconds', 'Upload publishing latency'))
@@ -0,0 +1,51 @@
+import threading
+import numpy as np
+from pathlib import Path
+
+
+class ProgressLog:
+    """Per-user log of the snapshots accepted by the server
+
+    Each user has an append-only file under the data folder (``<data_folder>/<uid>/accepted.log``) holding the
+    timestamp keys (see :func:`cortex.net.protocol.timestamp_key`) of its published snapshots as
+    little endian int64 values.
+
+    Args:
+        data_folder (:obj:`str`): Root folder of the server data
+    """
+    def __init__(self, data_folder):
+        self.data_folder = Path(data_folder)
+        self.lock = threading.Lock()
+
+    def _path(self, uid):
+        return self.data_folder / str(uid) / 'accepted.log'
+
+    def record(self, uid, timestamps):
+        """Records snapshots as accepted
+
+        Args:
+            uid (:obj:`int`): User ID
+            timestamps (:obj:`list`): Timestamp keys of the accepted snapshots
+        """
+        path = self._path(uid)
+        data = np.asarray(timestamps, dtype='<i8').tobytes()
+        with self.lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with path.open(mode='ab') as fd:
+                fd.write(data)
+
+    def accepted(self, uid):
+        """Returns the timestamp keys of the snapshots accepted for a user
+
+        Args:
+            uid (:obj:`int`): User ID
+        Returns:
+            :obj:`numpy.ndarray`: int64 array of timestamp keys
+        """
+        path = self._path(uid)
+        with self.lock:
+            if not path.exists():
+                return np.empty(0, dtype='<i8')
+            data = path.read_bytes()
+        # Ignore a partially written trailing record
+        return np.frombuffer(data, dtype='<i8', count=len(data) // 8)
@@ -0,0 +1,66 @@
+import concurrent.futures
+import threading
+import time
+from . import metrics
+
+
+def publish(publish_function, on_published):
+    """Publishes with a publish function of the server, then calls ``on_published`` once the messages are published
+
+    Publish functions either return once the messages are published, or return a
+    :class:`concurrent.futures.Future` (a list of them for a batch) completed once they are, as
+    :class:`cortex.net.mq.rabbitmq.SnapshotClient` does. The publish latency (PUBLISH_SECONDS) is measured until
+    every message is published, and failures are counted in PUBLISH_FAILURES.
+
+    Args:
+        publish_function (:obj:`function`): Takes no arguments and publishes the messages
+        on_published (:obj:`function`): Called once every message is published, not called if any failed
+    Returns:
+        :class:`concurrent.futures.Future`: Completed after ``on_published`` returned, or failed with the error of
+        the publish
+    """
+    done = concurrent.futures.Future()
+    start = time.perf_counter()
+    try:
+        result = publish_function()
+    except Exception as e:
+        _fail(done, e)
+        return done
+    pending = [future for future in (result if isinstance(result, list) else [result])
+               if isinstance(future, concurrent.futures.Future)]
+    if not pending:
+        _complete(done, start, on_published)
+        return done
+
+    lock = threading.Lock()
+    remaining = [len(pending)]
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        errors = [future.exception() for future in pending if future.exception() is not None]
+        if errors:
+            _fail(done, errors[0])
+        else:
+            _complete(done, start, on_published)
+
+    for future in pending:
+        future.add_done_callback(on_done)
+    return done
+
+
+def _complete(done, start, on_published):
+    metrics.PUBLISH_SECONDS.observe(time.perf_counter() - start)
+    try:
+        on_published()
+    except Exception as e:
+        done.set_exception(e)
+    else:
+        done.set_result(None)
+
+
+def _fail(done, error):
+    metrics.PUBLISH_FAILURES.inc()
+    done.set_exception(error)
@@ -1,4 +1,14 @@
+import contextlib
 import importlib
+import shutil
+import tempfile
+from . import metrics
+from .admission import AdmissionControl
+from .async_server import AsyncServer
+from .progress import ProgressLog
+from .writer import BlobWriter
+from ..net import blobstore
+from ..prefork import Supervisor
 from ..utils import parse_url
 
 
@@ -10,30 +20,77 @@ class Server:
         host (:obj:`str`): Hostname of the server
         port (:obj:`int`): Port of the server
         publish (function): Publish function, takes a message and publishes it
+        publish_batch (function): Batch publish function, takes a list of messages and publishes them
+        blob_store (:class:`cortex.net.blobstore.BlobStore`): Store of the raw image data under the data folder,
+            selected by the BLOB_STORE configuration ('directory' or 'segment')
+        blob_writer (:class:`cortex.server.writer.BlobWriter`): Write-behind writer of the raw snapshot data,
+            None unless the WRITE_BEHIND configuration is set (snapshots are then published once their data is
+            on disk, after the request returned)
+        admission (:class:`cortex.server.admission.AdmissionControl`): Admission control of the uploads, which
+            are rejected with 429 Too Many Requests past the ADMISSION_* watermarks
 
     Args:
         host (:obj:`str`): Hostname of the server
         port (:obj:`int`): Port of the server
-        publish (:obj:`function`): Publish function, takes a message and publishes it
+        publish (:obj:`function`): Publish function, takes a message and publishes it. It may return a
+            :class:`concurrent.futures.Future` completed once the message is published, snapshots are only recorded
+            as accepted then (see :func:`cortex.server.publishing.publish`).
+        publish_batch (:obj:`function`, optional): Batch publish function, takes a list of messages and
+            publishes them. Defaults to calling publish on each message.
+        queue_depth (:obj:`function`, optional): Returns the depth of the downstream queues, watched by the
+            admission control
 
     Routes:
         GET:
-            - /config: Returns the server supported parsers
+            - /config: Returns the server supported parsers and maximal batch size
+            - /progress/<user_id>: Returns the timestamps of the snapshots already accepted for a user
+            - /metrics: Returns the server metrics in the Prometheus text format (see :mod:`cortex.server.metrics`)
         POST:
             - /snapshot: Recieves a message and publishes it
+            - /snapshots: Recieves a user and a batch of snapshots and publishes a message per snapshot
     """
 
     _CONFIG = {'PARSERS': ['pose', 'image_color', 'image_depth', 'feelings'],
-               'DATA_FOLDER': 'data/shared'}
-
-    def __init__(self, host, port, publish):
+               'DATA_FOLDER': 'data/shared',
+               'BLOB_STORE': 'directory',
+               'MAX_BATCH_SIZE': 64,
+               'PUBLISH_CONFIRMS': False,
+               'PUBLISH_QUEUE_SIZE': 1024,
+               'PUBLISH_QUEUE_TIMEOUT': 1,
+               'PUBLISH_BATCH_SIZE': 64,
+               'PUBLISH_TIMEOUT': 30,
+               'WRITE_BEHIND': False,
+               'WRITE_BEHIND_WORKERS': 2,
+               'WRITE_BEHIND_QUEUE_SIZE': 256,
+               'WRITE_BEHIND_FSYNC': True,
+               'ADMISSION_MAX_IN_FLIGHT': 256,
+               'ADMISSION_QUEUE_HIGH': 10000,
+               'ADMISSION_QUEUE_LOW': 5000,
+               'ADMISSION_RETRY_AFTER': 1}
+
+    def __init__(self, host, port, publish, publish_batch=None, queue_depth=None):
         self.host = host
         self.port = port
         self.publish = publish
+        self.publish_batch = publish_batch or (lambda messages: [publish(message) for message in messages])
+
+        self.blob_store = blobstore.open_store(Server._CONFIG['BLOB_STORE'], Server._CONFIG['DATA_FOLDER'])
+        self.blob_writer = None
+        if Server._CONFIG['WRITE_BEHIND']:
+            self.blob_writer = BlobWriter(self.blob_store,
+                                          workers=Server._CONFIG['WRITE_BEHIND_WORKERS'],
+                                          max_queue=Server._CONFIG['WRITE_BEHIND_QUEUE_SIZE'],
+                                          fsync=Server._CONFIG['WRITE_BEHIND_FSYNC'])
+        self.admission = AdmissionControl.from_config(
+            Server._CONFIG, queue_depth=queue_depth,
+            backlog=self.blob_writer.queue.qsize if self.blob_writer is not None else None)
+        metrics.IN_FLIGHT.set_function(lambda: self.admission.in_flight)
 
         self.app = importlib.import_module(name=f'.app', package='cortex.server').app
         self.app.config.update(Server._CONFIG)
-        self.app.config.update(PUBLISH_MESSAGE=publish)
+        self.app.config.update(PUBLISH_MESSAGE=publish, PUBLISH_BATCH=self.publish_batch,
+                               PROGRESS_LOG=ProgressLog(self.app.config['DATA_FOLDER']),
+                               BLOB_STORE=self.blob_store, BLOB_WRITER=self.blob_writer, ADMISSION=self.admission)
 
     def start(self, **kwargs):
         """Runs the server.
@@ -43,26 +100,105 @@ class Server:
         """
         self.app.run(host=self.host, port=self.port, **kwargs)
 
-
-def _cli_run_server(host, port, message_queue):
+    def close(self):
+        """Writes (and publishes) the snapshots queued by the write-behind writer and closes the blob store"""
+        if self.blob_writer is not None:
+            self.blob_writer.close()
+        self.blob_store.close()
+
+
+def _cli_run_server(host, port, message_queue, confirms=False, engine='flask', max_uploads=16, write_behind=False,
+                    blob_store='directory', workers=1):
+    if engine != 'flask' and workers > 1:
+        raise ValueError('Only the flask engine can run several workers')
+    if engine != 'flask' and write_behind:
+        raise ValueError('Only the flask engine can write behind')
+    Server._CONFIG['PUBLISH_CONFIRMS'] = confirms
+    Server._CONFIG['WRITE_BEHIND'] = write_behind
+    Server._CONFIG['BLOB_STORE'] = blob_store
+    if workers > 1:
+        with _shared_metrics() as metrics_dir:
+            Supervisor(host, port, lambda: _mq_worker(host, port, message_queue, metrics_dir), workers).run()
+        return
+    mq_client = _mq_client(message_queue)
+    run_server(host, port, mq_client.publish, publish_batch=getattr(mq_client, 'publish_batch', None),
+               engine=engine, max_uploads=max_uploads, queue_depth=getattr(mq_client, 'queue_depth', None))
+
+
+def _mq_client(message_queue):
     # Import a message queue module according to the url scheme
     # and instantiate an appropriate client
     mq_scheme, mq_host, mq_port = parse_url(message_queue)
     mq_module = importlib.import_module(name=f'..net.mq.{mq_scheme}', package='cortex.server')
-    publish = mq_module.SnapshotClient(mq_host, mq_port, **Server._CONFIG).publish
-    run_server(host, port, publish)
-
-
-def run_server(host, port, publish, threaded=True):
+    return mq_module.SnapshotClient(mq_host, mq_port, **Server._CONFIG)
+
+
+@contextlib.contextmanager
+def _mq_worker(host, port, message_queue, metrics_dir=None):
+    # Runs in every worker process, each has its own message queue connection
+    mq_client = _mq_client(message_queue)
+    try:
+        with _server_worker(host, port, mq_client.publish, getattr(mq_client, 'publish_batch', None),
+                            getattr(mq_client, 'queue_depth', None), metrics_dir) as app:
+            yield app
+    finally:
+        if hasattr(mq_client, 'close'):
+            mq_client.close()
+
+
+@contextlib.contextmanager
+def _server_worker(host, port, publish, publish_batch, queue_depth=None, metrics_dir=None):
+    if metrics_dir is not None:
+        metrics.REGISTRY.share(metrics_dir)
+    server = Server(host, port, publish, publish_batch=publish_batch, queue_depth=queue_depth)
+    try:
+        yield server.app
+    finally:
+        server.close()
+        metrics.REGISTRY.dump()
+
+
+@contextlib.contextmanager
+def _shared_metrics():
+    # The pre-forked workers aggregate their metrics in a directory of their own, see metrics.Registry.share
+    directory = tempfile.mkdtemp(prefix='cortex-metrics-')
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_server(host, port, publish, threaded=True, publish_batch=None, engine='flask', max_uploads=16, workers=1,
+               queue_depth=None):
     """Initiates and runs a server.
 
     The server will run on the host:port given and publish each message recieved using the publish function passed.
+    With several workers, the flask server is pre-forked into worker processes sharing the listening socket (see
+    :class:`cortex.prefork.Supervisor`) and the publish functions are called in the worker processes.
 
     Args:
         host (:obj:`str`): Hostname of the server
         port (:obj:`int`): Port of the server
-        publish (:obj:`function`): Publish function, takes a message and publishes it
+        publish (:obj:`function`): Publish function, takes a message and publishes it. It may return a
+            :class:`concurrent.futures.Future` completed once the message is published, snapshots are only recorded
+            as accepted then (see :func:`cortex.server.publishing.publish`).
         threaded (:obj:`bool`, optional): Flag for multi-thread use
+        publish_batch (:obj:`function`, optional): Batch publish function, takes a list of messages and publishes them
+        engine (:obj:`str`, optional): 'flask' runs a :class:`Server`, 'asyncio' runs a
+            :class:`cortex.server.async_server.AsyncServer`
+        max_uploads (:obj:`int`, optional): Maximal number of uploads received concurrently by the asyncio engine
+        workers (:obj:`int`, optional): Number of worker processes of the flask engine
+        queue_depth (:obj:`function`, optional): Returns the depth of the downstream queues, uploads are rejected
+            while it is past the ADMISSION_QUEUE_HIGH watermark
     """
-    server = Server(host, port, publish)
+    if engine == 'asyncio':
+        AsyncServer(host, port, publish, publish_batch=publish_batch, max_uploads=max_uploads,
+                    queue_depth=queue_depth).start()
+        return
+    if workers > 1:
+        with _shared_metrics() as metrics_dir:
+            Supervisor(host, port, lambda: _server_worker(host, port, publish, publish_batch, queue_depth, metrics_dir),
+                       workers, threaded=threaded).run()
+        return
+    server = Server(host, port, publish, publish_batch=publish_batch, queue_depth=queue_depth)
     server.start(threaded=threaded)
@@ -0,0 +1,60 @@
+from . import metrics
+
+IMAGE_FIELDS = ('image_color', 'image_depth')
+
+
+def blob_key(uid, timestamp, field):
+    """Returns the blob store key of a raw image field of a snapshot
+
+    Args:
+        uid (:obj:`int`): User ID
+        timestamp (:obj:`datetime.datetime`): Snapshot timestamp
+        field (:obj:`str`): Image field name
+    Returns:
+        :obj:`str`: Blob key, ``<uid>/<timestamp>/<field>.raw``
+    """
+    return f'{uid}/{timestamp.strftime("%Y-%m-%d_%H-%M-%S-%f")}/{field}.raw'
+
+
+def snapshot_writes(fields, user, snapshot):
+    """Lists the raw image blobs of a snapshot, without writing them
+
+    Args:
+        fields (:obj:`list`): Fields the server parses, only their images are stored
+        user (:obj:`dict`): User dictionary
+        snapshot (:obj:`dict`): Snapshot dictionary
+    Returns:
+        :obj:`list`: (key, image, field) triples, the image data is at ``image[field]`` and is replaced by the
+        blob reference once written (see :func:`write_blobs`)
+    """
+    return [(blob_key(user['uid'], snapshot['timestamp_ms'], field), snapshot[field], field)
+            for field in IMAGE_FIELDS if field in fields and field in snapshot]
+
+
+def write_blobs(store, writes):
+    """Writes blobs listed by :func:`snapshot_writes` and replaces their data with their references
+
+    Args:
+        store (:class:`cortex.net.blobstore.BlobStore`): Blob store
+        writes (:obj:`list`): (key, image, field) triples
+    Returns:
+        :obj:`list`: References of the written blobs
+    """
+    refs = []
+    for key, image, field in writes:
+        with metrics.BLOB_WRITE_SECONDS.time():
+            image[field] = store.put(key, image[field])
+        refs.append(image[field])
+    return refs
+
+
+def store_snapshot(store, fields, user, snapshot):
+    """Writes the raw image data of a snapshot to a blob store and replaces it with the blob references
+
+    Args:
+        store (:class:`cortex.net.blobstore.BlobStore`): Blob store
+        fields (:obj:`list`): Fields the server parses, only their images are stored
+        user (:obj:`dict`): User dictionary
+        snapshot (:obj:`dict`): Snapshot dictionary, updated in place
+    """
+    write_blobs(store, snapshot_writes(fields, user, snapshot))
@@ -0,0 +1,107 @@
+import queue
+import threading
+from . import metrics, storage
+
+
+class BlobWriter:
+    """Write-behind writer of the raw snapshot data
+
+    Request threads hand the writer the blobs of a snapshot (see :func:`cortex.server.storage.snapshot_writes`)
+    along with a callback and return right away, a pool of writer threads takes the queued jobs in batches of up
+    to ``batch_size``, writes their blobs to the blob store, syncs the whole batch to disk at once and only then
+    calls the jobs' callbacks. The server publishes from the callback, so a message never refers to a file which
+    could still be lost. :meth:`submit` blocks while ``max_queue`` jobs are waiting, which bounds the memory held by
+    the queue.
+    The callback of a job whose blobs failed to be written (or synced) is not called and the failure is counted in
+    BLOB_WRITE_FAILURES: its snapshots are neither published nor recorded as accepted, so a resumed upload sends
+    them again.
+
+    Args:
+        store (:class:`cortex.net.blobstore.BlobStore`): Blob store the blobs are written to
+        workers (:obj:`int`, optional): Number of writer threads
+        max_queue (:obj:`int`, optional): Maximal number of queued jobs
+        batch_size (:obj:`int`, optional): Maximal number of jobs synced together
+        fsync (:obj:`bool`, optional): Sync the written blobs before calling the callbacks
+    """
+    _STOP = object()
+
+    def __init__(self, store, workers=2, max_queue=256, batch_size=16, fsync=True):
+        self.store = store
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._threads = [threading.Thread(target=self._run, name=f'blob-writer-{i}', daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, writes, on_durable=None):
+        """Queues blobs for writing, blocks while the queue is full
+
+        Args:
+            writes (:obj:`list`): (key, image, field) triples of the blobs to write
+            on_durable (callable, optional): Called by a writer thread once all the blobs were written (and synced)
+        """
+        if self._closed:
+            raise RuntimeError('BlobWriter is closed')
+        self.queue.put((writes, on_durable))
+
+    def flush(self):
+        """Blocks until every queued job was written and its callback returned"""
+        self.queue.join()
+
+    def close(self):
+        """Writes the queued jobs and stops the writer threads"""
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self.queue.put(self._STOP)
+            for thread in self._threads:
+                thread.join()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not self._STOP:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, jobs):
+        refs, written = [], []
+        for writes, on_durable in jobs:
+            try:
+                refs += storage.write_blobs(self.store, writes)
+                written.append(on_durable)
+            except OSError as e:
+                print(e)
+                metrics.BLOB_WRITE_FAILURES.inc()
+        if self.fsync:
+            try:
+                self.store.sync(refs)
+            except OSError:
+                metrics.BLOB_WRITE_FAILURES.inc(amount=len(written))
+                raise
+        return written
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch = self._next_batch()
+            stopped = batch[-1] is self._STOP
+            jobs = batch[:-1] if stopped else batch
+            try:
+                for on_durable in self._write(jobs):
+                    try:
+                        if on_durable is not None:
+                            on_durable()
+                    except Exception as e:
+                        print(e)
+            except OSError as e:
+                # The batch didn't make it to disk, none of its jobs is published
+                print(e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
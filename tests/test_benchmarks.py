@@ -0,0 +1,32 @@
+import subprocess
+import sys
+
+from cortex.benchmarks.benchmark import write_results
+
+_BASELINE = {'parsers': {'pose': {'ops_per_sec': 100.0}, 'feelings': {'ops_per_sec': 200.0}},
+             'read_snapshot': {'fast': {'ops_per_sec': 50.0}}}
+_RESULTS = {'parsers': {'pose': {'ops_per_sec': 80.0}, 'feelings': {'ops_per_sec': 210.0}}}
+
+
+def test_compare(tmp_path):
+    baseline, results = tmp_path / 'baseline.json', tmp_path / 'results.json'
+    write_results(baseline, _BASELINE, count=20)
+    write_results(results, _RESULTS, count=20)
+
+    # Cases missing from either side are ignored
+    compared = subprocess.run([sys.executable,
+                               "-m",
+                               "cortex.benchmarks",
+                               "compare", str(baseline), str(results)], capture_output=True, text=True)
+    assert compared.returncode == 1
+    assert compared.stdout.splitlines() == ['parsers[feelings]: 200.00 -> 210.00 ops/sec (+5.0%)',
+                                            'parsers[pose]: 100.00 -> 80.00 ops/sec (-20.0%)  REGRESSION',
+                                            '1 regressions in 2 cases']
+
+    compared = subprocess.run([sys.executable,
+                               "-m",
+                               "cortex.benchmarks",
+                               "compare", "--threshold", "0.25", str(baseline), str(results)],
+                              capture_output=True, text=True)
+    assert compared.returncode == 0
+    assert compared.stdout.splitlines()[-1] == '0 regressions in 2 cases'
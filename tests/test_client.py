@@ -1,10 +1,14 @@
+import json
 import pytest
 import datetime
 import requests
 import bson
-from cortex.client import Client, upload_sample
-from cortex.client.reader import Reader
-from cortex.net.protocol import Snapshot, Config
+import numpy as np
+from cortex.client import Client, upload_sample, upload_samples
+from cortex.client.bulk import read_failures
+from cortex.benchmarks.synthetic import write_sample
+from cortex.client.reader import Reader, SampleIndex, convert_sample
+from cortex.net.protocol import Snapshot, SnapshotBatch, Config, timestamp_key, encode_message, decode_message
 
 _HOST = '127.0.0.1'
 _PORT = 8000
@@ -14,14 +18,14 @@ _SAMPLE_FORMAT = 'protobuf'
 
 @pytest.fixture
 def mock_response(monkeypatch):
-    def mock_get(url):
+    def mock_get(session, url):
         return MockGetResponse()
 
-    def mock_post(url, headers, data):
+    def mock_post(session, url, headers, data):
         return MockPostResponse()
 
-    monkeypatch.setattr(requests, 'get', mock_get)
-    monkeypatch.setattr(requests, 'post', mock_post)
+    monkeypatch.setattr(requests.Session, 'get', mock_get)
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
 
 
 class MockGetResponse:
@@ -33,6 +37,11 @@ class MockPostResponse:
     status_code = 200
 
 
+class MockFailedPostResponse:
+    status_code = 500
+    reason = 'Internal Server Error'
+
+
 @pytest.fixture
 def client():
     return Client(host=_HOST, port=_PORT, sample=_SAMPLE, sample_format=_SAMPLE_FORMAT)
@@ -68,6 +77,154 @@ def test_reader(reader):
     assert isinstance(snapshot2, Snapshot)
 
 
+@pytest.fixture
+def synthetic_sample(tmp_path):
+    path = tmp_path / 'synthetic.mind.gz'
+    write_sample(path, count=3, color_size=(64, 48), depth_size=(24, 16))
+    return path
+
+
+def test_reader_fast_decode(synthetic_sample):
+    fast_reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, fast=True)
+    legacy_reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, fast=False)
+    assert fast_reader.read_user().to_bson() == legacy_reader.read_user().to_bson()
+
+    fast_snapshots, legacy_snapshots = list(fast_reader), list(legacy_reader)
+    assert len(fast_snapshots) == len(legacy_snapshots) == 3
+    for fast_snapshot, legacy_snapshot in zip(fast_snapshots, legacy_snapshots):
+        assert fast_snapshot.to_bson() == legacy_snapshot.to_bson()
+        assert fast_snapshot.image_color.image_color.tobytes() == legacy_snapshot.image_color.image_color.tobytes()
+        assert fast_snapshot.image_depth.image_depth.size == (16, 24)
+
+
+def test_snapshot_images_lazy(synthetic_sample):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    reader.read_user()
+    snapshot = reader.read_snapshot()
+    assert snapshot.image_color._image is None and snapshot.image_depth._image is None
+    assert snapshot.image_color.to_numpy().shape == (48, 64, 3)
+    assert snapshot.image_depth.to_numpy().dtype == '<f4'
+
+    decoded = Snapshot.from_bson(bson.decode(bson.encode(snapshot.to_bson())))
+    assert type(decoded.image_depth).__name__ == 'ImageDepth'
+    assert decoded.image_color._image is None
+    assert decoded.image_color.to_numpy().tobytes() == snapshot.image_color.image_color.tobytes()
+    assert decoded.image_depth.image_depth.size == snapshot.image_depth.image_depth.size
+
+
+def test_encode_message_frame(synthetic_sample):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    user = reader.read_user()
+    snapshot = reader.read_snapshot()
+    expected = bson.decode(bson.encode({'user': user.to_bson(), 'snapshot': snapshot.to_bson()}))
+
+    frame = encode_message({'user': user.to_bson(), 'snapshot': snapshot.to_bson(raw=True)}, 'frame')
+    decoded = decode_message(frame, 'frame')
+    assert isinstance(decoded['snapshot']['image_color']['image_color'], memoryview)
+    assert bson.decode(bson.encode({'user': decoded['user'],
+                                    'snapshot': Snapshot.from_bson(decoded['snapshot']).to_bson()})) == expected
+    with pytest.raises(ValueError):
+        decode_message(frame[:-1], 'frame')
+
+
+@pytest.mark.parametrize('wire_format', ['bson', 'frame'])
+def test_snapshot_batch(synthetic_sample, wire_format):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    reader.read_user()
+    snapshots = list(reader)
+    snapshots[1].feelings = None
+
+    batch = SnapshotBatch.from_snapshots(snapshots)
+    assert len(batch) == 3 and batch.poses.shape == (3, 7) and batch.translations.shape == (3, 3)
+    assert np.isnan(batch.feelings[1]).all()
+
+    data = encode_message(batch.to_bson(raw=wire_format == 'frame'), wire_format)
+    decoded = SnapshotBatch.from_bson(decode_message(data, wire_format))
+    assert [timestamp_key(snapshot.timestamp_ms) for snapshot in decoded] == batch.timestamps.tolist()
+    assert [snapshot.to_bson() for snapshot in decoded] == [snapshot.to_bson() for snapshot in snapshots]
+    assert SnapshotBatch.from_bson(batch.to_bson(fields=['pose'])).image_color is None
+
+
+def test_reader_random_access(synthetic_sample):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    reader.read_user()
+    snapshots = [snapshot.to_bson() for snapshot in reader]
+
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    assert len(reader) == 3
+    assert SampleIndex.sidecar_path(synthetic_sample).exists()
+    assert reader[1].to_bson() == snapshots[1]
+    assert reader[-1].to_bson() == snapshots[2]
+    assert [snapshot.to_bson() for snapshot in reader[0:2]] == snapshots[0:2]
+    assert [snapshot.to_bson() for snapshot in reader[::2]] == snapshots[::2]
+    with pytest.raises(IndexError):
+        reader[3]
+
+    # Random access leaves the iteration position untouched
+    reader.read_user()
+    assert [snapshot.to_bson() for snapshot in reader] == snapshots
+
+    cached_reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    assert list(cached_reader.index.offsets) == list(reader.index.offsets)
+    assert [snapshot.to_bson() for snapshot in cached_reader.iter_parallel(workers=2, chunk_size=1)] == snapshots
+
+
+def test_reader_prefetch(synthetic_sample):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    reader.read_user()
+    snapshots = [snapshot.to_bson() for snapshot in reader]
+
+    prefetch_reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, prefetch=2, prefetch_workers=3)
+    prefetch_reader.read_user()
+    assert [snapshot.to_bson() for snapshot in prefetch_reader] == snapshots
+    with pytest.raises(EOFError):
+        prefetch_reader.read_snapshot()
+    prefetch_reader.close()
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_reader_skip_snapshots(synthetic_sample, prefetch):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    reader.read_user()
+    snapshots = [snapshot.to_bson() for snapshot in reader]
+
+    # Skipping the first snapshot seeks past it, skipping the last one is done by scanning
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, prefetch=prefetch)
+    reader.read_user()
+    reader.skip_snapshots([timestamp_key(snapshots[0]['timestamp_ms']), timestamp_key(snapshots[2]['timestamp_ms'])])
+    assert [snapshot.to_bson() for snapshot in reader] == [snapshots[1]]
+    reader.close()
+
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_reader_select_fields(synthetic_sample, fast):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, fast=fast)
+    reader.read_user()
+    full_snapshot = reader.read_snapshot()
+
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT, fast=fast)
+    reader.select_fields(['pose'])
+    reader.read_user()
+    snapshot = reader.read_snapshot()
+    assert snapshot.image_color is None and snapshot.image_depth is None and snapshot.feelings is None
+    assert snapshot.to_bson() == full_snapshot.to_bson(fields=['pose'])
+
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_reader_mmap(synthetic_sample, fast):
+    reader = Reader(path=synthetic_sample, driver_type=_SAMPLE_FORMAT)
+    user = reader.read_user().to_bson()
+    snapshots = [snapshot.to_bson() for snapshot in reader]
+
+    path = convert_sample(synthetic_sample)
+    assert path == synthetic_sample.with_suffix('')
+    reader = Reader(path=path, driver_type='mmap', fast=fast)
+    assert reader.read_user().to_bson() == user
+    assert [snapshot.to_bson() for snapshot in reader] == snapshots
+    assert len(reader) == 3 and reader[2].to_bson() == snapshots[2]
+    assert [snapshot.to_bson() for snapshot in reader.iter_parallel(workers=2, chunk_size=1)] == snapshots
+
+
 def test_get_config(client, mock_response):
     config = client._get_config()
     assert isinstance(config, Config)
@@ -85,3 +242,55 @@ def test_upload_sample(mock_response):
     assert upload_sample(host=_HOST, port=_PORT, path=_SAMPLE) == 0
 
 
+def test_run_concurrent(synthetic_sample, mock_response, monkeypatch):
+    posted = []
+
+    def mock_post(session, url, headers, data):
+        posted.append(bson.decode(data)['snapshot']['timestamp_ms'])
+        return MockPostResponse()
+
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+    client = Client(host=_HOST, port=_PORT, sample=synthetic_sample, sample_format=_SAMPLE_FORMAT, concurrency=3)
+    assert client.run() == 3
+    assert len(set(posted)) == 3
+
+
+def test_run_batches(synthetic_sample, monkeypatch):
+    posted = []
+
+    def mock_get(session, url):
+        response = MockGetResponse()
+        response.data = bson.encode({'parsers': ['pose', 'feelings'], 'max_batch_size': 2})
+        return response
+
+    def mock_post(session, url, headers, data):
+        posted.append((url.rsplit('/', 1)[-1], len(bson.decode(data)['snapshots'])))
+        return MockPostResponse()
+
+    monkeypatch.setattr(requests.Session, 'get', mock_get)
+    monkeypatch.setattr(requests.Session, 'post', mock_post)
+    client = Client(host=_HOST, port=_PORT, sample=synthetic_sample, sample_format=_SAMPLE_FORMAT, batch_size=8)
+    assert client.run() == 3
+    assert sorted(posted) == [('snapshots', 1), ('snapshots', 2)]
+
+
+def test_run_fails_fast(synthetic_sample, mock_response, monkeypatch):
+    monkeypatch.setattr(requests.Session, 'post', lambda session, url, headers, data: MockFailedPostResponse())
+    client = Client(host=_HOST, port=_PORT, sample=synthetic_sample, sample_format=_SAMPLE_FORMAT, concurrency=2)
+    with pytest.raises(ConnectionError):
+        client.run()
+
+
+def test_upload_samples(tmp_path, mock_response):
+    samples = tmp_path / 'samples'
+    (samples / 'nested').mkdir(parents=True)
+    write_sample(samples / 'a.mind.gz', count=2, color_size=(8, 6), depth_size=(4, 3))
+    write_sample(samples / 'nested' / 'b.mind.gz', count=3, color_size=(8, 6), depth_size=(4, 3))
+    (samples / 'broken.mind.gz').write_bytes(b'not a sample')
+    summary_path = tmp_path / 'summary.json'
+
+    assert upload_samples(_HOST, _PORT, [str(samples)], processes=2, summary_path=summary_path) == 1
+    summary = json.loads(summary_path.read_text())
+    assert summary['samples'] == 3
+    assert summary['snapshots'] == 5
+    assert read_failures(summary_path) == [str(samples / 'broken.mind.gz')]
@@ -1,8 +1,16 @@
+import io
+import queue
+import threading
 import pytest
 import subprocess
+import pika
 import datetime
 import bson
+import numpy as np
+from PIL import Image
+from cortex.net import blobstore
 from cortex.parsers import run_parser
+from cortex.parsers.parser import Parser, setup_parser
 
 
 _SNAPSHOT_RAW = "data/snapshot.raw"
@@ -53,3 +61,153 @@ def test_parse(field, result, tmp_path):
                         "cortex.parsers",
                         "parse", field, _SNAPSHOT_RAW], stdout=fd)
     assert tmp_file.read_bytes() == enc_result
+
+
+def test_parse_segment_store(tmp_path, monkeypatch):
+    synced = []
+    sync = blobstore.SegmentStore.sync
+    monkeypatch.setattr(blobstore.SegmentStore, 'sync', lambda self, refs=(): synced.extend(refs) or sync(self, refs))
+    store = blobstore.SegmentStore(tmp_path / 'shared')
+    color = np.arange(8 * 6 * 3, dtype=np.uint8)
+    depth = np.linspace(0, 1, 4 * 3, dtype=np.float32)
+    snapshot = {'timestamp_ms': _POSE['snapshot']['timestamp_ms'],
+                'image_color': {'image_color': store.put('42/2019-12-04_10-08-07-339000/image_color.raw', color),
+                                'width': 8, 'height': 6},
+                'image_depth': {'image_depth': store.put('42/2019-12-04_10-08-07-339000/image_depth.raw', depth),
+                                'width': 4, 'height': 3}}
+    data = bson.encode({**_USER, 'snapshot': snapshot})
+
+    color_ref = bson.decode(run_parser('image_color', data))['snapshot']['image_color']['image_color']
+    depth_ref = bson.decode(run_parser('image_depth', data))['snapshot']['image_depth']['image_depth']
+    assert blobstore.blob_key(color_ref) == '42/2019-12-04_10-08-07-339000/image_color.png'
+    assert blobstore.blob_key(depth_ref) == '42/2019-12-04_10-08-07-339000/image_depth.tiff'
+    # The images are synced before the results referring to them are returned
+    assert synced == [color_ref, depth_ref]
+    blobstore.close_stores()
+    with Image.open(io.BytesIO(blobstore.read_blob(color_ref))) as img:
+        assert np.array_equal(np.asarray(img).ravel(), color)
+    with Image.open(io.BytesIO(blobstore.read_blob(depth_ref))) as img:
+        assert np.array_equal(np.asarray(img).ravel(), depth)
+
+
+class MockConnection:
+    def __init__(self, parameters):
+        self.is_open = True
+        self.callbacks = queue.Queue()
+        self.consumer = MockChannel(self)
+
+    def channel(self):
+        return self.consumer
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def call_later(self, delay, callback):
+        timer = threading.Timer(delay, self.callbacks.put, (callback,))
+        timer.start()
+        return timer
+
+    def remove_timeout(self, timer):
+        timer.cancel()
+
+    def close(self):
+        self.is_open = False
+
+
+class MockChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.thread = threading.get_ident()
+        self.messages = []
+        self.published, self.acked, self.nacked = [], [], []
+        self.max_unacked = 0
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def queue_declare(self, queue):
+        pass
+
+    def queue_bind(self, exchange, queue, routing_key):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert not auto_ack
+        self.on_message = on_message_callback
+
+    def basic_publish(self, exchange, routing_key, body):
+        assert threading.get_ident() == self.thread
+        self.published.append(body)
+
+    def basic_ack(self, delivery_tag):
+        assert threading.get_ident() == self.thread
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue):
+        assert not requeue
+        self.nacked.append(delivery_tag)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def start_consuming(self):
+        # Deliver the messages as the broker would, never more than the prefetch count unacknowledged
+        self.consuming, delivered = True, 0
+        while self.consuming and len(self.acked) + len(self.nacked) < len(self.messages):
+            while delivered < len(self.messages) and delivered - len(self.acked) - len(self.nacked) < self.prefetch:
+                delivered += 1
+                self.on_message(self, pika.spec.Basic.Deliver(delivery_tag=delivered), None,
+                                self.messages[delivered - 1])
+            self.max_unacked = max(self.max_unacked, delivered - len(self.acked) - len(self.nacked))
+            self.connection.callbacks.get(timeout=10)()
+
+
+@pytest.mark.parametrize('pool, workers, batch_size', [('thread', 4, 1), ('process', 2, 1), ('process', 2, 4)])
+def test_parser_client(monkeypatch, pool, workers, batch_size):
+    monkeypatch.setattr(pika, 'BlockingConnection', MockConnection)
+    client = setup_parser('pose', 'rabbitmq://127.0.0.1:5672', workers=workers, pool=pool, batch_size=batch_size)
+    channel = client.channel
+    messages = [bson.encode({**_USER, 'snapshot': {**_POSE['snapshot'], 'timestamp_ms': i}}) for i in range(20)]
+    channel.messages = messages[:10] + [b'not bson'] + messages[10:]
+    try:
+        client.consume()
+    finally:
+        client.close()
+
+    assert channel.prefetch == 2 * workers * batch_size
+    assert 1 < channel.max_unacked <= channel.prefetch
+    assert channel.nacked == [11]
+    assert sorted(channel.acked) == [tag for tag in range(1, 22) if tag != 11]
+    assert sorted(bson.decode(body)['snapshot']['timestamp_ms'] for body in channel.published) == list(range(20))
+
+
+def test_parse_batch(tmp_path, monkeypatch, capsys):
+    store = blobstore.DirectoryStore(tmp_path)
+    messages = []
+    for i in range(3):
+        depth = np.full(4 * 3, i, dtype=np.float32)
+        snapshot = {**_POSE['snapshot'], **_FEELINGS['snapshot'], 'timestamp_ms': i,
+                    'image_depth': {'image_depth': store.put(f'42/{i}/image_depth.raw', depth),
+                                    'width': 4, 'height': 3}}
+        messages.append(bson.encode({**_USER, 'snapshot': snapshot}))
+    batch = [messages[0], b'not bson', *messages[1:]]
+    calls = []
+
+    def parse_pose_batch(data):
+        calls.append(len(data))
+        return [snapshot['pose'] for snapshot in data]
+
+    # A batch variant parses a batch in a single call, and falls back to parsing message by message when it fails
+    monkeypatch.setitem(Parser._BATCH_PARSERS, 'pose', parse_pose_batch)
+    parser = Parser('pose')
+    assert parser.parse_batch(messages) == [parser(message) for message in messages]
+    assert calls == [3]
+    for field in ('pose', 'image_depth'):
+        parser = Parser(field)
+        results = parser.parse_batch(batch)
+        assert isinstance(results[1], Exception)
+        assert [results[0], *results[2:]] == [parser(message) for message in messages]
+    assert 'Parsing a batch of 4 pose messages failed' in capsys.readouterr().out
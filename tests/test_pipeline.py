@@ -0,0 +1,98 @@
+import pytest
+import threading
+import bson
+import pymongo
+import mongomock
+import requests
+
+from cortex.benchmarks.synthetic import write_sample
+from cortex.client import upload_sample
+from cortex.net import blobstore
+from cortex.net.db import mongodb
+from cortex.net.mq import local
+from cortex.pipeline import Pipeline
+from cortex.saver import Saver
+from cortex.server import Server
+
+_HOST = '127.0.0.1'
+_PORT = 8000
+_FIELDS = ['pose', 'image_color', 'image_depth', 'feelings']
+
+
+@pytest.fixture()
+def mock_mongo(monkeypatch):
+    monkeypatch.setattr(pymongo, 'MongoClient', mongomock.MongoClient)
+    monkeypatch.setattr(mongodb, 'MongoClient', mongomock.MongoClient)
+
+
+def test_local_routing():
+    broker = local.Broker()
+    broker.bind('snapshots', 'pose', '#.pose.#')
+    broker.bind('snapshots', 'feelings', '#.feelings.#')
+    broker.bind('snapshots', 'first', '*.feelings')
+    for field in _FIELDS:
+        broker.bind('parsed_data', 'save', field)
+
+    broker.publish('snapshots', 'pose', b'1')
+    broker.publish('snapshots', 'image_color.pose.feelings', b'2')
+    broker.publish('snapshots', 'pose.feelings', b'3')
+    broker.publish('snapshots', 'image_depth', b'4')
+    broker.publish('parsed_data', 'pose', b'5')
+    broker.publish('parsed_data', 'pose.feelings', b'6')
+
+    assert broker.queue('pose').get_batch(10, 0) == [('pose', b'1'), ('image_color.pose.feelings', b'2'),
+                                                     ('pose.feelings', b'3')]
+    assert broker.queue('feelings').get_batch(10, 0) == [('image_color.pose.feelings', b'2'),
+                                                         ('pose.feelings', b'3')]
+    assert broker.queue('first').get_batch(10, 0) == [('pose.feelings', b'3')]
+    assert broker.queue('save').get_batch(10, 0) == [('pose', b'5')]
+    assert broker.depth(['pose', 'feelings', 'save']) == 0
+    assert not broker.queue('pose').join(timeout=0)
+    broker.queue('pose').task_done(3)
+    assert broker.queue('pose').join(timeout=0)
+
+
+def test_local_saver(monkeypatch, tmp_path, mock_mongo, capsys):
+    saver = Saver('mongodb://127.0.0.1:27017')
+    client = local.SaverClient(str(tmp_path), None, saver, batch_size=3, batch_timeout=0.01, retry_delay=0)
+    # Batches fail to save, their messages are saved one at a time and the one which can't be saved is dropped
+    monkeypatch.setattr(saver.client.snapshots, 'bulk_write', lambda *args, **kwargs: 1 / 0)
+    for field in _FIELDS:
+        with open(f'data/{field}.result', 'rb') as fd:
+            client.broker.publish('parsed_data', field, fd.read())
+    client.broker.publish('parsed_data', 'pose', bson.encode({'user': {}}))
+    thread = threading.Thread(target=client.consume)
+    thread.start()
+    assert client.queue.join(timeout=5)
+    client.close()
+    thread.join()
+
+    snapshot = saver.client.snapshots.find_one(projection={'_id': False})
+    assert set(snapshot) == {'uid', 'timestamp_ms', *_FIELDS}
+    assert 'Dropping 1 messages after 5 failed attempts' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('pool, batch_size', [('thread', 1), ('process', 4)])
+def test_pipeline(monkeypatch, tmp_path, mock_mongo, pool, batch_size):
+    sample = tmp_path / 'synthetic.mind.gz'
+    write_sample(sample, count=5, color_size=(8, 6), depth_size=(4, 3))
+    pipeline = Pipeline('mongodb://127.0.0.1:27017', _FIELDS, workers=2, pool=pool, batch_size=batch_size,
+                        mq_url=f'local://{tmp_path}')
+    pipeline.start()
+    monkeypatch.setitem(Server._CONFIG, 'DATA_FOLDER', str(tmp_path / 'shared'))
+    server = Server(host=_HOST, port=_PORT, publish=pipeline.mq_client.publish,
+                    publish_batch=pipeline.mq_client.publish_batch, queue_depth=pipeline.mq_client.queue_depth)
+    app = server.app
+    monkeypatch.setattr(requests.Session, 'get', lambda session, url, **kwargs: app.test_client().get(url, **kwargs))
+    monkeypatch.setattr(requests.Session, 'post', lambda session, url, **kwargs: app.test_client().post(url, **kwargs))
+
+    assert upload_sample(host=_HOST, port=_PORT, path=sample, batch_size=2) == 0
+    pipeline.close()
+
+    snapshots = list(pipeline.saver.db_client.client.snapshots.find(projection={'_id': False}))
+    assert len(snapshots) == 5
+    for snapshot in snapshots:
+        assert snapshot['uid'] == 42
+        assert set(snapshot) == {'uid', 'timestamp_ms', *_FIELDS}
+        assert blobstore.blob_key(snapshot['image_color']['image_color']).endswith('image_color.png')
+        assert len(blobstore.read_blob(snapshot['image_depth']['image_depth'])) > 0
@@ -1,18 +1,44 @@
 import pytest
 import datetime
+import bson
+import pika
 import pymongo
 import mongomock
 
+from cortex.api.app import app
+from cortex.net.db import mongodb
+from cortex.net.mq import rabbitmq
 from cortex.saver import Saver
 
 _DB_URL = 'mongodb://127.0.0.1:27017'
 _RESULTS = ['pose', 'image_color', 'image_depth', 'feelings']
-_STORED_USER = {'uid': 42, 'name': 'Dan Gittik', 'birthday': datetime.datetime(1992, 3, 5, 0, 0), 'gender': 'm', 'snapshots': [{'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 7, 339000), 'pose': {'translation': [0.4873843491077423, 0.007090016733855009, -1.1306129693984985], 'rotation': [-0.10888676356214629, -0.26755994585035286, -0.021271118915446748, 0.9571326384559261]}, 'image_color': {'image_color': 'data/temp/42/2019-12-04_10-08-07-339000/image_color.tiff', 'width': 1920, 'height': 1080}, 'image_depth': {'image_depth': 'data/temp/42/2019-12-04_10-08-07-339000/image_depth.tiff', 'width': 172, 'height': 224}, 'feelings': {'hunger': 0.0, 'thirst': 0.0, 'exhaustion': 0.0, 'happiness': 0.0}}]}
+_STORED_USER = {'uid': 42, 'name': 'Dan Gittik', 'birthday': datetime.datetime(1992, 3, 5, 0, 0), 'gender': 'm'}
+_STORED_SNAPSHOT = {'uid': 42, 'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 7, 339000), 'pose': {'translation': [0.4873843491077423, 0.007090016733855009, -1.1306129693984985], 'rotation': [-0.10888676356214629, -0.26755994585035286, -0.021271118915446748, 0.9571326384559261]}, 'image_color': {'image_color': 'data/temp/42/2019-12-04_10-08-07-339000/image_color.tiff', 'width': 1920, 'height': 1080}, 'image_depth': {'image_depth': 'data/temp/42/2019-12-04_10-08-07-339000/image_depth.tiff', 'width': 172, 'height': 224}, 'feelings': {'hunger': 0.0, 'thirst': 0.0, 'exhaustion': 0.0, 'happiness': 0.0}}
 
 
 @pytest.fixture()
 def mock_mongo(monkeypatch):
     monkeypatch.setattr(pymongo, 'MongoClient', mongomock.MongoClient)
+    monkeypatch.setattr(mongodb, 'MongoClient', mongomock.MongoClient)
+    # Newer pymongo versions pass the sort of single document updates to the bulk builder, mongomock doesn't take it
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ['add_update', 'add_replace']:
+        monkeypatch.setattr(builder, name, _ignore_sort(getattr(builder, name)))
+
+
+def _ignore_sort(add):
+    def add_without_sort(self, *args, sort=None, **kwargs):
+        return add(self, *args, **kwargs)
+    return add_without_sort
+
+
+def assert_stored(saver):
+    stored_user = saver.client.users.find_one(filter={'uid': 42},
+                                              projection={'_id': False})
+    assert stored_user == _STORED_USER
+    stored_snapshots = list(saver.client.snapshots.find(filter={'uid': 42},
+                                                        projection={'_id': False}))
+    assert stored_snapshots == [_STORED_SNAPSHOT]
 
 
 def test_saver(mock_mongo):
@@ -22,7 +48,145 @@ def test_saver(mock_mongo):
             data = fd.read()
             saver.save(field, data)
 
-    stored_user = saver.client.users.find_one(filter={'uid': 42},
-                                              projection={'_id': False})
-    assert stored_user == _STORED_USER
+    assert_stored(saver)
+
+
+def test_saver_batch(mock_mongo):
+    saver = Saver(_DB_URL)
+    results = []
+    for field in _RESULTS:
+        with open(f'data/{field}.result', 'rb') as fd:
+            results.append((field, fd.read()))
+    # A batch merges the fields of a snapshot, a later batch updates the saved snapshot
+    saver.save_batch(results[:3])
+    saver.save_batch(results[2:])
+    # A batch with data which fails to decode isn't saved, so its messages can be saved one at a time
+    with pytest.raises(bson.errors.InvalidBSON):
+        saver.save_batch([('pose', b'not bson'), results[3]])
+
+    assert_stored(saver)
+
+
+def test_migrate(mock_mongo, monkeypatch):
+    saver = Saver(_DB_URL)
+    snapshot = {key: value for key, value in _STORED_SNAPSHOT.items() if key != 'uid'}
+    later = {'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 8), 'pose': snapshot['pose']}
+    saver.client.users.insert_one({**_STORED_USER, 'snapshots': [snapshot, later]})
+
+    assert saver.migrate(batch_size=1) == 2
+    assert saver.migrate() == 0
+    assert saver.client.users.find_one(filter={'uid': 42}, projection={'_id': False}) == _STORED_USER
+    assert saver.client.snapshots.count_documents({'uid': 42}) == 2
+
+    monkeypatch.setattr(mongodb, 'MongoClient', lambda host, port: saver.client.client)
+    api = mongodb.APIClient('127.0.0.1', 27017)
+    snapshots = api.get_user_snapshots(42)
+    assert [s['datetime'] for s in snapshots] == [snapshot['timestamp_ms'], later['timestamp_ms']]
+    # Snapshot IDs don't depend on the other snapshots of the user
+    saver.client.snapshots.insert_one({'uid': 42, 'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 6)})
+    assert api.get_user_snapshot(42, snapshots[1]['id']) == {'ss_id': snapshots[1]['id'],
+                                                             'datetime': later['timestamp_ms'], 'fields': ['pose']}
+    assert api.get_user_snapshot_field(42, snapshots[0]['id'], 'feelings') == snapshot['feelings']
+
+
+def test_unknown_snapshot(mock_mongo, monkeypatch):
+    saver = Saver(_DB_URL)
+    with open('data/pose.result', 'rb') as fd:
+        saver.save('pose', fd.read())
+    monkeypatch.setattr(mongodb, 'MongoClient', lambda host, port: saver.client.client)
+    api = mongodb.APIClient('127.0.0.1', 27017)
+    ss_id = api.get_user_snapshots(42)[0]['id']
+    assert api.get_user_snapshot(42, ss_id + 1) is None
+    assert api.get_user_snapshot_field(42, ss_id + 1, 'pose') is None
+    assert api.get_user_snapshot_field_data(42, ss_id, 'image_color') is None
+
+    monkeypatch.setitem(app.config, 'DB_CLIENT', api)
+    client = app.test_client()
+    assert client.get(f'/users/42/snapshots/{ss_id}').status_code == 200
+    for route in ['/users/7', f'/users/42/snapshots/{ss_id + 1}', f'/users/42/snapshots/{ss_id + 1}/pose',
+                  f'/users/42/snapshots/{ss_id}/image_color/data']:
+        response = client.get(route)
+        assert response.status_code == 404
+        assert 'not found' in response.get_json()['error']
+
+
+class MockConnection:
+    def __init__(self, parameters):
+        self.is_open = True
+        self.timers = []
+
+    def channel(self):
+        return MockChannel()
+
+    def call_later(self, delay, callback):
+        self.timers.append(callback)
+        return callback
+
+    def remove_timeout(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def close(self):
+        self.is_open = False
+
+
+class MockChannel:
+    def __init__(self):
+        self.settled = []
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def queue_declare(self, queue):
+        pass
+
+    def queue_bind(self, exchange, queue, routing_key):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack):
+        assert not auto_ack
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.settled.append(('ack', delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        self.settled.append(('nack', delivery_tag, multiple, requeue))
+
+
+def test_saver_client(mock_mongo, monkeypatch):
+    monkeypatch.setattr(pika, 'BlockingConnection', MockConnection)
+    saver = Saver(_DB_URL)
+    client = rabbitmq.SaverClient('127.0.0.1', 5672, saver, batch_size=3)
+    assert client.channel.prefetch == 6
+    for tag, field in enumerate(_RESULTS, 1):
+        with open(f'data/{field}.result', 'rb') as fd:
+            client.on_consume(client.channel, pika.spec.Basic.Deliver(delivery_tag=tag, routing_key=field), None,
+                              fd.read())
+    assert client.channel.settled == [('ack', 3, True)]
+
+    # The last message is saved once the batch times out
+    client.connection.timers.pop()()
+    assert client.channel.settled[-1] == ('ack', 4, True)
+    assert_stored(saver)
+
+    # A failed batch is saved one message at a time
+    bulk_write = saver.client.snapshots.bulk_write
+    monkeypatch.setattr(saver.client.snapshots, 'bulk_write', lambda *args, **kwargs: 1 / 0)
+    for tag, field in enumerate(['pose', 'feelings'], 5):
+        client.on_consume(client.channel, pika.spec.Basic.Deliver(delivery_tag=tag, routing_key=field), None,
+                          open(f'data/{field}.result', 'rb').read())
+    client.flush_batch()
+    assert client.channel.settled[-2:] == [('ack', 5, False), ('ack', 6, False)]
 
+    # A message which can't be saved is requeued once, then rejected, the rest of its batch is saved
+    monkeypatch.setattr(saver.client.snapshots, 'bulk_write', bulk_write)
+    for tag, redelivered in [(7, False), (8, True)]:
+        client.on_consume(client.channel, pika.spec.Basic.Deliver(delivery_tag=tag, redelivered=redelivered,
+                                                                  routing_key='pose'), None, b'not bson')
+    client.on_consume(client.channel, pika.spec.Basic.Deliver(delivery_tag=9, routing_key='pose'), None,
+                      open('data/pose.result', 'rb').read())
+    assert client.channel.settled[-3:] == [('nack', 7, False, True), ('nack', 8, False, False), ('ack', 9, False)]
+    assert_stored(saver)
@@ -1,10 +1,25 @@
 import pytest
+import contextlib
+import os
+import signal
+import threading
 import time
 import datetime
+import pika
 import requests
+from pathlib import Path
 
+from cortex.benchmarks.synthetic import write_sample
 from cortex.client import upload_sample
-from cortex.server import Server
+from cortex.client.reader import Reader
+from cortex.net import blobstore, protocol
+from cortex.net.mq import rabbitmq
+from cortex.prefork import Supervisor
+from cortex.client import client as client_module
+from cortex.server import Server, metrics
+from cortex.server.admission import AdmissionControl
+from cortex.server.async_server import AsyncServer
+from cortex.server.server import _cli_run_server, _server_worker
 
 _HOST = '127.0.0.1'
 _PORT = 8000
@@ -25,15 +40,489 @@ def server():
 
 @pytest.fixture
 def mock_requests(monkeypatch, server):
-    monkeypatch.setattr(requests, 'get', server.get)
-    monkeypatch.setattr(requests, 'post', server.post)
+    # Uploads run on worker threads, each request gets its own (non context preserving) test client
+    monkeypatch.setattr(requests.Session, 'get',
+                        lambda session, url, **kwargs: server.application.test_client().get(url, **kwargs))
+    monkeypatch.setattr(requests.Session, 'post',
+                        lambda session, url, **kwargs: server.application.test_client().post(url, **kwargs))
 
 
-def test_publish(server, capsys, mock_requests):
+@pytest.fixture
+def synthetic_sample(tmp_path):
+    path = tmp_path / 'synthetic.mind.gz'
+    write_sample(path, count=3, color_size=(8, 6), depth_size=(4, 3))
+    return path
+
+
+@pytest.fixture
+def make_server(monkeypatch, tmp_path):
+    # Builds a server on a temporary data folder, the uploads of the client are handled by its app
+    def make(publish, queue_depth=None, **config):
+        monkeypatch.setitem(Server._CONFIG, 'DATA_FOLDER', str(tmp_path / 'shared'))
+        for key, value in config.items():
+            monkeypatch.setitem(Server._CONFIG, key, value)
+        server = Server(host=_HOST, port=_PORT, publish=publish, queue_depth=queue_depth)
+        monkeypatch.setattr(requests.Session, 'get',
+                            lambda session, url, **kwargs: server.app.test_client().get(url, **kwargs))
+        monkeypatch.setattr(requests.Session, 'post',
+                            lambda session, url, **kwargs: server.app.test_client().post(url, **kwargs))
+        return server
+    return make
+
+
+@pytest.mark.parametrize('batch_size', [1, 16])
+def test_publish(server, capsys, mock_requests, batch_size):
     time.sleep(1)
-    upload_sample(host=_HOST, port=_PORT, path=_SAMPLE)
+    # The shared data folder outlives the test, don't let recorded progress skip the upload
+    upload_sample(host=_HOST, port=_PORT, path=_SAMPLE, batch_size=batch_size, resume=False)
     stdout, stderr = capsys.readouterr()
 
     assert stderr == ''
     assert str(_SNAPSHOT_1) in stdout
     assert str(_SNAPSHOT_2) in stdout
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+@pytest.mark.parametrize('wire_format', ['frame', 'bson'])
+def test_publish_synthetic(make_server, synthetic_sample, batch_size, wire_format):
+    published = []
+    make_server(published.append)
+
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=batch_size,
+                         wire_format=wire_format) == 0
+    assert len(published) == 3
+    for message in published:
+        assert message['user']['uid'] == 42
+        assert Path(message['snapshot']['image_color']['image_color']).stat().st_size == 8 * 6 * 3
+        assert Path(message['snapshot']['image_depth']['image_depth']).stat().st_size == 4 * 3 * 4
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+@pytest.mark.parametrize('blob_store', ['directory', 'segment'])
+def test_write_behind(make_server, synthetic_sample, batch_size, blob_store):
+    published = []
+
+    def publish(message):
+        # Messages are only published once the blobs they refer to are written
+        assert len(blobstore.read_blob(message['snapshot']['image_color']['image_color'])) == 8 * 6 * 3
+        published.append(message)
+
+    server = make_server(publish, WRITE_BEHIND=True, BLOB_STORE=blob_store)
+
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=batch_size) == 0
+    server.blob_writer.close()
+    assert len(published) == 3
+    assert len(server.app.config['PROGRESS_LOG'].accepted(42)) == 3
+
+
+def test_write_behind_failure(monkeypatch, make_server, synthetic_sample):
+    published = []
+    server = make_server(published.append, WRITE_BEHIND=True)
+    progress_log = server.app.config['PROGRESS_LOG']
+    put = server.blob_store.put
+    puts = []
+
+    def flaky_put(key, data):
+        # The disk is full for a moment, failing the job of a single snapshot
+        puts.append(key)
+        if len(puts) == 3:
+            raise OSError('No space left on device')
+        return put(key, data)
+
+    monkeypatch.setattr(server.blob_store, 'put', flaky_put)
+    before = metrics.BLOB_WRITE_FAILURES.value()
+
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=1, concurrency=1) == 0
+    server.blob_writer.flush()
+    assert len(published) == 2
+    assert metrics.BLOB_WRITE_FAILURES.value() - before == 1
+    assert len(progress_log.accepted(42)) == 2
+
+    # The snapshot which failed to be written isn't recorded as accepted, resuming the upload sends it again
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample) == 0
+    server.blob_writer.close()
+    assert len(published) == 3
+    assert len(progress_log.accepted(42)) == 3
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+@pytest.mark.parametrize('wire_format', ['frame', 'bson'])
+@pytest.mark.parametrize('blob_store', ['directory', 'segment'])
+def test_async_server(tmp_path, synthetic_sample, batch_size, wire_format, blob_store):
+    published = []
+    server = AsyncServer(_HOST, 0, publish=published.append, config={**Server._CONFIG, 'BLOB_STORE': blob_store,
+                                                                     'DATA_FOLDER': str(tmp_path / 'shared')})
+    thread = threading.Thread(target=server.start)
+    thread.start()
+    try:
+        assert server.started.wait(5)
+        assert upload_sample(host=_HOST, port=server.port, path=synthetic_sample, batch_size=batch_size,
+                             wire_format=wire_format) == 0
+        assert requests.get(f'http://{_HOST}:{server.port}/unknown').status_code == 404
+    finally:
+        server.stop()
+        thread.join()
+
+    assert len(published) == 3
+    for message in published:
+        assert message['user']['uid'] == 42
+        assert len(blobstore.read_blob(message['snapshot']['image_color']['image_color'])) == 8 * 6 * 3
+        assert len(blobstore.read_blob(message['snapshot']['image_depth']['image_depth'])) == 4 * 3 * 4
+    assert sorted(server.progress_log.accepted(42)) == \
+        sorted(protocol.timestamp_key(message['snapshot']['timestamp_ms']) for message in published)
+
+
+@pytest.mark.parametrize('options', [{'workers': 2}, {'write_behind': True}])
+def test_async_server_options(options):
+    # Options the asyncio engine doesn't support are refused rather than ignored
+    with pytest.raises(ValueError):
+        _cli_run_server(_HOST, 0, 'local://', engine='asyncio', **options)
+    assert not Server._CONFIG['WRITE_BEHIND']
+
+
+def test_admission_control():
+    depth = [0]
+    admission = AdmissionControl(max_in_flight=2, queue_high=100, queue_low=50, retry_after=3,
+                                 queue_depth=lambda: depth[0])
+    assert admission.admit() is None
+    assert admission.admit() is None
+    assert admission.admit() == 3
+    admission.release()
+    assert admission.admit() is None
+    admission.release()
+    admission.release()
+
+    # Past the high watermark uploads are rejected until the queue drains under the low one
+    depth[0] = 100
+    assert admission.admit() == 3
+    depth[0] = 75
+    assert admission.admit() == 3
+    depth[0] = 50
+    assert admission.admit() is None
+    assert admission.in_flight == 1
+
+
+@pytest.mark.parametrize('batch_size', [1, 2])
+def test_overloaded_retry(monkeypatch, make_server, synthetic_sample, batch_size):
+    published, delays = [], []
+    # The downstream queues are backed up for the first two uploads
+    depths = iter([20000, 20000])
+    server = make_server(published.append, queue_depth=lambda: next(depths, 0))
+    monkeypatch.setattr(client_module.time, 'sleep', delays.append)
+
+    response = server.app.test_client().post('/snapshot', data=b'')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=batch_size, concurrency=1) == 0
+    assert len(published) == 3
+    # Retried once, honoring the server's Retry-After with some jitter
+    assert len(delays) == 1 and 1 <= delays[0] <= 2
+    assert server.admission.in_flight == 0
+
+
+def test_failed_upload(monkeypatch, make_server, synthetic_sample):
+    published, delays = [], []
+    # The broker is down for the first upload attempt, then for good
+    failures = iter([True, False, False, True])
+
+    def publish(message):
+        if next(failures, True):
+            raise ConnectionError('Broker is down')
+        published.append(message)
+
+    app = make_server(publish).app
+    monkeypatch.setattr(client_module.time, 'sleep', delays.append)
+    before = metrics.REQUESTS.value('/snapshot', '503')
+
+    assert app.test_client().post('/snapshot', data=b'not bson').status_code == 400
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=1, concurrency=1,
+                         max_retries=1) == 1
+    # Failed publishes are retried, and only the published snapshots are recorded as accepted
+    assert len(published) == 2
+    assert len(delays) == 2
+    assert metrics.REQUESTS.value('/snapshot', '503') - before == 3
+    assert sorted(app.config['PROGRESS_LOG'].accepted(42)) == \
+        sorted(protocol.timestamp_key(message['snapshot']['timestamp_ms']) for message in published)
+
+
+def test_metrics_sharded(monkeypatch):
+    monkeypatch.setattr(metrics.Counter, '_FOLD_AT', 4)
+    counter = metrics.Counter('test_total', 'Test counter', ('kind',))
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1))
+
+    def work(i):
+        for _ in range(100):
+            counter.inc('even' if i % 2 == 0 else 'odd')
+        histogram.observe(i / 10)
+
+    # Shards of the finished threads are folded as new threads register theirs
+    for _ in range(4):
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert counter.value('even') == counter.value('odd') == 1600
+    assert histogram.count() == 32
+    assert histogram.collect() == ['test_seconds_bucket{le="0.1"} 8', 'test_seconds_bucket{le="1"} 32',
+                                   'test_seconds_bucket{le="+Inf"} 32', f'test_seconds_sum {histogram._total()[-1]!r}',
+                                   'test_seconds_count 32']
+    assert counter.collect() == ['test_total{kind="even"} 1600', 'test_total{kind="odd"} 1600']
+
+
+def test_metrics_endpoint(make_server, synthetic_sample):
+    app = make_server(lambda message: None).app
+    before = (metrics.REQUESTS.value('/snapshot', '200'), metrics.SNAPSHOT_FIELDS.value('image_depth'),
+              metrics.PUBLISH_SECONDS.count(), metrics.BLOB_WRITE_SECONDS.count())
+
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample, batch_size=1) == 0
+    after = (metrics.REQUESTS.value('/snapshot', '200'), metrics.SNAPSHOT_FIELDS.value('image_depth'),
+             metrics.PUBLISH_SECONDS.count(), metrics.BLOB_WRITE_SECONDS.count())
+    assert [b - a for a, b in zip(before, after)] == [3, 3, 3, 6]
+
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+    text = response.data.decode()
+    assert '# TYPE cortex_server_decode_seconds histogram' in text
+    assert f'cortex_server_requests_total{{route="/snapshot",status="200"}} {after[0]}' in text
+    assert 'cortex_server_in_flight_requests 0' in text
+
+
+def test_resume_upload(make_server, synthetic_sample):
+    published = []
+    app = make_server(published.append).app
+
+    # Simulate an interrupted upload which got the first and third snapshots through
+    reader = Reader(synthetic_sample, 'protobuf')
+    reader.read_user()
+    timestamps = [protocol.timestamp_key(snapshot.timestamp_ms) for snapshot in reader]
+    app.config['PROGRESS_LOG'].record(42, [timestamps[0], timestamps[2]])
+
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample) == 0
+    assert [protocol.timestamp_key(message['snapshot']['timestamp_ms']) for message in published] == [timestamps[1]]
+    assert sorted(app.config['PROGRESS_LOG'].accepted(42)) == timestamps
+
+    published.clear()
+    assert upload_sample(host=_HOST, port=_PORT, path=synthetic_sample) == 0
+    assert published == []
+
+
+def test_prefork_supervisor(tmp_path):
+    @contextlib.contextmanager
+    def worker():
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(os.getpid()).encode()]
+        try:
+            yield app
+        finally:
+            (tmp_path / f'{os.getpid()}.closed').touch()
+
+    supervisor = Supervisor(_HOST, 0, worker, workers=2, restart_delay=0.01)
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+    try:
+        assert supervisor.started.wait(5)
+        url = f'http://{_HOST}:{supervisor.port}/'
+        assert int(requests.get(url).text) in supervisor.pids
+
+        # A crashed worker is replaced
+        crashed = next(iter(supervisor.pids))
+        os.kill(crashed, signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        while (crashed in supervisor.pids or len(supervisor.pids) < 2) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        workers = set(supervisor.pids)
+        assert crashed not in workers and len(workers) == 2
+        assert int(requests.get(url).text) in workers
+    finally:
+        supervisor.stop()
+        thread.join()
+
+    # Workers are stopped gracefully, leaving their context
+    assert supervisor.pids == set()
+    assert {int(path.stem) for path in tmp_path.glob('*.closed')} == workers
+
+
+def test_metrics_prefork(monkeypatch, tmp_path):
+    monkeypatch.setitem(Server._CONFIG, 'DATA_FOLDER', str(tmp_path / 'shared'))
+    metrics_dir = tmp_path / 'metrics'
+    metrics_dir.mkdir()
+    supervisor = Supervisor(_HOST, 0, lambda: _server_worker(_HOST, 0, print, None, metrics_dir=metrics_dir),
+                            workers=2, restart_delay=0.01)
+    thread = threading.Thread(target=supervisor.run)
+    thread.start()
+
+    def scrape():
+        text = requests.get(f'http://{_HOST}:{supervisor.port}/metrics').text
+        return [line for line in text.splitlines() if line.startswith('cortex_server_requests_total{route="/config"')]
+
+    try:
+        assert supervisor.started.wait(5)
+        for _ in range(20):
+            assert requests.get(f'http://{_HOST}:{supervisor.port}/config').status_code == 200
+        time.sleep(1.5)
+        # Whichever worker answers reports the requests of both
+        for _ in range(4):
+            assert scrape() == ['cortex_server_requests_total{route="/config",status="200"} 20']
+
+        # The requests of a crashed worker are still counted
+        crashed = next(iter(supervisor.pids))
+        os.kill(crashed, signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        while (crashed in supervisor.pids or len(supervisor.pids) < 2) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for _ in range(4):
+            assert scrape() == ['cortex_server_requests_total{route="/config",status="200"} 20']
+    finally:
+        supervisor.stop()
+        thread.join()
+
+
+def test_segment_store(tmp_path):
+    store = blobstore.SegmentStore(tmp_path / 'shared', max_segment_size=64)
+    blobs = {f'{uid}/2019-12-04_10-08-07-{i:06d}/image_color.raw': bytes([uid + i]) * 24
+             for uid in (1, 2) for i in range(4)}
+    refs = {key: store.put(key, data) for key, data in blobs.items()}
+
+    # A failed upload leaves no trace in the index
+    blob = store.create('1/2019-12-04_10-08-08-000000/image_color.raw', 8)
+    blob.write(b'1234')
+    with pytest.raises(ValueError):
+        blob.commit()
+    store.sync(list(refs.values()))
+
+    for key, ref in refs.items():
+        assert ref.startswith('segment:')
+        assert blobstore.blob_key(ref) == key
+        assert store.get(ref) == blobs[key]
+        assert blobstore.read_blob(ref) == blobs[key]
+    # Users get their own segments, 24 bytes blobs roll over a 64 bytes segment every third blob
+    for uid in (1, 2):
+        segments = store.segments(uid)
+        assert len(segments) == 2
+        assert [key for segment in segments for key, _ in store.index(segment)] == \
+            [key for key in blobs if key.startswith(f'{uid}/')]
+    store.close()
+
+
+class MockConnection:
+    instances = []
+    fail_at = set()
+    published = []
+
+    def __init__(self, parameters):
+        self.is_open = True
+        self.thread = threading.get_ident()
+        MockConnection.instances.append(self)
+
+    def channel(self):
+        return MockChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+class MockChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.confirming = False
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def exchange_declare(self, exchange, exchange_type):
+        pass
+
+    def confirm_delivery(self):
+        self.confirming = True
+
+    def basic_publish(self, exchange, routing_key, body):
+        # pika connections must only be used by the thread which opened them
+        assert threading.get_ident() == self.connection.thread
+        if len(MockConnection.published) in MockConnection.fail_at:
+            MockConnection.fail_at.remove(len(MockConnection.published))
+            self.connection.is_open = False
+            raise pika.exceptions.StreamLostError('Connection lost')
+        MockConnection.published.append((routing_key, body))
+
+
+def test_publisher_concurrent(monkeypatch):
+    monkeypatch.setattr(pika, 'BlockingConnection', MockConnection)
+    monkeypatch.setattr(MockConnection, 'instances', [])
+    monkeypatch.setattr(MockConnection, 'published', [])
+    monkeypatch.setattr(MockConnection, 'fail_at', {37})
+    publisher = rabbitmq.Publisher(_HOST, 5672, 'snapshots', confirms=True, max_queue=8, batch_size=4,
+                                   reconnect_delay=0.01)
+
+    futures = []
+
+    def publish_all(thread_id):
+        for i in range(50):
+            futures.append(publisher.publish(str(thread_id), f'{thread_id}:{i}'.encode()))
+
+    threads = [threading.Thread(target=publish_all, args=(thread_id,)) for thread_id in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    publisher.close()
+
+    assert len(MockConnection.instances) == 2
+    assert len(MockConnection.published) == 8 * 50
+    assert all(future.done() and future.exception() is None for future in futures)
+    for thread_id in range(8):
+        bodies = [body for routing_key, body in MockConnection.published if routing_key == str(thread_id)]
+        assert bodies == [f'{thread_id}:{i}'.encode() for i in range(50)]
+    with pytest.raises(RuntimeError):
+        publisher.publish('0', b'')
+
+
+def test_publisher_shutdown(monkeypatch, make_server):
+    def basic_publish(channel, exchange, routing_key, body):
+        raise pika.exceptions.StreamLostError('Connection lost')
+
+    monkeypatch.setattr(pika, 'BlockingConnection', MockConnection)
+    monkeypatch.setattr(MockConnection, 'instances', [])
+    monkeypatch.setattr(MockChannel, 'basic_publish', basic_publish)
+    mq_client = rabbitmq.SnapshotClient(_HOST, 5672, **{**Server._CONFIG, 'ADMISSION_QUEUE_HIGH': 0})
+    mq_client.publisher.reconnect_delay = 0.01
+    app = make_server(mq_client.publish, PUBLISH_TIMEOUT=0.1).app
+
+    # The broker never gets the message, it must not be recorded as accepted
+    message = {'user': {'uid': 42}, 'snapshot': {'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 7, 339000)}}
+    response = app.test_client().post('/snapshot', data=protocol.encode_message(message, 'bson'),
+                                      headers={'Content-Type': protocol.WIRE_FORMATS['bson']})
+    assert response.status_code == 503
+    future = mq_client.publish(message)
+    mq_client.close()
+    assert isinstance(future.exception(timeout=1), ConnectionError)
+    assert len(app.config['PROGRESS_LOG'].accepted(42)) == 0
+
+
+def test_publisher_full(monkeypatch, make_server):
+    def basic_publish(channel, exchange, routing_key, body):
+        raise pika.exceptions.StreamLostError('Connection lost')
+
+    monkeypatch.setattr(pika, 'BlockingConnection', MockConnection)
+    monkeypatch.setattr(MockConnection, 'instances', [])
+    monkeypatch.setattr(MockChannel, 'basic_publish', basic_publish)
+    mq_client = rabbitmq.SnapshotClient(_HOST, 5672, **{**Server._CONFIG, 'ADMISSION_QUEUE_HIGH': 0,
+                                                        'PUBLISH_QUEUE_SIZE': 1, 'PUBLISH_QUEUE_TIMEOUT': 0.2,
+                                                        'PUBLISH_BATCH_SIZE': 1})
+    mq_client.publisher.reconnect_delay = 0.01
+    app = make_server(mq_client.publish, PUBLISH_TIMEOUT=30).app
+
+    # While the broker is down the queue fills up, publishing fails instead of blocking the request
+    message = {'user': {'uid': 42}, 'snapshot': {'timestamp_ms': datetime.datetime(2019, 12, 4, 10, 8, 7, 339000)}}
+    futures = [mq_client.publish(message) for _ in range(2)]
+    start = time.perf_counter()
+    response = app.test_client().post('/snapshot', data=protocol.encode_message(message, 'bson'),
+                                      headers={'Content-Type': protocol.WIRE_FORMATS['bson']})
+    assert response.status_code == 503
+    assert time.perf_counter() - start < 5
+    assert not any(future.done() for future in futures)
+    mq_client.close()
+    assert len(app.config['PROGRESS_LOG'].accepted(42)) == 0